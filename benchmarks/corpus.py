@@ -0,0 +1,168 @@
+"""
+Synthetic statuses used by the benchmarks.
+
+The generated statuses are deterministic (seeded), and mix the things the
+text pipeline has to deal with: URLs, mentions, e-mail addresses, hashtags,
+over-long words, line breaks, repeated spaces, emoji and non-latin text.
+"""
+import random
+
+WORDS = [
+    'the', 'crossposter', 'toot', 'tweet', 'thread', 'federation', 'instance', 'timeline',
+    'bonjour', 'château', 'ça', 'très', 'über', 'straße', 'español', 'niño',
+    'привет', 'мир', 'こんにちは', '世界', 'مرحبا', 'שלום', 'γειά', 'नमस्ते',
+    '🐘', '🐦', '🔁', '✨', '👩‍💻', '🏳️‍🌈',
+]
+
+URLS = [
+    'https://example.com', 'https://example.com/some/long/path?with=query&and=more#anchor',
+    'http://www.example.org/', 'www.example.net/index.html', 'example.fr', 'sub.domain.co.uk/path',
+    'https://mastodon.social/@user/123456789012345678', 'https://t.co/AbCdEf1234', 'foo.1',
+    'https://xn--nxasmq6b.com/', 'http://127.0.0.1:8080/', 'https://example.com/path_(with)_parens',
+]
+
+OTHERS = [
+    '@user', '@user@mastodon.social', 'me@example.com', '#hashtag', '#Mastodon', '#twitter',
+    'supercalifragilisticexpialidociousandevenlongerthanthat', 'a' * 45, '',
+    'word\nword', 'end.\n\nStart', '(example.com)', '"https://example.com/"', 'e.g.',
+]
+
+
+def make_status(length, seed=0, url_ratio=0.1, other_ratio=0.15):
+    """
+    :param length: The minimal status length, in characters.
+    :param seed: The random seed.
+    :param url_ratio: The proportion of URLs among words.
+    :param other_ratio: The proportion of mentions, hashtags, long words... among words.
+    :return: A status.
+    """
+    rng = random.Random(seed)
+    words = []
+    size = 0
+
+    while size < length:
+        draw = rng.random()
+        if draw < url_ratio:
+            word = rng.choice(URLS)
+        elif draw < url_ratio + other_ratio:
+            word = rng.choice(OTHERS)
+        else:
+            word = rng.choice(WORDS)
+
+        words.append(word)
+        size += len(word) + 1
+
+    return ' '.join(words)
+
+
+def make_hashtag_status(length, seed=0):
+    """
+    :return: A status starting and ending with hashtags.
+    """
+    rng = random.Random(seed)
+    begin = ' '.join(f'#tag{rng.randrange(100)}' for _ in range(rng.randrange(1, 4)))
+    end = ' '.join(f'#end{rng.randrange(100)}' for _ in range(rng.randrange(1, 4)))
+    return f'{begin} {make_status(length, seed)} {end}'
+
+
+def make_corpus(sizes=(50, 200, 300, 500, 1000, 2000), seeds=range(20)):
+    """
+    :return: A list of statuses of various sizes and shapes.
+    """
+    corpus = []
+    for size in sizes:
+        for seed in seeds:
+            corpus.append(make_status(size, seed))
+            corpus.append(make_status(size, seed, url_ratio=0.4, other_ratio=0.3))
+            corpus.append(make_hashtag_status(size, seed))
+    return corpus
+
+
+INSTANCE_URL = 'https://mastodon.example'
+
+
+def make_toot_html(paragraphs, seed=0):
+    """
+    :param paragraphs: The number of paragraphs.
+    :param seed: The random seed.
+    :return: A toot HTML content, shaped like the content Mastodon sends.
+    """
+    rng = random.Random(seed)
+    html_paragraphs = []
+
+    for _ in range(paragraphs):
+        parts = []
+        for _ in range(rng.randrange(5, 40)):
+            draw = rng.random()
+            if draw < 0.05:
+                user = rng.choice(['alice', 'bob', 'carol_'])
+                parts.append(f'<span class="h-card"><a href="{INSTANCE_URL}/@{user}" class="u-url mention">'
+                             f'@<span>{user}</span></a></span>')
+            elif draw < 0.1:
+                tag = rng.choice(['Mastodon', 'fediverse', 'café'])
+                parts.append(f'<a href="{INSTANCE_URL}/tags/{tag}" class="mention hashtag" rel="tag">'
+                             f'#<span>{tag}</span></a>')
+            elif draw < 0.15:
+                parts.append('<a href="https://example.com/some/long/path" rel="nofollow noopener" target="_blank">'
+                             '<span class="invisible">https://</span><span class="ellipsis">example.com/some/lo'
+                             '</span><span class="invisible">ng/path</span></a>')
+            elif draw < 0.17:
+                media_id = rng.randrange(10 ** 6)
+                parts.append(f'<a href="{INSTANCE_URL}/media/{media_id}">{INSTANCE_URL}/media/{media_id}</a>')
+            elif draw < 0.2:
+                parts.append(rng.choice(['&amp;', '&lt;3', '&quot;quoted&quot;', '&#39;', '<br />', '<br>']))
+            else:
+                parts.append(rng.choice(WORDS))
+        html_paragraphs.append(' '.join(parts))
+
+    return '<p>' + '</p><p>'.join(html_paragraphs) + '</p>'
+
+
+CONTENT_WARNINGS = ['CW: spoilers', '[TW - politics]', '(SPOILER: the end)', '[CW ⋅ food, 🍕]', '(tw, 日本語)']
+
+
+def make_cw_status(length, seed=0):
+    """
+    :return: A status with one or more content warnings, as written in tweets.
+    """
+    rng = random.Random(seed)
+    warnings = ' '.join(rng.sample(CONTENT_WARNINGS, rng.randrange(1, 3)))
+    return f'{warnings} {make_status(length, seed)}'
+
+
+def make_hashtag_wall(tags, seed=0):
+    """
+    :return: A status made (almost) only of hashtags.
+    """
+    rng = random.Random(seed)
+    return ' '.join(f'#{rng.choice(["tag", "Mastodon", "fediverse", "art"])}{rng.randrange(1000)}'
+                    for _ in range(tags)) + ' ' + rng.choice(WORDS)
+
+
+def make_emoji_status(length, seed=0):
+    """
+    :return: A status mostly made of emoji and non-latin text.
+    """
+    rng = random.Random(seed)
+    words = WORDS[16:]  # From 'привет' on
+    status = ''
+    while len(status) < length:
+        status += rng.choice(words) + rng.choice(['', ' ', ' ', '\n'])
+    return status
+
+
+def make_text_corpus(seeds=range(10)):
+    """
+    :return: A dict of named lists of statuses, each exercising a part of
+             the text pipeline: short and long statuses (threads once
+             split), URLs, hashtags, content warnings, emoji.
+    """
+    return {
+        'short': [make_status(length, seed) for seed in seeds for length in (80, 200, 270)],
+        'thread': [make_status(length, seed) for seed in seeds for length in (1000, 3000, 5000)],
+        'urls': [make_status(length, seed, url_ratio=0.5, other_ratio=0.1) for seed in seeds for length in (280, 1000)],
+        'hashtags': [make_hashtag_wall(tags, seed) for seed in seeds for tags in (5, 30, 80)]
+        + [make_hashtag_status(length, seed) for seed in seeds for length in (300, 1000)],
+        'cw': [make_cw_status(length, seed) for seed in seeds for length in (100, 500)],
+        'emoji': [make_emoji_status(length, seed) for seed in seeds for length in (280, 1000)],
+    }
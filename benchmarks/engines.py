@@ -0,0 +1,148 @@
+"""
+Compares the per-status latency of the threaded engine (statuses processed
+one after the other) and of the asyncio engine, under bursts of statuses.
+
+The publishers are stubs: processing a status sleeps for a while, like a
+post or a media upload would (some statuses being much slower, like those
+with large medias), and the streams emit statuses at a fixed pace, some of
+them being replies. The work queue is also checked with statuses queued
+twice.
+
+Run from the project root:
+
+    python -m benchmarks.engines
+"""
+import random
+import statistics
+import threading
+import time
+
+from mtt.async_engine import AsyncEngine
+from mtt.work_queue import WorkQueue
+
+
+class StubPublisher:
+    def __init__(self, name, statuses, interval):
+        self.name = name
+        self.statuses = statuses
+        self.interval = interval
+        self.latencies = []
+        self.processed = []
+        self.work_queue = None
+
+    def init_process(self):
+        pass
+
+    def listen(self, callback):
+        # Statuses are emitted at a fixed pace; statuses emitted while the
+        # previous one is processed are waiting in the stream.
+        start = time.perf_counter()
+        for i, status in enumerate(self.statuses):
+            status['emitted_at'] = start + i * self.interval
+            time.sleep(max(0, status['emitted_at'] - time.perf_counter()))
+            callback(status)
+
+    @staticmethod
+    def get_reply_ids(status):
+        return status['id'], status['in_reply_to_id']
+
+    def process_status(self, status):
+        time.sleep(status['duration'])
+        self.processed.append(status['id'])
+        self.latencies.append(time.perf_counter() - status['emitted_at'])
+
+    def read_stream(self):
+        self.listen(lambda status: self.work_queue.put(*self.get_reply_ids(status), status))
+
+    def crosspost(self, status, attempt=0):
+        self.process_status(status)
+
+    def run_sequentially(self):
+        # What a publisher thread does
+        self.listen(self.process_status)
+
+
+def make_statuses(count, seed):
+    rng = random.Random(seed)
+    statuses = []
+    for i in range(count):
+        statuses.append({
+            'id': seed * 10000 + i,
+            'in_reply_to_id': statuses[-1]['id'] if statuses and rng.random() < 0.2 else None,
+            # Mostly fast posts, and a few slow media uploads
+            'duration': rng.choice((0.02, 0.02, 0.03, 0.05, 0.3))
+        })
+    return statuses
+
+
+def summarize(label, publishers):
+    latencies = sorted(latency for publisher in publishers for latency in publisher.latencies)
+    print(f'{label:>8} {statistics.mean(latencies) * 1000:>10.0f} {statistics.median(latencies) * 1000:>10.0f} '
+          f'{latencies[int(len(latencies) * 0.95)] * 1000:>10.0f}')
+
+
+def check_order(publishers):
+    for publisher in publishers:
+        position = {status_id: i for i, status_id in enumerate(publisher.processed)}
+        for status in publisher.statuses:
+            if status['in_reply_to_id'] is not None:
+                assert position[status['in_reply_to_id']] < position[status['id']], 'reply processed first'
+
+
+def check_duplicates():
+    """
+    Statuses queued again (as a stream may resend them after a reconnection) are processed once, and do not
+    stop the workers.
+    """
+    processed = []
+    lock = threading.Lock()
+
+    def handler(status, attempt):
+        time.sleep(0.01)
+        with lock:
+            processed.append(status['id'])
+
+    queue = WorkQueue(handler, name='duplicates', workers=2, max_size=100)
+    queue.start()
+
+    statuses = make_statuses(20, 3)
+    for status in statuses + statuses[:10]:
+        queue.put(*StubPublisher.get_reply_ids(status), status)
+
+    # Queued again while the first ones are processed
+    for status in statuses[15:]:
+        queue.put(*StubPublisher.get_reply_ids(status), status)
+
+    deadline = time.monotonic() + 10
+    while queue.stats['processed'] < len(statuses) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert all(worker.is_alive() for worker in queue.workers), 'a worker stopped'
+
+    queue.close()
+    assert sorted(processed) == sorted(status['id'] for status in statuses), 'duplicate or missing statuses'
+    print(f'{len(statuses)} statuses queued twice, processed once.')
+
+
+def main():
+    count, interval = 40, 0.03
+
+    print(f'{count} statuses per direction, one every {interval * 1000:.0f} ms; latencies in ms')
+    print(f'{"engine":>8} {"mean":>10} {"median":>10} {"p95":>10}')
+
+    # The threaded engine: each direction is sequential (both directions
+    # run in parallel, so they don't interfere; a single one is enough).
+    publisher = StubPublisher('threads', make_statuses(count, 1), interval)
+    publisher.run_sequentially()
+    summarize('threads', [publisher])
+
+    publishers = [StubPublisher('async-1', make_statuses(count, 1), interval),
+                  StubPublisher('async-2', make_statuses(count, 2), interval)]
+    AsyncEngine(publishers, max_concurrency=8).run()
+    check_order(publishers)
+    summarize('async', publishers)
+
+    check_duplicates()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,743 @@
+"""
+End-to-end load test of the crossposter, against local stand-ins of the
+Mastodon and Twitter APIs.
+
+The fake servers speak the endpoints the crossposter uses: streams (user
+stream of both platforms), timelines, account lookups, status posts, media
+uploads (Mastodon media_post, Twitter chunked uploads), the Twitter
+configuration, and the medias to download. They answer after a configurable
+latency, with rate limit headers.
+
+A synthetic workload (texts, threads, boosts/retweets and statuses with
+medias) is replayed on the source stream at a target rate, and each status
+is followed until its last part is posted on the destination. For each
+direction, the crossposter runs in its own process (its peak memory is
+reported), with a fresh state. With --foreign, statuses of other accounts
+(as a home timeline stream carries them) are sent between them.
+
+With --restart, the crossposter is killed after the first third of the
+workload, while statuses are in flight. The second third is posted while it
+is stopped, and the last third once it is started again, with the same state
+(outbox, associations, medias cache): the statuses in flight must be resumed
+from the outbox, and the others caught up from the timeline. Statuses posted
+more than once on the destination are reported as duplicates: a status
+being posted when the process is killed is posted again, as the post is not
+known to be done. At most one status per worker (PUBLISH_WORKERS, or
+ASYNC_MAX_CONCURRENCY with the async engine) is in flight, so there can't be
+more duplicates than that, and none without --restart.
+
+The exit status is 1 if some statuses were not crossposted, or if there are
+more duplicates than expected.
+
+Run from the project root:
+
+    python -m benchmarks.loadtest
+    python -m benchmarks.loadtest --count 500 --rate 50 --engine async --mix text=70,thread=10,boost=10,media=10
+    python -m benchmarks.loadtest --foreign 20
+    python -m benchmarks.loadtest --count 300 --restart
+"""
+import argparse
+import itertools
+import json
+import os
+import queue
+import random
+import re
+import resource
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+MA_ACCOUNT_ID = 1000
+TW_ACCOUNT_ID = 2000
+
+# Each status of the workload contains a marker, to follow it to the destination
+MARKER_REGEXP = re.compile(r'\bltm(\d{6})\b')
+
+# Only characters Twitter counts once: the splitter counts characters, so
+# statuses with CJK or emoji near the limit are rejected by python-twitter.
+WORDS = ['the', 'crossposter', 'federation', 'timeline', 'bonjour', 'château', 'très', 'привет', 'мир', 'γειά']
+
+DIRECTIONS = {
+    'm2t': 'Mastodon -> Twitter',
+    't2m': 'Twitter -> Mastodon'
+}
+
+
+class _FakeHandler(BaseHTTPRequestHandler):
+    # Keep-alive, like the real APIs
+    protocol_version = 'HTTP/1.1'
+    platform = None
+
+    def do_GET(self):
+        self.platform.handle(self, 'GET')
+
+    def do_POST(self):
+        self.platform.handle(self, 'POST')
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def path_only(self):
+        return urlparse(self.path).path.rstrip('/')
+
+    def read_form(self):
+        """
+        :return: The form fields of the request (query string and body), as a dict of lists.
+        """
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+
+        fields = parse_qs(urlparse(self.path).query)
+        content_type = self.headers.get('Content-Type', '')
+
+        if content_type.startswith('application/x-www-form-urlencoded'):
+            fields.update(parse_qs(body.decode('utf-8')))
+        elif content_type.startswith('application/json'):
+            fields.update({key: value if isinstance(value, list) else [value]
+                           for key, value in json.loads(body or b'{}').items()})
+        elif content_type.startswith('multipart/form-data'):
+            fields['multipart'] = [len(body)]
+
+        return fields
+
+    def send_body(self, body, status=200, content_type='application/json', headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, data, status=200):
+        self.send_body(json.dumps(data).encode('utf-8'), status=status, headers=self.platform.rate_limit_headers())
+
+    def send_stream(self, content_type, encode, keepalive, keepalive_interval):
+        """
+        Sends the statuses emitted on the platform, as a chunked response, until the client disconnects.
+        """
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        statuses = self.platform.subscribe()
+        try:
+            while True:
+                try:
+                    data = encode(statuses.get(timeout=keepalive_interval))
+                except queue.Empty:
+                    data = keepalive
+
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+                self.wfile.flush()
+        except OSError:
+            pass
+        finally:
+            self.platform.unsubscribe(statuses)
+
+
+class _FakeServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # The connections of a killed crossposter are reset
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super(_FakeServer, self).handle_error(request, client_address)
+
+
+class FakePlatform:
+    """
+    A fake API server. Subclasses route the requests.
+
+    Statuses emitted are sent to the stream subscribers, and the followed ones
+    are added to the timeline. Statuses posted are followed by their marker,
+    or by the status they reply to (parts of a split status): a status is
+    complete when its last part is posted.
+    """
+
+    def __init__(self, api_latency, media_size):
+        """
+        :param api_latency: The time taken to answer API requests (seconds).
+        :param media_size: The size of the medias served (bytes).
+        """
+        self.api_latency = api_latency
+        self.media_filler = os.urandom(media_size)
+        self.ids = itertools.count(10 ** 6)
+
+        self.lock = threading.Lock()
+        self.subscribers = []
+        self.subscriptions = 0
+        self.subscribed = threading.Condition(self.lock)
+
+        # Statuses followed, oldest first
+        self.timeline = []
+
+        # Marker -> emission time
+        self.emitted = {}
+        # Posted status ID -> marker
+        self.chains = {}
+        # Marker -> time the last part was posted
+        self.completed = {}
+        # (marker, text) of the statuses posted, to find duplicates
+        self.posted = set()
+        self.duplicates = 0
+        self.posts = 0
+        self.uploads = 0
+
+        self.server = _FakeServer(('127.0.0.1', 0), type('Handler', (_FakeHandler,), {'platform': self}))
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def subscribe(self):
+        statuses = queue.SimpleQueue()
+        with self.lock:
+            self.subscribers.append(statuses)
+            self.subscriptions += 1
+            self.subscribed.notify_all()
+        return statuses
+
+    def unsubscribe(self, statuses):
+        with self.lock:
+            self.subscribers.remove(statuses)
+
+    def wait_for_subscriber(self, timeout, after=0):
+        """
+        :param after: The number of subscriptions already made (the streams of a
+                      killed process are only closed on the next write).
+        :return: False if no stream was opened before the timeout.
+        """
+        with self.lock:
+            return self.subscribed.wait_for(lambda: self.subscriptions > after, timeout=timeout)
+
+    def emit(self, marker, status):
+        """
+        Sends a status on the streams; it is followed if it has a marker.
+        """
+        with self.lock:
+            if marker is not None:
+                self.emitted[marker] = time.time()
+                self.timeline.append(status)
+            for statuses in self.subscribers:
+                statuses.put(status)
+
+    def record_post(self, text, in_reply_to_id):
+        """
+        :return: The ID of the posted status.
+        """
+        posted_id = next(self.ids)
+        marker = MARKER_REGEXP.search(text or '')
+
+        with self.lock:
+            self.posts += 1
+            marker = marker.group(1) if marker else self.chains.get(str(in_reply_to_id))
+            if marker is not None:
+                self.chains[str(posted_id)] = marker
+                self.completed[marker] = time.time()
+
+                if (marker, text) in self.posted:
+                    self.duplicates += 1
+                self.posted.add((marker, text))
+
+        return posted_id
+
+    def timeline_page(self, request, max_id_included):
+        """
+        :param max_id_included: True if the status with the max_id is in the page (Twitter), False if not (Mastodon).
+        :return: The statuses of the timeline page requested, newest first.
+        """
+        query = parse_qs(urlparse(request.path).query)
+        since_id = int(query.get('since_id', ['0'])[0])
+        max_id = int(query['max_id'][0]) if 'max_id' in query else None
+        limit = int((query.get('limit') or query.get('count') or ['20'])[0])
+
+        with self.lock:
+            statuses = [status for status in reversed(self.timeline) if int(status['id']) > since_id
+                        and (max_id is None or int(status['id']) < max_id + max_id_included)]
+        return statuses[:limit]
+
+    def rate_limit_headers(self):
+        return {}
+
+    def media_url(self, name):
+        return f'{self.url}/media/{name}.png'
+
+    def handle(self, request, method):
+        path = request.path_only
+
+        if path.startswith('/media/'):
+            # Different content for each media, so they are not deduplicated
+            request.send_body(path.encode('utf-8') + self.media_filler, content_type='image/png')
+            return
+
+        time.sleep(self.api_latency)
+        if not self.route(request, method, path):
+            request.send_json({'error': f'Unknown endpoint {method} {path}'}, status=404)
+
+    def route(self, request, method, path):
+        """
+        :return: False if the endpoint is unknown.
+        """
+        raise NotImplementedError
+
+
+class FakeMastodon(FakePlatform):
+    def account(self):
+        return {'id': str(MA_ACCOUNT_ID), 'username': 'bench', 'acct': 'bench', 'url': f'{self.url}/@bench'}
+
+    def rate_limit_headers(self):
+        reset = datetime.now(timezone.utc) + timedelta(minutes=5)
+        return {'X-RateLimit-Limit': '1000000', 'X-RateLimit-Remaining': '999999',
+                'X-RateLimit-Reset': reset.isoformat()}
+
+    def route(self, request, method, path):
+        if method == 'GET' and path == '/api/v1/streaming/user':
+            request.send_stream('text/event-stream',
+                                lambda toot: b'event: update\ndata: ' + json.dumps(toot).encode('utf-8') + b'\n\n',
+                                keepalive=b':thump\n', keepalive_interval=15)
+        elif method == 'GET' and path == '/api/v1/instance':
+            # Streams are served by the API server
+            request.send_json({'uri': self.url, 'title': 'Fake Mastodon', 'version': '4.2.0', 'urls': {}})
+        elif method == 'GET' and path == '/api/v2/instance':
+            request.send_json({'domain': self.url, 'title': 'Fake Mastodon', 'version': '4.2.0', 'configuration': {}})
+        elif method == 'GET' and path in ('/api/v1/accounts/verify_credentials', f'/api/v1/accounts/{MA_ACCOUNT_ID}'):
+            request.send_json(self.account())
+        elif method == 'GET' and path == f'/api/v1/accounts/{MA_ACCOUNT_ID}/statuses':
+            request.send_json(self.timeline_page(request, max_id_included=False))
+        elif method == 'POST' and path == '/api/v1/statuses':
+            form = request.read_form()
+            toot_id = self.record_post(form.get('status', [''])[0], form.get('in_reply_to_id', [None])[0])
+            request.send_json({'id': str(toot_id), 'uri': f'{self.url}/statuses/{toot_id}',
+                               'url': f'{self.url}/@bench/{toot_id}', 'content': form.get('status', [''])[0],
+                               'account': self.account(), 'media_attachments': []})
+        elif method == 'POST' and path in ('/api/v1/media', '/api/v2/media'):
+            request.read_form()
+            with self.lock:
+                self.uploads += 1
+            media_id = next(self.ids)
+            request.send_json({'id': str(media_id), 'type': 'image', 'url': self.media_url(media_id)})
+        else:
+            return False
+        return True
+
+
+class FakeTwitter(FakePlatform):
+    def user(self):
+        return {'id': TW_ACCOUNT_ID, 'id_str': str(TW_ACCOUNT_ID), 'screen_name': 'bench', 'name': 'Bench'}
+
+    def rate_limit_headers(self):
+        return {'x-rate-limit-limit': '1000000', 'x-rate-limit-remaining': '999999',
+                'x-rate-limit-reset': str(int(time.time()) + 300)}
+
+    def route(self, request, method, path):
+        if path == '/1.1/user.json':
+            request.send_stream('application/json', lambda tweet: json.dumps(tweet).encode('utf-8') + b'\r\n',
+                                keepalive=b'\r\n', keepalive_interval=30)
+        elif method == 'GET' and path == '/1.1/account/verify_credentials.json':
+            request.send_json(self.user())
+        elif method == 'GET' and path == '/1.1/statuses/user_timeline.json':
+            request.send_json(self.timeline_page(request, max_id_included=True))
+        elif method == 'GET' and path == '/1.1/help/configuration.json':
+            request.send_json({'short_url_length': 23, 'short_url_length_https': 23,
+                               'characters_reserved_per_media': 24, 'photo_size_limit': 3145728})
+        elif method == 'POST' and path == '/1.1/statuses/update.json':
+            form = request.read_form()
+            text = form.get('status', [''])[0]
+            tweet_id = self.record_post(text, form.get('in_reply_to_status_id', [None])[0])
+            request.send_json({'id': tweet_id, 'id_str': str(tweet_id), 'full_text': text, 'user': self.user()})
+        elif method == 'POST' and path == '/1.1/media/upload.json':
+            form = request.read_form()
+            if 'multipart' in form:
+                # APPEND: no content
+                request.send_body(b'', status=204)
+            elif form.get('command') == ['INIT']:
+                with self.lock:
+                    self.uploads += 1
+                media_id = next(self.ids)
+                request.send_json({'media_id': media_id, 'media_id_string': str(media_id)})
+            else:
+                media_id = int(form.get('media_id', ['0'])[0])
+                request.send_json({'media_id': media_id, 'media_id_string': str(media_id)})
+        else:
+            return False
+        return True
+
+
+def make_workload(direction, count, mix, seed, source):
+    """
+    :param direction: 'm2t' (toots) or 't2m' (tweets).
+    :param count: The number of statuses.
+    :param mix: A dict mapping the kinds of statuses (text, thread, boost, media) to their weight.
+    :param seed: The random seed.
+    :param source: The fake platform the statuses are emitted on.
+    :return: A list of (marker, status) tuples.
+    """
+    rng = random.Random(seed)
+    kinds, weights = zip(*mix.items())
+    workload = []
+    previous_id = None
+
+    for i in range(count):
+        kind = rng.choices(kinds, weights)[0]
+        marker = f'{i:06d}'
+        status_id = (10 ** 7 if direction == 'm2t' else 10 ** 8) + i
+        # Threads are long enough to be split into several tweets (or replies on Twitter)
+        length = rng.randint(400, 900) if kind == 'thread' and direction == 'm2t' else rng.randint(40, 200)
+        text = f'ltm{marker} ' + ' '.join(rng.choice(WORDS) for _ in range(length // 6))
+        in_reply_to_id = previous_id if kind == 'thread' else None
+
+        if direction == 'm2t':
+            status = make_toot(status_id, text, kind, in_reply_to_id, source.account(), source.media_url(marker))
+        else:
+            status = make_tweet(status_id, text, kind, in_reply_to_id, source.user(), source.media_url(marker))
+
+        workload.append((marker, status))
+        if kind != 'boost':
+            previous_id = status_id
+
+    return workload
+
+
+def make_foreign_statuses(direction, count, seed):
+    """
+    :return: Statuses of other accounts, as found in home timelines (not crossposted).
+    """
+    rng = random.Random(seed)
+    statuses = []
+
+    for i in range(count):
+        status_id = (10 ** 9 if direction == 'm2t' else 10 ** 10) + i
+        text = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(5, 40)))
+        if direction == 'm2t':
+            account = {'id': str(3000 + i % 50), 'username': f'friend{i % 50}',
+                       'url': f'https://example.com/@friend{i % 50}',
+                       'note': '<p>' + ' '.join(WORDS) + '</p>', 'created_at': '2020-01-01T00:00:00.000Z'}
+            statuses.append(dict(make_toot(status_id, text, 'text', None, account, None),
+                                 created_at='2026-01-01T00:00:00.000Z'))
+        else:
+            user = {'id': 3000 + i % 50, 'id_str': str(3000 + i % 50), 'screen_name': f'friend{i % 50}'}
+            statuses.append(make_tweet(status_id, text, 'text', None, user, None))
+
+    return statuses
+
+
+def make_toot(toot_id, text, kind, in_reply_to_id, account, media_url):
+    toot = {
+        'id': str(toot_id),
+        'uri': f'https://mastodon.example/users/bench/statuses/{toot_id}',
+        'url': f'https://mastodon.example/@bench/{toot_id}',
+        'account': account,
+        'content': f'<p>{text}</p>',
+        'visibility': 'public',
+        'spoiler_text': '',
+        'in_reply_to_id': str(in_reply_to_id) if in_reply_to_id else None,
+        'reblogged': False,
+        'reblog': None,
+        'media_attachments': [{'type': 'image', 'url': media_url}] if kind == 'media' else []
+    }
+
+    if kind == 'boost':
+        toot['reblogged'] = True
+        toot['reblog'] = dict(toot, id=str(toot_id + 10 ** 6), reblogged=False,
+                              account={'id': '1', 'username': 'someone', 'url': 'https://example.com/@someone'})
+    return toot
+
+
+def make_tweet(tweet_id, text, kind, in_reply_to_id, user, media_url):
+    tweet = {
+        'id': tweet_id,
+        'id_str': str(tweet_id),
+        'full_text': text,
+        'user': user,
+        'entities': {'user_mentions': [], 'urls': [], 'hashtags': []},
+        'in_reply_to_user_id': TW_ACCOUNT_ID if in_reply_to_id else None,
+        'in_reply_to_status_id': in_reply_to_id
+    }
+
+    if kind == 'media':
+        short_url = f'https://t.co/m{tweet_id}'
+        tweet['full_text'] = f'{text} {short_url}'
+        tweet['entities']['media'] = [{
+            'id': tweet_id, 'id_str': str(tweet_id), 'type': 'photo', 'media_url_https': media_url,
+            'url': short_url, 'display_url': f'pic.twitter.com/m{tweet_id}', 'expanded_url': media_url,
+            'indices': [len(text) + 1, len(text) + 1 + len(short_url)]
+        }]
+    elif kind == 'boost':
+        author = {'id': 1, 'id_str': '1', 'screen_name': 'someone'}
+        tweet['retweeted_status'] = dict(tweet, id=tweet_id + 10 ** 6, id_str=str(tweet_id + 10 ** 6), user=author)
+        tweet['full_text'] = f'RT @someone: {text}'
+
+    return tweet
+
+
+def run_crossposter(args):
+    """
+    Runs the crossposter against the fake servers, until terminated. Its peak
+    memory is written to args.rss_file on termination. Its state is stored in
+    args.state_dir.
+    """
+    from path import Path
+
+    from mtt import config, connections
+    from mtt.accounts import ACCOUNT_FILES, AccountPair
+
+    workdir = Path(args.state_dir)
+    config.update({
+        'FILES': dict(config.FILES, media_cache=workdir / 'mtt_media_cache.json'),
+        'LOG_LEVEL': 'INFO' if args.verbose else 'WARNING'
+    })
+
+    class LoopbackAdapter(connections.PooledHTTPAdapter):
+        # python-twitter does not allow to change the user stream URL
+        def send(self, request, **kwargs):
+            request.url = request.url.replace('https://userstream.twitter.com', args.twitter_url)
+            return super(LoopbackAdapter, self).send(request, **kwargs)
+
+    # Installed as the shared adapter, before any connection is made
+    connections._adapter = LoopbackAdapter(
+        connect_timeout=config.HTTP_CONNECT_TIMEOUT,
+        stream_read_timeout=config.STREAM_STALL_TIMEOUT,
+        rate_limiter=connections.RateLimiter(max_wait=config.RATE_LIMIT_MAX_WAIT),
+        pool_connections=config.HTTP_POOL_HOSTS,
+        pool_maxsize=config.HTTP_POOL_SIZE
+    )
+
+    pair = AccountPair(None, files={key: workdir / config.FILES[key].name for key in ACCOUNT_FILES},
+                       post_on_twitter=args.crossposter == 'm2t', post_on_mastodon=args.crossposter == 't2m')
+    pair.connect(
+        mastodon_settings=dict(access_token='bench', api_base_url=args.mastodon_url, ratelimit_method='throw'),
+        twitter_settings=dict(consumer_key='bench', consumer_secret='bench', access_token_key='bench',
+                              access_token_secret='bench', tweet_mode='extended', base_url=f'{args.twitter_url}/1.1',
+                              upload_url=f'{args.twitter_url}/1.1')
+    )
+    publishers = pair.create_publishers()
+
+    def terminate(signum, frame):
+        with open(args.rss_file, 'w') as f:
+            # Kilobytes on Linux
+            f.write(str(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+        os._exit(0)
+
+    signal.signal(signal.SIGTERM, terminate)
+
+    if args.engine == 'async':
+        from mtt.async_engine import AsyncEngine
+        AsyncEngine(publishers, max_concurrency=config.ASYNC_MAX_CONCURRENCY).run()
+    else:
+        for publisher in publishers:
+            publisher.start()
+        for publisher in publishers:
+            publisher.join()
+
+
+def run_direction(direction, args, mix):
+    """
+    Replays the workload in a direction.
+    :return: A dict with the results.
+    """
+    mastodon = FakeMastodon(args.api_latency, args.media_size)
+    twitter = FakeTwitter(args.api_latency, args.media_size)
+    mastodon.start()
+    twitter.start()
+    source, destination = (mastodon, twitter) if direction == 'm2t' else (twitter, mastodon)
+
+    workdir = tempfile.mkdtemp(prefix='mtt-loadtest-')
+    state_dir = os.path.join(workdir, 'state')
+    os.mkdir(state_dir)
+    rss_file = os.path.join(workdir, 'rss')
+    log_file = os.path.join(workdir, 'crossposter.log')
+
+    command = [sys.executable, '-m', 'benchmarks.loadtest', '--crossposter', direction,
+               '--mastodon-url', mastodon.url, '--twitter-url', twitter.url,
+               '--engine', args.engine, '--rss-file', rss_file, '--state-dir', state_dir]
+    if args.verbose:
+        command.append('--verbose')
+
+    def start_crossposter():
+        subscriptions = source.subscriptions
+        # Appended to, to keep the log of the killed process
+        with open(log_file, 'a') as log:
+            started = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT)
+        if not source.wait_for_subscriber(timeout=30, after=subscriptions):
+            started.kill()
+            raise RuntimeError(f'The crossposter did not open the stream, see {log_file}')
+        return started
+
+    workload = make_workload(direction, args.count, mix, args.seed, source)
+    foreign = make_foreign_statuses(direction, args.count * args.foreign, args.seed)
+
+    def emit(first, last):
+        """
+        Emits the statuses of the workload from index first to last (excluded), at the target rate.
+        """
+        segment_start = time.time()
+        for i in range(first, last):
+            time.sleep(max(0.0, segment_start + (i - first) / args.rate - time.time()))
+            marker, status = workload[i]
+            source.emit(marker, status)
+            for other in foreign[i * args.foreign:(i + 1) * args.foreign]:
+                source.emit(None, other)
+
+    process = start_crossposter()
+    try:
+        start = time.time()
+
+        if args.restart:
+            # Killed with statuses in flight, then restarted with the same state
+            emit(0, len(workload) // 3)
+            process.kill()
+            process.wait(timeout=30)
+            emit(len(workload) // 3, 2 * len(workload) // 3)
+            process = start_crossposter()
+            emit(2 * len(workload) // 3, len(workload))
+        else:
+            emit(0, len(workload))
+
+        # Until everything is posted, or nothing progresses anymore
+        last_progress, done = time.time(), 0
+        while done < len(workload) and time.time() - last_progress < args.drain_timeout:
+            time.sleep(0.1)
+            with destination.lock:
+                if len(destination.completed) > done:
+                    done, last_progress = len(destination.completed), time.time()
+        # The last parts of the last statuses may still come
+        time.sleep(0.5)
+
+    finally:
+        process.send_signal(signal.SIGTERM)
+        process.wait(timeout=30)
+        mastodon.stop()
+        twitter.stop()
+
+    with destination.lock:
+        latencies = sorted(destination.completed[marker] - source.emitted[marker] for marker in destination.completed)
+        last_completion = max(destination.completed.values(), default=start)
+
+    try:
+        with open(rss_file) as f:
+            max_rss = int(f.read()) * 1024
+    except (OSError, ValueError):
+        max_rss = None
+
+    return {
+        'direction': direction,
+        'statuses': len(workload),
+        'completed': len(latencies),
+        'posts': destination.posts,
+        'duplicates': destination.duplicates,
+        'uploads': destination.uploads,
+        'p50': statistics.median(latencies) if latencies else None,
+        'p99': statistics.quantiles(latencies, n=100)[98] if len(latencies) > 1 else None,
+        'throughput': len(latencies) / (last_completion - start) if latencies else 0.0,
+        'max_rss': max_rss,
+        'log': log_file
+    }
+
+
+def parse_mix(mix):
+    weights = {}
+    for item in mix.split(','):
+        kind, _, weight = item.partition('=')
+        if kind not in ('text', 'thread', 'boost', 'media'):
+            raise argparse.ArgumentTypeError(f'Unknown kind of status "{kind}"')
+        weights[kind] = float(weight or 1)
+    return weights
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.loadtest', description=__doc__.split('\n\n')[0])
+    parser.add_argument('--direction', choices=('m2t', 't2m', 'both'), default='both')
+    parser.add_argument('--engine', choices=('threads', 'async'), default='threads')
+    parser.add_argument('--count', type=int, default=200, help='statuses per direction')
+    parser.add_argument('--rate', type=float, default=20, help='statuses emitted per second')
+    parser.add_argument('--mix', type=parse_mix, default='text=50,thread=20,boost=15,media=15',
+                        help='weights of the kinds of statuses (text, thread, boost, media)')
+    parser.add_argument('--foreign', type=int, default=0,
+                        help='statuses of other accounts sent on the stream after each status (home timeline)')
+    parser.add_argument('--media-size', type=int, default=200 * 1024, help='size of the medias (bytes)')
+    parser.add_argument('--api-latency', type=float, default=0.02, help='latency of the fake APIs (seconds)')
+    parser.add_argument('--drain-timeout', type=float, default=30,
+                        help='how long to wait for the crossposter to make progress (seconds)')
+    parser.add_argument('--restart', action='store_true',
+                        help='kill the crossposter after a third of the statuses, and restart it after two thirds')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--verbose', action='store_true', help='keep the crossposter info logs')
+    # Internal: runs the crossposter process
+    parser.add_argument('--crossposter', choices=('m2t', 't2m'), help=argparse.SUPPRESS)
+    parser.add_argument('--mastodon-url', help=argparse.SUPPRESS)
+    parser.add_argument('--twitter-url', help=argparse.SUPPRESS)
+    parser.add_argument('--rss-file', help=argparse.SUPPRESS)
+    parser.add_argument('--state-dir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.crossposter:
+        run_crossposter(args)
+        return
+
+    from mtt import config
+
+    mix = args.mix
+    directions = ('m2t', 't2m') if args.direction == 'both' else (args.direction,)
+
+    # Statuses in flight when the crossposter is killed, each may be posted again
+    if not args.restart:
+        max_duplicates = 0
+    elif args.engine == 'async':
+        max_duplicates = config.ASYNC_MAX_CONCURRENCY
+    else:
+        max_duplicates = config.PUBLISH_WORKERS
+    failed = False
+
+    print(f'{args.count} statuses per direction at {args.rate:g}/s ({", ".join(f"{k} {v:g}" for k, v in mix.items())}),'
+          f' {args.engine} engine, API latency {args.api_latency * 1000:.0f} ms'
+          f'{", restarted" if args.restart else ""}')
+    print(f'{"direction":>20} {"completed":>10} {"posts":>6} {"dups":>5} {"uploads":>8} {"p50 ms":>8} '
+          f'{"p99 ms":>8} {"status/s":>9} {"peak RSS":>9}')
+
+    for direction in directions:
+        result = run_direction(direction, args, mix)
+
+        def ms(value):
+            return f'{value * 1000:.0f}' if value is not None else '-'
+
+        print(f'{DIRECTIONS[direction]:>20} {result["completed"]:>4}/{result["statuses"]:<5} {result["posts"]:>6} '
+              f'{result["duplicates"]:>5} {result["uploads"]:>8} {ms(result["p50"]):>8} {ms(result["p99"]):>8} '
+              f'{result["throughput"]:>9.1f} {(result["max_rss"] or 0) / 2 ** 20:>7.0f}MB')
+
+        if result['completed'] < result['statuses']:
+            print(f'{"":>20} some statuses were not crossposted, see {result["log"]}')
+            failed = True
+        if result['duplicates'] > max_duplicates:
+            print(f'{"":>20} {result["duplicates"]} statuses were posted more than once, '
+                  f'{max_duplicates} expected at most, see {result["log"]}')
+            failed = True
+        elif result['duplicates']:
+            print(f'{"":>20} {result["duplicates"]} statuses were posted more than once, '
+                  f'in flight when killed ({max_duplicates} expected at most)')
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+"""
+Checks the status splitter against the previous implementation (which
+re-measured the whole current part for every word) on a generated corpus,
+and measures how both scale with the status length.
+
+Run from the project root:
+
+    python -m benchmarks.split_status
+"""
+import timeit
+import twitter
+
+from benchmarks.corpus import make_corpus, make_status
+from mtt import config
+from mtt.utils import calc_expected_status_length, re_hashtag_begin, re_hashtag_end, split_status
+
+
+# The previous implementation, kept as a reference (minus debug prints).
+def legacy_split_status(status, max_length, split=True, url=None, url_length=None):
+    """
+    Split toots, if need be, using Many magic numbers.
+
+    status:     The status text to split
+    max_length: The maximal length of each sub status
+    split:      If true (default), will split in multiple status; else,
+                will append the URL.
+    url:        If split=False, the URL to append.
+    url_length: The length of a Twitter URL (after some reduction).
+    """
+    content_parts = []
+
+    if not url_length:
+        url_length = 24
+
+    max_length -= 6
+
+    hashtags_begin = ''
+    hashtags_end = ''
+
+    if split and config.DISTRIBUTE_HASHTAGS_ON_TWITTER:
+        match = re_hashtag_begin.search(status)
+        if match:
+            hashtags_begin = match.group(1)
+            status = re_hashtag_begin.sub('', status).lstrip()
+        match = re_hashtag_end.search(status)
+        if match:
+            hashtags_end = match.group(1)
+            status = re_hashtag_end.sub('', status).rstrip()
+
+        # Ensures the hashtags will fit
+        while len(hashtags_begin) + len(hashtags_end) > max_length:
+            if hashtags_end:
+                hashtags_end = ' '.join(hashtags_end.split(' ')[:-1])
+            elif hashtags_begin:
+                hashtags_begin = ' '.join(hashtags_begin.split(' ')[:-1])
+            else:
+                break
+
+    hashtags_begin = (hashtags_begin.lstrip() + (' ' if not hashtags_begin.endswith('\n') else '')) if hashtags_begin else ''  # noqa: E501
+    hashtags_end = (' ' + hashtags_end.rstrip()) if hashtags_end else ''
+    hashtags_len = len(hashtags_begin) + len(hashtags_end)
+
+    if calc_expected_status_length(status, short_url_length=url_length) > max_length:
+        current_part = ''
+        for next_word in status.split(' '):
+            # Need to split here?
+            if calc_expected_status_length(current_part + ' ' + next_word, short_url_length=url_length) + len(hashtags_end) > max_length:  # noqa: E501
+                space_left = max_length - 5 - (calc_expected_status_length(current_part, short_url_length=url_length) + len(hashtags_end)) - 1  # noqa: E501
+
+                if split:
+                    # Want to split word?
+                    if len(next_word) > 30 and space_left > 5 and not twitter.twitter_utils.is_url(next_word):
+                        current_part = current_part + ' ' + next_word[:space_left] + hashtags_end
+                        content_parts.append(current_part)
+                        current_part = hashtags_begin + next_word[space_left:]
+                    else:
+                        content_parts.append(current_part + hashtags_end)
+                        current_part = hashtags_begin + next_word
+
+                    # Split potential overlong word in current_part
+                    while len(current_part) + hashtags_len > max_length - 5:
+                        content_parts.append(hashtags_begin + current_part[:max_length - 5 - hashtags_len] + hashtags_end)  # noqa: E501
+                        current_part = current_part[max_length - 5:]
+                else:
+                    space_for_suffix = len('… ') + url_length
+                    content_parts.append(current_part[:-space_for_suffix] + '… ' + url)
+                    current_part = ''
+                    break
+            else:
+                # Just plop next word on
+                current_part = current_part + ' ' + next_word
+
+        # Insert last part
+        if len(current_part.strip()) != 0 or len(content_parts) == 0:
+            content_parts.append(current_part.strip() + hashtags_end)
+
+    else:
+        content_parts.append(status)
+
+    parts = len(content_parts)
+    if split and parts > 1:
+        for i in range(parts):
+            content_parts[i] += f' — {i + 1}/{parts}'
+
+    return content_parts
+
+
+def check_golden_corpus():
+    corpus = make_corpus()
+    checked = 0
+
+    for distribute in (True, False):
+        config.config['DISTRIBUTE_HASHTAGS_ON_TWITTER'] = distribute
+        for status in corpus:
+            for split in (True, False):
+                for url_length in (None, 24):
+                    kwargs = dict(status=status, max_length=280, split=split, url='https://example.com/@u/1',
+                                  url_length=url_length)
+                    expected = legacy_split_status(**kwargs)
+                    actual = split_status(**kwargs)
+                    if expected != actual:
+                        raise AssertionError(f'Different output for {kwargs}:\n{expected}\n{actual}')
+                    checked += 1
+
+    config.config['DISTRIBUTE_HASHTAGS_ON_TWITTER'] = True
+    print(f'Identical output on {checked} golden cases.')
+
+
+def benchmark():
+    print(f'{"length":>8} {"legacy (ms)":>12} {"new (ms)":>12} {"speedup":>8}')
+    for length in (500, 1000, 2000, 5000, 10000):
+        status = make_status(length, seed=length)
+        number = 3
+        legacy = timeit.timeit(lambda: legacy_split_status(status, 280), number=number) / number * 1000
+        new = timeit.timeit(lambda: split_status(status, 280), number=number) / number * 1000
+        print(f'{length:>8} {legacy:>12.1f} {new:>12.1f} {legacy / new:>7.1f}x')
+
+
+if __name__ == '__main__':
+    check_golden_corpus()
+    benchmark()
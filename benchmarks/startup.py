@@ -0,0 +1,155 @@
+"""
+Measures the cold start of the crossposter: the time from the process
+spawn to its first network request, and what is imported before it (as
+reported by python -X importtime, grouped by top-level package).
+
+The crossposter is started with placeholder credentials; the first request
+is intercepted (and the process ended) before anything is sent. It is
+measured with an empty platform metadata cache (the first request is then
+a credentials verification) and with a cached one (a timeline fetch). The
+bare interpreter start is measured too, for reference.
+
+Run from the project root:
+
+    python -m benchmarks.startup
+    python -m benchmarks.startup --runs 10
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from path import Path
+
+
+FAKE_URL = 'http://127.0.0.1:9'
+
+METADATA = {
+    'mastodon_account': {'id': 1, 'username': 'bench', 'acct': 'bench', 'url': f'{FAKE_URL}/@bench'},
+    'twitter_account': {'id': 2, 'screen_name': 'bench'},
+    'mastodon_instance': {'uri': '127.0.0.1', 'version': '4.2.0'},
+    'twitter_configuration': {'short_url_length': 23, 'short_url_length_https': 23,
+                              'characters_reserved_per_media': 24, 'photo_size_limit': 3145728}
+}
+
+
+def write_state(workdir, cached):
+    """
+    Writes placeholder credentials (and the platform metadata cache if `cached`) to workdir.
+    """
+    from mtt.accounts import ACCOUNT_FILES
+    from mtt import config
+
+    files = {key: workdir / config.FILES[key].name for key in ACCOUNT_FILES}
+    files['credentials_twitter'].write_text('key\nsecret\ntoken\ntoken secret\n')
+    files['credentials_mastodon_server'].write_text(f'{FAKE_URL}\n')
+    files['credentials_mastodon_client'].write_text(f'client id\nclient secret\n{FAKE_URL}\n')
+    files['credentials_mastodon_user'].write_text(f'access token\n{FAKE_URL}\n')
+
+    if cached:
+        files['platform_metadata'].write_text(json.dumps({key: [value, time.time()]
+                                                          for key, value in METADATA.items()}))
+
+
+def run_crossposter(args):
+    """
+    Runs the crossposter until its first request; prints the elapsed time since the spawn (JSON).
+    """
+    from mtt import config
+
+    workdir = Path(args.workdir)
+    config.update({
+        'FILES': {key: workdir / path.name for key, path in config.FILES.items()},
+        'LOG_LEVEL': 'WARNING'
+    })
+
+    # Needed before any request anyway
+    from mtt import connections
+
+    # Several threads may send their first request at the same time
+    first = threading.Lock()
+
+    def first_request(adapter, request, **kwargs):
+        elapsed = time.time() - args.spawned_at
+        with first:
+            print(json.dumps({'elapsed': elapsed, 'url': request.url}), flush=True)
+            os._exit(0)
+
+    connections.PooledHTTPAdapter.send = first_request
+
+    from mtt.__main__ import main
+    main([])
+
+
+def spawn(arguments, importtime=False):
+    """
+    :return: The parsed JSON output of a child process, and its standard error.
+    """
+    command = [sys.executable] + (['-X', 'importtime'] if importtime else []) + arguments + [str(time.time())]
+    process = subprocess.run(command, capture_output=True, text=True, timeout=60)
+
+    for line in reversed(process.stdout.splitlines()):
+        if line.startswith('{'):
+            return json.loads(line), process.stderr
+
+    raise RuntimeError(f'The child process failed:\n{process.stdout}\n{process.stderr}')
+
+
+def imports_by_package(stderr):
+    """
+    :return: A dict mapping the top-level packages to their import time (seconds, own time of their modules).
+    """
+    packages = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        own, _, name = line[len('import time:'):].split('|')
+        package = name.strip().split('.')[0]
+        packages[package] = packages.get(package, 0) + int(own) / 1e6
+    return packages
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measures the time from the process start to the first request.')
+    parser.add_argument('--runs', type=int, default=5, help='runs per scenario (the median is reported)')
+    parser.add_argument('--top', type=int, default=10, help='packages to list in the imports breakdown')
+    parser.add_argument('--crossposter', metavar='WORKDIR', help=argparse.SUPPRESS)
+    parser.add_argument('spawned_at', type=float, nargs='?', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.crossposter:
+        args.workdir = args.crossposter
+        run_crossposter(args)
+        return
+
+    interpreter = [spawn(['-c', 'import json, sys, time; '
+                                'print(json.dumps({"elapsed": time.time() - float(sys.argv[1])}))'])[0]['elapsed']
+                   for _ in range(args.runs)]
+    print(f'{"scenario":<28} {"first request":>14}  request')
+    print(f'{"interpreter alone":<28} {statistics.median(interpreter) * 1000:>11.0f} ms')
+
+    for name, cached in (('empty metadata cache', False), ('cached metadata', True)):
+        with tempfile.TemporaryDirectory(prefix='mtt-startup-') as workdir:
+            write_state(Path(workdir), cached)
+            # The first run writes the state files (associations store...); not measured
+            spawn(['-m', 'benchmarks.startup', '--crossposter', workdir])
+
+            results = [spawn(['-m', 'benchmarks.startup', '--crossposter', workdir])[0] for _ in range(args.runs)]
+            elapsed = statistics.median(result['elapsed'] for result in results)
+            print(f'{name:<28} {elapsed * 1000:>11.0f} ms  {results[0]["url"].split("?")[0]}')
+
+            _, stderr = spawn(['-m', 'benchmarks.startup', '--crossposter', workdir], importtime=True)
+
+    packages = imports_by_package(stderr)
+    print(f'\nImported before the first request (cached metadata): {sum(packages.values()) * 1000:.0f} ms')
+    for package, duration in sorted(packages.items(), key=lambda item: -item[1])[:args.top]:
+        print(f'  {package:<26} {duration * 1000:>6.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+"""
+Micro-benchmarks of the text pipeline hot paths: status splitting, length
+calculation, URL scanning, content warnings and hashtags regexps, toots
+HTML conversion and tweets text conversion.
+
+Each benchmark runs a function over a set of statuses of the generated
+corpus (see benchmarks.corpus.make_text_corpus) and reports the statuses
+processed per second and the memory allocated per status (peak, measured
+with tracemalloc). Results are compared with a stored baseline; a
+benchmark slower (or allocating more) than the baseline by more than the
+threshold is reported as a regression, and the command fails.
+
+Timings depend on the machine: save a baseline on the machine used to
+compare (e.g. before starting some work, or on the release machine).
+
+Run from the project root:
+
+    python -m benchmarks.text                # Compares with the baseline
+    python -m benchmarks.text --save         # Stores a new baseline
+    python -m benchmarks.text --filter split --threshold 0.1
+"""
+import argparse
+import json
+import platform
+import sys
+import timeit
+import tracemalloc
+
+from pathlib import Path
+
+from benchmarks.corpus import INSTANCE_URL, make_text_corpus, make_toot_html
+from mtt import config
+from mtt.converters import TootConverter, TweetConverter
+from mtt.twitter_to_mastodon import MastodonPublisher
+from mtt.urls import find_urls
+from mtt.utils import calc_expected_status_length, re_hashtag_begin, re_hashtag_end, split_status
+
+
+BASELINE_PATH = Path(__file__).parent / 'data' / 'text_baseline.json'
+TWEETS_PATH = Path(__file__).parent / 'data' / 'tweets.json'
+
+
+def get_benchmarks():
+    """
+    :return: A dict of benchmark name -> (function called with a status, list of statuses).
+    """
+    corpus = make_text_corpus()
+    statuses = [status for statuses in corpus.values() for status in statuses]
+
+    toots = [make_toot_html(paragraphs, seed) for paragraphs in (1, 3, 10) for seed in range(10)]
+    toot_converter = TootConverter(INSTANCE_URL)
+
+    with TWEETS_PATH.open() as f:
+        tweets = [(MastodonPublisher._get_tweet_full_text(tweet),
+                   MastodonPublisher._get_tweet_entities(tweet, 'user_mentions'),
+                   MastodonPublisher._get_tweet_entities(tweet, 'urls'),
+                   MastodonPublisher._get_tweet_entities(tweet, 'media')) for tweet in json.load(f)]
+    tweet_converter = TweetConverter(
+        cw_regexp=config.TWEET_CW_REGEXP,
+        cw_allow_multi=config.TWEET_CW_ALLOW_MULTI,
+        cw_separator=config.TWEET_CW_SEPARATOR
+    )
+
+    benchmarks = {}
+
+    for name in ('short', 'thread', 'urls', 'hashtags', 'cw', 'emoji'):
+        benchmarks[f'split_status/{name}'] = (lambda status: split_status(status, 280), corpus[name])
+
+    benchmarks['split_status/no_split'] = (
+        lambda status: split_status(status, 280, split=False, url='https://mastodon.example/@u/1'), corpus['thread']
+    )
+    benchmarks['calc_expected_status_length'] = (calc_expected_status_length, statuses)
+    benchmarks['find_urls'] = (find_urls, statuses)
+    benchmarks['cw_regexp'] = (config.TWEET_CW_REGEXP.findall, corpus['cw'] + corpus['short'])
+    benchmarks['hashtag_regexps'] = (
+        lambda status: (re_hashtag_begin.search(status), re_hashtag_end.search(status)), corpus['hashtags']
+    )
+    benchmarks['toot_html'] = (toot_converter.convert, toots)
+    benchmarks['tweet_text'] = (
+        lambda tweet: tweet_converter.convert(tweet[0], mentions=tweet[1], urls=tweet[2], medias=tweet[3]), tweets
+    )
+
+    return benchmarks
+
+
+def measure_speed(function, inputs, min_time=0.2, repeat=7):
+    """
+    :return: The inputs processed per second (best of `repeat` runs of at least `min_time` seconds).
+    """
+    def run():
+        for item in inputs:
+            function(item)
+
+    timer = timeit.Timer(run)
+    number, _ = timer.autorange()
+    number = max(1, int(number * min_time / 0.2))
+    return number * len(inputs) / min(timer.repeat(repeat=repeat, number=number))
+
+
+def measure_allocations(function, inputs):
+    """
+    :return: The mean memory allocated while processing an input, at peak (bytes).
+    """
+    total = 0
+    tracemalloc.start()
+    try:
+        for item in inputs:
+            tracemalloc.reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+            function(item)
+            _, peak = tracemalloc.get_traced_memory()
+            total += peak - before
+    finally:
+        tracemalloc.stop()
+
+    return total / len(inputs)
+
+
+def run(benchmarks, min_time):
+    results = {}
+    for name, (function, inputs) in benchmarks.items():
+        # Warms up the caches (compiled regexps...), which are not measured
+        function(inputs[0])
+        results[name] = {
+            'ops': round(measure_speed(function, inputs, min_time=min_time), 1),
+            'alloc': round(measure_allocations(function, inputs))
+        }
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Prints the results next to the baseline ones.
+    :return: The names of the benchmarks which regressed.
+    """
+    regressions = []
+
+    print(f'{"benchmark":<32} {"ops/s":>12} {"baseline":>12} {"change":>8} {"B/op":>10} {"baseline":>10}')
+    for name, result in results.items():
+        reference = baseline.get(name)
+        if reference is None:
+            print(f'{name:<32} {result["ops"]:>12.0f} {"-":>12} {"-":>8} {result["alloc"]:>10} {"-":>10}')
+            continue
+
+        change = result['ops'] / reference['ops'] - 1
+        slower = change < -threshold
+        heavier = result['alloc'] > reference['alloc'] * (1 + threshold) + 64
+        if slower or heavier:
+            regressions.append(name)
+
+        print(f'{name:<32} {result["ops"]:>12.0f} {reference["ops"]:>12.0f} {change:>+8.0%} '
+              f'{result["alloc"]:>10} {reference["alloc"]:>10}'
+              f'{"  SLOWER" if slower else ""}{"  HEAVIER" if heavier else ""}')
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro-benchmarks of the text pipeline.')
+    parser.add_argument('--save', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--baseline', type=Path, default=BASELINE_PATH, help='the baseline file')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='relative slowdown (or allocations increase) reported as a regression (default: 0.25)')
+    parser.add_argument('--filter', default='', help='only run the benchmarks whose name contains this')
+    parser.add_argument('--min-time', type=float, default=0.2, help='minimal duration of a timing run (seconds)')
+    args = parser.parse_args()
+
+    benchmarks = {name: benchmark for name, benchmark in get_benchmarks().items() if args.filter in name}
+    results = run(benchmarks, args.min_time)
+
+    if args.save:
+        compare(results, {}, args.threshold)
+
+        baseline = {}
+        if args.filter and args.baseline.exists():
+            with args.baseline.open() as f:
+                baseline = json.load(f)['results']
+        baseline.update(results)
+
+        with args.baseline.open('w') as f:
+            json.dump({'python': platform.python_version(), 'machine': platform.machine(), 'results': baseline},
+                      f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f'Baseline saved to {args.baseline}.')
+        return
+
+    if not args.baseline.exists():
+        compare(results, {}, args.threshold)
+        print(f'No baseline at {args.baseline}; run with --save to store one.')
+        return
+
+    with args.baseline.open() as f:
+        baseline = json.load(f)
+
+    if baseline['python'] != platform.python_version():
+        print(f'Note: the baseline was measured with Python {baseline["python"]}.')
+
+    regressions = compare(results, baseline['results'], args.threshold)
+    if regressions:
+        print(f'{len(regressions)} regression(s): {", ".join(regressions)}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
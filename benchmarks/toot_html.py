@@ -0,0 +1,52 @@
+"""
+Compares the toot HTML converter with the previous chain of regexp passes:
+output on generated toots, and throughput.
+
+Run from the project root:
+
+    python -m benchmarks.toot_html
+"""
+import html
+import re
+import timeit
+
+from benchmarks.corpus import INSTANCE_URL, make_toot_html
+from mtt.converters import TootConverter
+
+
+MEDIA_REGEXP = re.compile(re.escape(INSTANCE_URL.rstrip("/")) + r"\/media\/(\w)+(\s|$)+")
+
+
+# The previous implementation, kept as a reference.
+def legacy_convert(content):
+    content_clean = re.sub(r'<a [^>]*href="([^"]+)">[^<]*</a>', r'\g<1>', content)
+    content_clean = "\n".join(re.compile(r'<br ?/?>', re.IGNORECASE).split(content_clean))
+    content_clean = "\n\n".join(re.compile(r'</p><p>', re.IGNORECASE).split(content_clean))
+    content_clean = html.unescape(str(re.compile(r'<.*?>').sub("", content_clean).strip()))
+    return re.sub(MEDIA_REGEXP, "", content_clean)
+
+
+def check_corpus(converter):
+    toots = [make_toot_html(paragraphs, seed) for paragraphs in (1, 2, 5) for seed in range(200)]
+    for toot in toots:
+        if converter.convert(toot) != legacy_convert(toot):
+            raise AssertionError(f'Different output for {toot!r}')
+    print(f'Identical output on {len(toots)} toots.')
+
+
+def benchmark(converter):
+    print(f'{"paragraphs":>10} {"legacy (toots/s)":>17} {"new (toots/s)":>14} {"speedup":>8}')
+    for paragraphs in (1, 3, 10):
+        toots = [make_toot_html(paragraphs, seed) for seed in range(50)]
+        number = 10
+        legacy = number * len(toots) / min(timeit.repeat(lambda: [legacy_convert(toot) for toot in toots],
+                                                         number=number, repeat=5))
+        new = number * len(toots) / min(timeit.repeat(lambda: [converter.convert(toot) for toot in toots],
+                                                      number=number, repeat=5))
+        print(f'{paragraphs:>10} {legacy:>17.0f} {new:>14.0f} {new / legacy:>7.1f}x')
+
+
+if __name__ == '__main__':
+    converter = TootConverter(INSTANCE_URL)
+    check_corpus(converter)
+    benchmark(converter)
@@ -0,0 +1,155 @@
+"""
+Compares the entities-driven tweet rewriting with the previous one (a
+re.sub over the whole text for each mention, URL and media) on recorded
+tweets, and measures both.
+
+Differences are expected where the previous rewriting was wrong: mentions
+prefixing other mentions (@someone / @someone_else), URLs of extended
+tweets left shortened (entities were taken from the truncated tweet), and
+whitespace left when a media link followed a content warning. Entities
+prefixing longer mentions or URLs are also checked, with and without
+indices matching the text.
+
+Run from the project root:
+
+    python -m benchmarks.tweet_text
+"""
+import html
+import json
+import re
+import timeit
+
+from pathlib import Path
+
+from mtt import config
+from mtt.converters import TweetConverter
+from mtt.twitter_to_mastodon import MastodonPublisher
+
+
+TWEETS_PATH = Path(__file__).parent / 'data' / 'tweets.json'
+
+
+# The previous implementation, kept as a reference.
+def legacy_convert(tweet):
+    content = MastodonPublisher._get_tweet_full_text(tweet)
+
+    if 'retweeted_status' in tweet:
+        rt = tweet['retweeted_status']
+        rt_content = MastodonPublisher._get_tweet_full_text(rt)
+
+        content = f'\U0001f501 RT @{rt["user"]["screen_name"]}\n\n' \
+                  f'{rt_content}\n\n' \
+                  f'https://twitter.com/{rt["user"]["screen_name"]}/status/{rt["id_str"]}'
+
+        tweet = rt
+
+    media_attachments = (tweet['media'] if 'media' in tweet
+                         else tweet['entities']['media'] if 'entities' in tweet and 'media' in tweet['entities']
+                         else tweet['extended_tweet']['entities']['media']
+                             if 'extended_tweet' in tweet and 'entities' in tweet['extended_tweet']
+                             and 'media' in tweet['extended_tweet']['entities']
+                         else [])
+
+    urls = (tweet['urls'] if 'urls' in tweet
+            else tweet['entities']['urls'] if 'entities' in tweet and 'urls' in tweet['entities']
+            else tweet['extended_tweet']['entities']['urls']
+                if 'extended_tweet' in tweet and 'entities' in tweet['extended_tweet']
+                and 'urls' in tweet['extended_tweet']['entities']
+            else [])
+
+    content_toot = html.unescape(content)
+    mentions = re.findall(r'@[a-zA-Z0-9_]*', content_toot)
+    cws = config.TWEET_CW_REGEXP.findall(content) if config.TWEET_CW_REGEXP else []
+    warning = None
+
+    for mention in mentions:
+        content_toot = re.sub(mention, mention + '@twitter.com', content_toot)
+
+    for url in urls:
+        content_toot = re.sub(url['url'], url['expanded_url'], content_toot)
+
+    if cws:
+        warning = (config.TWEET_CW_SEPARATOR.join([cw.strip() for cw in cws]) if config.TWEET_CW_ALLOW_MULTI
+                   else cws[0].strip())
+        content_toot = config.TWEET_CW_REGEXP.sub('', content_toot, count=(0 if config.TWEET_CW_ALLOW_MULTI
+                                                                           else 1)).strip()
+
+    for attachment in media_attachments:
+        content_toot = re.sub(attachment['url'], '', content_toot)
+
+    return content_toot, warning
+
+
+# Same as MastodonPublisher.run
+def convert(converter, tweet):
+    content_prefix = ''
+    content_suffix = ''
+
+    if 'retweeted_status' in tweet:
+        rt = tweet['retweeted_status']
+        content_prefix = f'\U0001f501 RT @{rt["user"]["screen_name"]}@twitter.com\n\n'
+        content_suffix = f'\n\nhttps://twitter.com/{rt["user"]["screen_name"]}/status/{rt["id_str"]}'
+        tweet = rt
+
+    content_toot, warning = converter.convert(
+        MastodonPublisher._get_tweet_full_text(tweet),
+        mentions=MastodonPublisher._get_tweet_entities(tweet, 'user_mentions'),
+        urls=MastodonPublisher._get_tweet_entities(tweet, 'urls'),
+        medias=MastodonPublisher._get_tweet_entities(tweet, 'media')
+    )
+
+    return content_prefix + content_toot + content_suffix, warning
+
+
+def compare(converter, tweets):
+    differences = 0
+    for tweet in tweets:
+        expected = legacy_convert(tweet)
+        actual = convert(converter, tweet)
+        if expected != actual:
+            differences += 1
+            print(f'Tweet {tweet["id"]} differs:\n  legacy: {expected!r}\n  new:    {actual!r}')
+    print(f'{len(tweets) - differences}/{len(tweets)} tweets converted identically.')
+
+
+def check_overlapping_entities(converter):
+    """
+    Entities are not rewritten inside longer mentions or URLs, whether located by their indices or searched
+    (when they have no indices matching the text).
+    """
+    cases = [
+        ('@bobby and @bob', [{'screen_name': 'bob'}], [], '@bobby and @bob@twitter.com'),
+        ('@bob_smith, @Bob!', [{'screen_name': 'bob', 'indices': [0, 4]}], [], '@bob_smith, @Bob@twitter.com!'),
+        ('mail@bob.com @bob', [{'screen_name': 'bob'}], [], 'mail@bob.com @bob@twitter.com'),
+        ('https://t.co/abcd https://t.co/abc', [], [{'url': 'https://t.co/abc', 'expanded_url': 'https://example.com'}],
+         'https://t.co/abcd https://example.com')
+    ]
+
+    for text, mentions, urls, expected in cases:
+        actual, _ = converter.convert(text, mentions=mentions, urls=urls)
+        if actual != expected:
+            raise AssertionError(f'{text!r} converted to {actual!r}, expected {expected!r}')
+    print(f'{len(cases)} overlapping entities located correctly.')
+
+
+def benchmark(converter, tweets):
+    number = 2000
+    legacy = min(timeit.repeat(lambda: [legacy_convert(tweet) for tweet in tweets], number=number, repeat=3))
+    new = min(timeit.repeat(lambda: [convert(converter, tweet) for tweet in tweets], number=number, repeat=3))
+    count = number * len(tweets)
+    print(f'Legacy: {count / legacy:.0f} tweets/s, new: {count / new:.0f} tweets/s ({legacy / new:.1f}x)')
+
+
+if __name__ == '__main__':
+    with TWEETS_PATH.open() as f:
+        tweets = json.load(f)
+
+    converter = TweetConverter(
+        cw_regexp=config.TWEET_CW_REGEXP,
+        cw_allow_multi=config.TWEET_CW_ALLOW_MULTI,
+        cw_separator=config.TWEET_CW_SEPARATOR
+    )
+
+    compare(converter, tweets)
+    check_overlapping_entities(converter)
+    benchmark(converter, tweets)
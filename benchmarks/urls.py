@@ -0,0 +1,70 @@
+"""
+Compares the URL scanner with the previous URL regexp (a single
+alternation of all the top-level domains): compilation time, scanning
+time, and results on a generated corpus.
+
+Run from the project root:
+
+    python -m benchmarks.urls
+"""
+import re
+import timeit
+
+from twitter.twitter_utils import TLDS
+
+from benchmarks.corpus import make_corpus, make_status
+from mtt import urls
+
+
+def compile_legacy_regexp():
+    return re.compile((
+        r'('
+        r'(?!(https?://|www\.)?\.|ftps?://|([0-9]+\.){{1,3}}\d+)'  # exclude urls that start with "."
+        r'(?:https?://|www\.)*(?!.*@)(?:[\w+-_]+[.])'              # beginning of url
+        r'(?:{0}\b|'                                               # all tlds
+        r'(?:[:0-9]))'                                             # port numbers & close off TLDs
+        r'(?:[\w+\/]?[a-z0-9!\*\'\(\);:&=\+\$/%#\[\]\-_\.,~?])*'   # path/query params
+        r')').format(r'\b|'.join(TLDS)), re.U | re.I | re.X)
+
+
+def compile_regexp():
+    # The patterns are compiled for the TLDs of each word scanned
+    urls._get_regexp.cache_clear()
+    return urls.find_urls(make_status(280, seed=280, url_ratio=0.1))
+
+
+def compile_time(compile_function, number=5):
+    def compile_uncached():
+        re.purge()
+        compile_function()
+
+    return timeit.timeit(compile_uncached, number=number) / number * 1000
+
+
+def check_corpus(legacy_regexp):
+    corpus = make_corpus()
+    for status in corpus:
+        expected = [match[0] for match in legacy_regexp.findall(status)]
+        if urls.find_urls(status) != expected:
+            raise AssertionError(f'Different URLs found in {status!r}')
+    print(f'Identical URLs found in {len(corpus)} statuses.')
+
+
+def benchmark(legacy_regexp):
+    print(f'Compilation: legacy {compile_time(compile_legacy_regexp):.1f} ms, '
+          f'new {compile_time(compile_regexp):.1f} ms (first scan of a status, compiling for its TLDs)')
+
+    print(f'{"length":>8} {"legacy (ms)":>12} {"new (ms)":>12} {"speedup":>8}')
+    for length in (280, 1000, 5000):
+        for url_ratio in (0.0, 0.1, 0.5):
+            status = make_status(length, seed=length, url_ratio=url_ratio)
+            number = 20
+            legacy = timeit.timeit(lambda: legacy_regexp.findall(status), number=number) / number * 1000
+            new = timeit.timeit(lambda: urls.find_urls(status), number=number) / number * 1000
+            print(f'{length:>8} {legacy:>12.2f} {new:>12.2f} {legacy / new:>7.1f}x   ({url_ratio:.0%} URLs)')
+
+
+if __name__ == '__main__':
+    legacy_regexp = compile_legacy_regexp()
+    check_corpus(legacy_regexp)
+    benchmark(legacy_regexp)
@@ -1,122 +1,108 @@
-import json
-import twitter
+import argparse
+import signal
 
-from mastodon import Mastodon
+from concurrent.futures import ThreadPoolExecutor
 
 from mtt import config
 
-from mtt.credentials import check_credentials, setup_credentials
-from mtt.mastodon_to_twitter import TwitterPublisher
-from mtt.twitter_to_mastodon import MastodonPublisher
-from mtt.utils import lgt
-
-
-#
-# First step: check credentials
-#
-
-if not check_credentials():
-    setup_credentials()
-
-lgt('Everything looks good; starting…')
-
-
-#
-# Read in credentials
-#
-
-with config.FILES['credentials_twitter'].open('r') as secret_file:
-    TWITTER_CONSUMER_KEY = secret_file.readline().rstrip()
-    TWITTER_CONSUMER_SECRET = secret_file.readline().rstrip()
-    TWITTER_ACCESS_KEY = secret_file.readline().rstrip()
-    TWITTER_ACCESS_SECRET = secret_file.readline().rstrip()
-
-with config.FILES['credentials_mastodon_server'].open('r') as secret_file:
-    MASTODON_BASE_URL = secret_file.readline().rstrip()
-
-
-#
-# Log in
-#
-
-mastodon_api = Mastodon(
-    client_id=config.FILES['credentials_mastodon_client'],
-    access_token=config.FILES['credentials_mastodon_user'],
-    ratelimit_method='wait',
-    api_base_url=MASTODON_BASE_URL
-)
-twitter_api = twitter.Api(
-    consumer_key=TWITTER_CONSUMER_KEY,
-    consumer_secret=TWITTER_CONSUMER_SECRET,
-    access_token_key=TWITTER_ACCESS_KEY,
-    access_token_secret=TWITTER_ACCESS_SECRET,
-    tweet_mode='extended'  # Allows tweets longer than 140/280 raw characters
-)
-
-ma_account_id = mastodon_api.account_verify_credentials()["id"]
-tw_account_id = twitter_api.VerifyCredentials().id
-
-#
-# Tweets / toots association
-#
-
-# Loads tweets/toots associations to be able to mirror threads
-# This links the toots and tweets. For links from Mastodon to
-# Twitter, the toot listed is the last one of the generated thread
-# if the toot is too long to fit into a single tweet.
-status_associations = {'m2t': {}, 't2m': {}}
-try:
-    with open('mtt_status_associations.json', 'r') as f:
-        status_associations['m2t'] = json.load(f, object_hook=lambda d: {int(k): v for k, v in d.items()})
-        status_associations['t2m'] = {tweet_id: toot_id for toot_id, tweet_id in status_associations['m2t'].items()}
-except IOError:
-    pass
-
-
-#
-# Sent toots/tweets list
-#
-
-# To avoid bouncing toots or tweets, we keep the ID of the status we sent to
-# avoid re-sending them indefinitely.
-# Unlike status_associations, this contains _every_ status sent including
-# intermediate tweets if toots are too long.
-sent_status = {'toots': [], 'tweets': []}
-
-
-#
-# Startup
-#
-
-if config.POST_ON_TWITTER:
-    twitter_publisher = TwitterPublisher(
-        name='Mastodon -> Twitter',
-        mastodon_api=mastodon_api,
-        twitter_api=twitter_api,
-        ma_account_id=ma_account_id,
-        tw_account_id=tw_account_id,
-        status_associations=status_associations,
-        sent_status=sent_status
-    )
-
-    twitter_publisher.start()
-
-if config.POST_ON_MASTODON:
-    mastodon_publisher = MastodonPublisher(
-        name='Twitter -> Mastodon',
-        mastodon_api=mastodon_api,
-        twitter_api=twitter_api,
-        ma_account_id=ma_account_id,
-        tw_account_id=tw_account_id,
-        status_associations=status_associations,
-        sent_status=sent_status
-    )
-
-    mastodon_publisher.start()
-
-
-if config.POST_ON_TWITTER:
-    twitter_publisher.join()
-
-if config.POST_ON_MASTODON:
-    mastodon_publisher.join()
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(prog='python -m mtt', description='Crossposts between Mastodon and Twitter.')
+    parser.add_argument('--engine', choices=('threads', 'async'), default='threads',
+                        help='threads: one blocking thread per direction (default); '
+                             'async: statuses are crossposted concurrently by an asyncio event loop')
+    return parser.parse_args(args)
+
+
+def _stop(signum, frame):
+    raise SystemExit(0)
+
+
+def main(args=None):
+    """
+    Runs the crossposter until it is stopped (Ctrl+C or SIGTERM).
+    :param args: The command line arguments (defaults to sys.argv).
+    """
+    args = parse_args(args)
+
+    # The publishers (and the API clients) are only imported now, so
+    # importing this module or parsing the arguments stays quick.
+    from mtt.accounts import AccountPair, get_account_pairs
+    from mtt.credentials import check_credentials
+    from mtt.utils import lgt
+
+    #
+    # First step: check credentials
+    #
+
+    account_pairs = get_account_pairs()
+
+    for account_pair in account_pairs:
+        if not check_credentials(account_pair.files):
+            from mtt.credentials import setup_credentials
+            setup_credentials(account_pair.files, name=account_pair.name)
+
+    lgt('Everything looks good; starting…')
+
+    #
+    # Log in and load each account pair state
+    #
+
+    # Each pair has its own credentials, tweets/toots associations and sent
+    # statuses; connections and worker pools are shared by all pairs.
+    # Pairs are loaded concurrently.
+    with ThreadPoolExecutor(max_workers=len(account_pairs), thread_name_prefix='Loading') as executor:
+        list(executor.map(AccountPair.load, account_pairs))
+
+    publishers = []
+
+    for account_pair in account_pairs:
+        publishers.extend(account_pair.create_publishers())
+
+    #
+    # Metrics
+    #
+
+    if config.METRICS_PORT or config.METRICS_FILE:
+        from mtt import metrics
+        metrics.watch(account_pairs, publishers)
+
+        if config.METRICS_PORT:
+            metrics.serve_metrics(config.METRICS_HOST, config.METRICS_PORT)
+            lgt('Serving metrics at http://%s:%s/metrics', config.METRICS_HOST, config.METRICS_PORT)
+
+        if config.METRICS_FILE:
+            metrics.write_metrics_periodically(config.METRICS_FILE, config.METRICS_FILE_INTERVAL)
+            lgt('Writing metrics to %s every %s seconds', config.METRICS_FILE, config.METRICS_FILE_INTERVAL)
+
+    #
+    # Startup
+    #
+
+    # Stopped by docker or systemd like with Ctrl+C, so the state is saved below
+    signal.signal(signal.SIGTERM, _stop)
+
+    try:
+        if args.engine == 'async':
+            from mtt.async_engine import AsyncEngine
+            AsyncEngine(publishers, max_concurrency=config.ASYNC_MAX_CONCURRENCY,
+                        max_queue_size=config.PUBLISH_QUEUE_SIZE).run()
+
+        else:
+            for publisher in publishers:
+                publisher.start()
+
+            for publisher in publishers:
+                publisher.join()
+
+    except (KeyboardInterrupt, SystemExit):
+        lgt('Stopping…')
+
+    finally:
+        # The records written since the last sync are synced
+        for account_pair in account_pairs:
+            account_pair.close()
+
+
+if __name__ == '__main__':
+    main()
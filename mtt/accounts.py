@@ -0,0 +1,198 @@
+from path import Path
+
+from mtt import config
+from mtt.associations import open_status_associations
+from mtt.connections import APIClients
+from mtt.mastodon_to_twitter import TwitterPublisher
+from mtt.metadata import PlatformMetadata
+from mtt.outbox import Outbox
+from mtt.tracking import SentStatusTracker
+from mtt.twitter_to_mastodon import MastodonPublisher
+
+
+# The FILES entries stored separately for each account pair. Other files
+# (e.g. the medias cache) are shared by all pairs.
+ACCOUNT_FILES = (
+    'credentials_twitter',
+    'credentials_mastodon_client',
+    'credentials_mastodon_server',
+    'credentials_mastodon_user',
+    'status_associations',
+    'status_associations_store',
+    'outbox',
+    'platform_metadata'
+)
+
+
+class AccountPair:
+    """
+    A Mastodon account and a Twitter account crossposted together.
+
+    Each pair has its own credentials and its own state (tweets/toots
+    associations, sent statuses); connection pools, compiled regexps and
+    worker pools are shared by all the pairs of the process.
+    """
+
+    def __init__(self, name, files, post_on_twitter=None, post_on_mastodon=None, legacy_paths=None):
+        """
+        :param name: The name of the pair, used in logs. None for the only pair of the process.
+        :param files: A dict with the paths of the ACCOUNT_FILES of this pair.
+        :param post_on_twitter: Overrides POST_ON_TWITTER for this pair.
+        :param post_on_mastodon: Overrides POST_ON_MASTODON for this pair.
+        :param legacy_paths: The paths where an old JSON associations file may be.
+        """
+        self.name = name
+        self.files = files
+        self.post_on_twitter = config.POST_ON_TWITTER if post_on_twitter is None else post_on_twitter
+        self.post_on_mastodon = config.POST_ON_MASTODON if post_on_mastodon is None else post_on_mastodon
+        self.legacy_paths = legacy_paths or [files['status_associations']]
+
+        self.clients = None
+        self.metadata = None
+        self.ma_account_id = None
+        self.tw_account_id = None
+        self.status_associations = None
+        self.sent_status = None
+        self.outbox = None
+
+    def load(self):
+        """
+        Reads the credentials of the pair, logs in and opens its state.
+        """
+        with self.files['credentials_twitter'].open('r') as secret_file:
+            twitter_consumer_key = secret_file.readline().rstrip()
+            twitter_consumer_secret = secret_file.readline().rstrip()
+            twitter_access_key = secret_file.readline().rstrip()
+            twitter_access_secret = secret_file.readline().rstrip()
+
+        with self.files['credentials_mastodon_server'].open('r') as secret_file:
+            mastodon_base_url = secret_file.readline().rstrip()
+
+        self.connect(
+            mastodon_settings=dict(
+                client_id=self.files['credentials_mastodon_client'],
+                access_token=self.files['credentials_mastodon_user'],
+                # Requests are paced by the shared rate limiter; if a limit
+                # is hit anyway, the status is retried later
+                ratelimit_method='throw',
+                api_base_url=mastodon_base_url
+            ),
+            twitter_settings=dict(
+                consumer_key=twitter_consumer_key,
+                consumer_secret=twitter_consumer_secret,
+                access_token_key=twitter_access_key,
+                access_token_secret=twitter_access_secret,
+                tweet_mode='extended'  # Allows tweets longer than 140/280 raw characters
+            )
+        )
+
+    def connect(self, mastodon_settings, twitter_settings):
+        """
+        Logs in and opens the state of the pair.
+        :param mastodon_settings: The keyword arguments used to create Mastodon clients.
+        :param twitter_settings: The keyword arguments used to create Twitter clients.
+        """
+        # API clients are created per thread, and share keep-alive connection pools.
+        self.clients = APIClients(mastodon_settings=mastodon_settings, twitter_settings=twitter_settings)
+
+        # Accounts and platforms information are cached: only missing
+        # ones are fetched (concurrently), stale ones are refreshed later.
+        self.metadata = PlatformMetadata(self.clients, self.files['platform_metadata'],
+                                         ttl=config.PLATFORM_METADATA_TTL)
+        self.metadata.load()
+
+        self.ma_account_id = self.metadata.mastodon_account["id"]
+        self.tw_account_id = self.metadata.twitter_account["id"]
+
+        # Loads tweets/toots associations to be able to mirror threads
+        # This links the toots and tweets. A toot too long to fit into a
+        # single tweet is linked to every tweet of the generated thread.
+        self.status_associations = open_status_associations(
+            backend=config.STATUS_ASSOCIATIONS_BACKEND,
+            path=self.files['status_associations_store'],
+            retention_days=config.STATUS_ASSOCIATIONS_RETENTION_DAYS,
+            legacy_paths=self.legacy_paths
+        )
+
+        # To avoid bouncing toots or tweets, we keep the ID of the status we sent to
+        # avoid re-sending them indefinitely.
+        # Unlike status_associations, this contains _every_ status sent including
+        # intermediate tweets if toots are too long.
+        # IDs are forgotten after a while, as echoes arrive within seconds.
+        self.sent_status = {
+            'toots': SentStatusTracker(ttl=config.SENT_STATUS_TTL, max_size=config.SENT_STATUS_MAX_SIZE),
+            'tweets': SentStatusTracker(ttl=config.SENT_STATUS_TTL, max_size=config.SENT_STATUS_MAX_SIZE)
+        }
+
+        # Statuses being crossposted are journaled, so they are resumed if
+        # the process dies before they are fully crossposted.
+        self.outbox = Outbox(self.files['outbox'])
+
+    def close(self):
+        """
+        Syncs and closes the outbox and the associations store.
+        """
+        if self.outbox is not None:
+            self.outbox.close()
+        if self.status_associations is not None:
+            self.status_associations.close()
+
+    def create_publishers(self):
+        """
+        :return: The publishers of this pair (loaded first).
+        """
+        prefix = f'{self.name}: ' if self.name else ''
+        state = dict(
+            clients=self.clients,
+            metadata=self.metadata,
+            ma_account_id=self.ma_account_id,
+            tw_account_id=self.tw_account_id,
+            status_associations=self.status_associations,
+            sent_status=self.sent_status,
+            outbox=self.outbox
+        )
+
+        publishers = []
+
+        if self.post_on_twitter:
+            publishers.append(TwitterPublisher(name=f'{prefix}Mastodon -> Twitter', **state))
+
+        if self.post_on_mastodon:
+            publishers.append(MastodonPublisher(name=f'{prefix}Twitter -> Mastodon', **state))
+
+        return publishers
+
+
+def get_account_pairs():
+    """
+    :return: The account pairs to crosspost, from the ACCOUNTS option, or
+             the single pair stored in FILES if empty.
+    """
+    if not config.ACCOUNTS:
+        return [AccountPair(
+            name=None,
+            files={key: config.FILES[key] for key in ACCOUNT_FILES},
+            # Older versions stored the associations as JSON in the working directory
+            legacy_paths=[config.FILES['status_associations'], 'mtt_status_associations.json']
+        )]
+
+    pairs = []
+    names = set()
+
+    for account in config.ACCOUNTS:
+        name = account['name']
+        if name in names:
+            raise ValueError(f'Duplicated account pair name "{name}" in ACCOUNTS')
+        names.add(name)
+
+        directory = Path(account['path'])
+        directory.makedirs_p()
+
+        pairs.append(AccountPair(
+            name=name,
+            files={key: directory / config.FILES[key].name for key in ACCOUNT_FILES},
+            post_on_twitter=account.get('post_on_twitter'),
+            post_on_mastodon=account.get('post_on_mastodon')
+        ))
+
+    return pairs
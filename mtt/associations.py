@@ -0,0 +1,390 @@
+import json
+import logging
+import os
+import sqlite3
+import time
+
+from abc import ABC, abstractmethod
+from threading import RLock
+
+from mtt.utils import lg
+
+
+class StatusAssociations(ABC):
+    """
+    Stores which tweet corresponds to which toot, so threads can be mirrored.
+
+    A toot too long to fit into a single tweet is associated with each tweet
+    of the generated thread: the toot is found from any of them, and the
+    tweet found from the toot is the last one associated (the last of the
+    thread, which replies are attached to).
+
+    Every write is O(1): backends never rewrite the whole store when a single
+    association is added. Both directions are indexed.
+    """
+
+    # Associations are pruned every time this many associations are added
+    # (only if a retention period is set).
+    PRUNE_INTERVAL = 1000
+
+    def __init__(self, retention=None):
+        """
+        :param retention: If set, associations older than this (in seconds)
+                          are pruned from the store.
+        """
+        self.retention = retention
+        self.lock = RLock()
+        self._writes_since_prune = 0
+
+    def associate(self, toot_id, tweet_id):
+        """
+        Associates a tweet and a toot. The toot keeps its other tweets, but
+        this one is now returned by get_tweet_id.
+        :param toot_id: The toot ID
+        :param tweet_id: The tweet ID
+        """
+        with self.lock:
+            self._store(int(toot_id), int(tweet_id), time.time())
+
+            self._writes_since_prune += 1
+            if self.retention and self._writes_since_prune >= self.PRUNE_INTERVAL:
+                self.prune()
+
+    def get_tweet_id(self, toot_id):
+        """
+        :param toot_id: A toot ID.
+        :return: The ID of the tweet last associated with this toot, or None.
+        """
+        if toot_id is None:
+            return None
+        with self.lock:
+            return self._tweet_id(int(toot_id))
+
+    def get_toot_id(self, tweet_id):
+        """
+        :param tweet_id: A tweet ID.
+        :return: The ID of the toot associated with this tweet, or None.
+        """
+        if tweet_id is None:
+            return None
+        with self.lock:
+            return self._toot_id(int(tweet_id))
+
+    def prune(self):
+        """
+        Removes the associations older than the retention period, if any.
+        :return: The number of associations removed.
+        """
+        with self.lock:
+            self._writes_since_prune = 0
+            if not self.retention:
+                return 0
+            return self._prune(time.time() - self.retention)
+
+    @abstractmethod
+    def import_associations(self, m2t):
+        """
+        Bulk-imports associations (used for migrations).
+        :param m2t: A dict mapping toot IDs to tweet IDs.
+        """
+
+    def close(self):
+        pass
+
+    @abstractmethod
+    def __len__(self):
+        """
+        :return: The number of associations stored (one per tweet).
+        """
+
+    @abstractmethod
+    def _store(self, toot_id, tweet_id, created_at):
+        """
+        Stores an association, replacing the one of this tweet if any. Called with the lock held.
+        """
+
+    @abstractmethod
+    def _tweet_id(self, toot_id):
+        """
+        :return: The ID of the tweet last associated with this toot, or None. Called with the lock held.
+        """
+
+    @abstractmethod
+    def _toot_id(self, tweet_id):
+        """
+        :return: The ID of the toot associated with this tweet, or None. Called with the lock held.
+        """
+
+    @abstractmethod
+    def _prune(self, older_than):
+        """
+        Removes the associations created before a timestamp. Called with the lock held.
+        :return: The number of associations removed.
+        """
+
+
+class SQLiteStatusAssociations(StatusAssociations):
+    """
+    Associations stored in a SQLite table, indexed on both toot and tweet IDs.
+    """
+
+    # Version 1: one row per tweet (the table had one row per toot before)
+    SCHEMA_VERSION = 1
+
+    def __init__(self, path, retention=None):
+        super(SQLiteStatusAssociations, self).__init__(retention=retention)
+
+        self.path = path
+        self.db = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+
+        # WAL + NORMAL synchronous mode: commits are cheap appends to the WAL
+        # file instead of a full database sync.
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+
+        if self.db.execute('PRAGMA user_version').fetchone()[0] < self.SCHEMA_VERSION:
+            self._migrate()
+
+        self.db.execute('CREATE TABLE IF NOT EXISTS status_associations ('
+                        'tweet_id INTEGER PRIMARY KEY, '
+                        'toot_id INTEGER NOT NULL, '
+                        'created_at REAL NOT NULL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS status_associations_toot_id '
+                        'ON status_associations (toot_id)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS status_associations_created_at '
+                        'ON status_associations (created_at)')
+        self.db.execute(f'PRAGMA user_version = {self.SCHEMA_VERSION}')
+
+        # Kept up to date by the writes, so counting does not scan the table
+        self.count = self._count()
+
+    def _migrate(self):
+        """
+        Converts the table of the previous versions, with one row per toot.
+        """
+        if not self.db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' "
+                               "AND name = 'status_associations'").fetchone():
+            return
+
+        self.db.execute('BEGIN')
+        self.db.execute('ALTER TABLE status_associations RENAME TO status_associations_v0')
+        self.db.execute('DROP INDEX IF EXISTS status_associations_tweet_id')
+        self.db.execute('DROP INDEX IF EXISTS status_associations_created_at')
+        self.db.execute('CREATE TABLE status_associations ('
+                        'tweet_id INTEGER PRIMARY KEY, '
+                        'toot_id INTEGER NOT NULL, '
+                        'created_at REAL NOT NULL)')
+        # Oldest first, so the last toot associated with a tweet is kept
+        self.db.execute('INSERT OR REPLACE INTO status_associations (tweet_id, toot_id, created_at) '
+                        'SELECT tweet_id, toot_id, created_at FROM status_associations_v0 ORDER BY created_at')
+        self.db.execute('DROP TABLE status_associations_v0')
+        self.db.execute('COMMIT')
+
+    def import_associations(self, m2t):
+        now = time.time()
+        with self.lock:
+            self.db.execute('BEGIN')
+            self.db.executemany('INSERT OR REPLACE INTO status_associations (tweet_id, toot_id, created_at) '
+                                'VALUES (?, ?, ?)',
+                                ((int(tweet_id), int(toot_id), now) for toot_id, tweet_id in m2t.items()))
+            self.db.execute('COMMIT')
+            self.count = self._count()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def __len__(self):
+        return self.count
+
+    def _count(self):
+        return self.db.execute('SELECT COUNT(*) FROM status_associations').fetchone()[0]
+
+    def _store(self, toot_id, tweet_id, created_at):
+        if self.db.execute('INSERT OR IGNORE INTO status_associations (tweet_id, toot_id, created_at) '
+                           'VALUES (?, ?, ?)', (tweet_id, toot_id, created_at)).rowcount:
+            self.count += 1
+        else:
+            self.db.execute('UPDATE status_associations SET toot_id = ?, created_at = ? WHERE tweet_id = ?',
+                            (toot_id, created_at, tweet_id))
+
+    def _tweet_id(self, toot_id):
+        row = self.db.execute('SELECT tweet_id FROM status_associations WHERE toot_id = ? '
+                              'ORDER BY created_at DESC, tweet_id DESC LIMIT 1', (toot_id,)).fetchone()
+        return row[0] if row else None
+
+    def _toot_id(self, tweet_id):
+        row = self.db.execute('SELECT toot_id FROM status_associations WHERE tweet_id = ?', (tweet_id,)).fetchone()
+        return row[0] if row else None
+
+    def _prune(self, older_than):
+        removed = self.db.execute('DELETE FROM status_associations WHERE created_at < ?', (older_than,)).rowcount
+        self.count -= removed
+        return removed
+
+
+class LogStatusAssociations(StatusAssociations):
+    """
+    Associations kept in memory and persisted into an append-only log file
+    (one "toot_id tweet_id timestamp" line per association, in the order
+    they were made).
+
+    The log is compacted (rewritten with only the live associations) when it
+    grows to more than twice the number of live associations.
+    """
+
+    # The log is never compacted under this many lines.
+    MIN_COMPACTION_SIZE = 1000
+
+    def __init__(self, path, retention=None):
+        super(LogStatusAssociations, self).__init__(retention=retention)
+
+        self.path = path
+        # Toot ID -> ID of the tweet last associated
+        self.m2t = {}
+        # Tweet ID -> toot ID, in the order they were associated
+        self.t2m = {}
+        # Tweet ID -> association timestamp
+        self.created_at = {}
+        self.log_lines = 0
+
+        try:
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        toot_id, tweet_id, created_at = line.split()
+                        self._remember(int(toot_id), int(tweet_id), float(created_at))
+                    except ValueError:
+                        # Truncated last line after a crash
+                        continue
+                    self.log_lines += 1
+        except FileNotFoundError:
+            pass
+
+        self.log = open(path, 'a')
+
+    def import_associations(self, m2t):
+        now = time.time()
+        with self.lock:
+            for toot_id, tweet_id in m2t.items():
+                self._remember(int(toot_id), int(tweet_id), now)
+            self._compact()
+
+    def close(self):
+        with self.lock:
+            self.log.close()
+
+    def __len__(self):
+        return len(self.t2m)
+
+    def _remember(self, toot_id, tweet_id, created_at):
+        # Moved to the end, so compacting keeps the order of the associations
+        previous_toot_id = self.t2m.pop(tweet_id, None)
+        if previous_toot_id is not None and self.m2t.get(previous_toot_id) == tweet_id:
+            del self.m2t[previous_toot_id]
+        self.created_at.pop(tweet_id, None)
+
+        self.m2t[toot_id] = tweet_id
+        self.t2m[tweet_id] = toot_id
+        self.created_at[tweet_id] = created_at
+
+    def _store(self, toot_id, tweet_id, created_at):
+        self._remember(toot_id, tweet_id, created_at)
+
+        self.log.write(f'{toot_id} {tweet_id} {created_at}\n')
+        self.log.flush()
+        self.log_lines += 1
+
+        if self.log_lines > max(self.MIN_COMPACTION_SIZE, 2 * len(self.t2m)):
+            self._compact()
+
+    def _tweet_id(self, toot_id):
+        return self.m2t.get(toot_id)
+
+    def _toot_id(self, tweet_id):
+        return self.t2m.get(tweet_id)
+
+    def _prune(self, older_than):
+        expired = [tweet_id for tweet_id, created_at in self.created_at.items() if created_at < older_than]
+        for tweet_id in expired:
+            toot_id = self.t2m.pop(tweet_id)
+            del self.created_at[tweet_id]
+            if self.m2t.get(toot_id) == tweet_id:
+                del self.m2t[toot_id]
+
+        if expired:
+            self._compact()
+
+        return len(expired)
+
+    def _compact(self):
+        temp_path = f'{self.path}.tmp'
+        with open(temp_path, 'w') as f:
+            for tweet_id, toot_id in self.t2m.items():
+                f.write(f'{toot_id} {tweet_id} {self.created_at[tweet_id]}\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+        self.log.close()
+        os.replace(temp_path, self.path)
+        self.log = open(self.path, 'a')
+        self.log_lines = len(self.t2m)
+
+
+BACKENDS = {
+    'sqlite': SQLiteStatusAssociations,
+    'log': LogStatusAssociations
+}
+
+
+def open_status_associations(backend, path, retention_days=None, legacy_paths=None):
+    """
+    Opens the associations store, migrating the old JSON associations file
+    if needed.
+
+    :param backend: The backend to use ('sqlite' or 'log', else ValueError is raised).
+    :param path: The path of the store.
+    :param retention_days: If set, associations older than this are pruned.
+    :param legacy_paths: The paths where an old JSON associations file may be.
+    :return: A StatusAssociations instance.
+    """
+    try:
+        backend_class = BACKENDS[backend]
+    except KeyError:
+        raise ValueError(f'Unknown status associations backend "{backend}"')
+
+    associations = backend_class(path, retention=retention_days * 60 * 60 * 24 if retention_days else None)
+
+    for legacy_path in legacy_paths or []:
+        migrate_json_associations(associations, legacy_path)
+
+    removed = associations.prune()
+    if removed:
+        lg('Associations', 'Pruned %d associations older than %s days', removed, retention_days)
+
+    return associations
+
+
+def migrate_json_associations(associations, json_path):
+    """
+    One-time migration from the old whole-file JSON associations format.
+    Once imported, the JSON file is renamed with a .migrated suffix.
+
+    :param associations: The StatusAssociations instance to import into.
+    :param json_path: The old JSON file path.
+    """
+    if not os.path.isfile(json_path):
+        return
+
+    try:
+        with open(json_path, 'r') as f:
+            m2t = json.load(f)
+    except (OSError, ValueError) as e:
+        lg('Associations', 'Unable to read old associations file %s, not migrating it: %s', json_path, e,
+           level=logging.WARNING)
+        return
+
+    associations.import_associations(m2t)
+    os.replace(json_path, f'{json_path}.migrated')
+
+    lg('Associations', 'Migrated %d associations from %s', len(m2t), json_path)
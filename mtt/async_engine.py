@@ -0,0 +1,124 @@
+import asyncio
+import logging
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread
+
+from mtt.utils import lg
+from mtt.work_queue import WorkQueue
+
+
+class AsyncEngine:
+    """
+    Runs the publishers as asyncio coroutines instead of one blocking thread
+    per direction.
+
+    Each stream is read by a dedicated reader into the publisher work queue,
+    like with the threaded engine (see WorkQueue: statuses of a thread are
+    crossposted in order, and failed statuses are retried after a delay).
+    Statuses are then processed concurrently (up to `max_concurrency` at a
+    time across both directions), so a slow media transfer or a retry does
+    not delay the following statuses.
+
+    The Mastodon and Twitter client libraries are blocking, so the network
+    calls themselves run in a worker pool; the publishers filtering and
+    transformation logic is reused as is.
+    """
+
+    def __init__(self, publishers, max_concurrency=8, max_queue_size=100):
+        """
+        :param publishers: The publishers to run.
+        :param max_concurrency: The maximal number of statuses processed at the same time.
+        :param max_queue_size: The maximal number of statuses waiting, per publisher.
+        """
+        self.publishers = publishers
+        self.max_concurrency = max_concurrency
+        self.max_queue_size = max_queue_size
+
+        self.workers = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='Publish')
+        # A thread waiting for the statuses to process, per publisher (streams are read in their own threads)
+        self.readers = ThreadPoolExecutor(max_workers=len(publishers), thread_name_prefix='Stream')
+
+    def run(self):
+        """
+        Runs the engine. Streams are reopened when closed, so this only returns on unexpected errors.
+        """
+        try:
+            asyncio.run(self._run())
+        finally:
+            # When stopped (e.g. by a signal), the threads waiting for statuses return
+            for publisher in self.publishers:
+                if publisher.work_queue is not None:
+                    publisher.work_queue.close()
+
+    async def _run(self):
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        await asyncio.gather(*(self._run_publisher(publisher) for publisher in self.publishers))
+
+    async def _run_publisher(self, publisher):
+        loop = asyncio.get_running_loop()
+
+        await loop.run_in_executor(self.workers, publisher.init_process)
+
+        queue = publisher.work_queue = WorkQueue(publisher.crosspost, name=publisher.name, workers=0,
+                                                 max_size=self.max_queue_size)
+
+        reader = self._run_in_thread(loop, publisher.read_stream, name=publisher.name)
+        # Once the stream is closed, the queued statuses are still processed
+        reader.add_done_callback(lambda _: queue.close())
+
+        tasks = set()
+        while True:
+            item = await loop.run_in_executor(self.readers, queue.take)
+            if item is None:
+                break
+
+            # Statuses are only taken from the queue when they can be processed,
+            # so a full queue still pauses the stream reading.
+            await self.semaphore.acquire()
+
+            task = asyncio.ensure_future(self._process(queue, item))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        if tasks:
+            await asyncio.wait(tasks)
+
+        try:
+            reader.result()
+        except Exception as e:
+            lg(publisher.name, 'Stream closed: %s', e, level=logging.WARNING)
+
+    @staticmethod
+    def _run_in_thread(loop, function, name):
+        """
+        Runs a function in a daemon thread: unlike the executors threads, it
+        does not keep the process alive once stopped (streams are read forever).
+        :return: An asyncio future of its result.
+        """
+        future = loop.create_future()
+
+        def set_result(setter, value):
+            if not future.done():
+                setter(value)
+
+        def run():
+            try:
+                outcome = future.set_result, function()
+            except Exception as e:
+                outcome = future.set_exception, e
+
+            try:
+                loop.call_soon_threadsafe(set_result, *outcome)
+            except RuntimeError:
+                # The loop is closed
+                pass
+
+        Thread(target=run, name=name, daemon=True).start()
+        return future
+
+    async def _process(self, queue, item):
+        try:
+            await asyncio.get_running_loop().run_in_executor(self.workers, queue.process, item)
+        finally:
+            self.semaphore.release()
@@ -9,7 +9,6 @@
 
 import os
 import re
-import twitter
 
 from path import Path
 
@@ -35,13 +34,23 @@ TOOT_VISIBILITY = "public"
 # /!\ ADDING 'direct' HERE WILL TRANSFER ALL PRIVATE DIRECT MESSAGES TO TWITTER PUBLICLY.
 TOOT_VISIBILITY_REQUIRED_TO_TRANSFER = ['public', 'unlisted']
 
-# How often to retry when posting fails
+# How often to retry when posting fails (MASTODON_* for posting on
+# Mastodon, TWITTER_* for posting on Twitter). Failing statuses are put
+# aside while other statuses are crossposted.
 MASTODON_RETRIES = 3
 TWITTER_RETRIES = 3
 
-# How long to wait between retries, in seconds
+# How long to wait before the first retry, in seconds. The delay is
+# doubled at each retry (with a bit of randomness), up to RETRY_MAX_DELAY,
+# and is extended up to the rate limit reset if the API is rate limited.
 MASTODON_RETRY_DELAY = 20
 TWITTER_RETRY_DELAY = 20
+RETRY_MAX_DELAY = 15 * 60
+
+# API requests are paced using the rate limit headers of the responses.
+# When a rate limit is reached, requests wait for its reset for up to this
+# many seconds; if the reset is later, the status is retried after it.
+RATE_LIMIT_MAX_WAIT = 10
 
 # The text to prepend to tweets, if the corresponding toot has a
 # content warning. {} is the spoiler text.
@@ -61,28 +70,155 @@ TWEET_CW_REGEXP = re.compile(r'(?:[\[(])(?:(?:(?:C|T)W)|SPOIL(?:ER)?)(?:[\s\-\.
 TWEET_CW_ALLOW_MULTI = True
 TWEET_CW_SEPARATOR = ', '
 
-# Some helpers copied out from python-twitter, because they're broken there
-URL_REGEXP = re.compile((
-    r'('
-    r'(?!(https?://|www\.)?\.|ftps?://|([0-9]+\.){{1,3}}\d+)'  # exclude urls that start with "."
-    r'(?:https?://|www\.)*(?!.*@)(?:[\w+-_]+[.])'              # beginning of url
-    r'(?:{0}\b|'                                               # all tlds
-    r'(?:[:0-9]))'                                             # port numbers & close off TLDs
-    r'(?:[\w+\/]?[a-z0-9!\*\'\(\);:&=\+\$/%#\[\]\-_\.,~?])*'   # path/query params
-    r')').format(r'\b|'.join(twitter.twitter_utils.TLDS)), re.U | re.I | re.X)
-
 # The files where credentials and other data are stored
 FILES = {
     'credentials_twitter': ROOT_PATH / 'mtt_twitter.secret',
     'credentials_mastodon_client': ROOT_PATH / 'mtt_mastodon_client.secret',
     'credentials_mastodon_server': ROOT_PATH / 'mtt_mastodon_server.secret',
     'credentials_mastodon_user': ROOT_PATH / 'mtt_mastodon_user.secret',
-    'status_associations': ROOT_PATH / 'mtt_status_associations.json'
+    'status_associations': ROOT_PATH / 'mtt_status_associations.json',
+    'status_associations_store': ROOT_PATH / 'mtt_status_associations.db',
+    'media_cache': ROOT_PATH / 'mtt_media_cache.json',
+    'outbox': ROOT_PATH / 'mtt_outbox.journal',
+    'platform_metadata': ROOT_PATH / 'mtt_platform_metadata.json'
+}
+
+# What we need to know about the accounts and the platforms (our accounts,
+# the Mastodon instance limits, the Twitter short URLs length and medias
+# constraints) is cached in FILES['platform_metadata'], so restarts are
+# quick. It is refreshed in the background when older than this (seconds).
+PLATFORM_METADATA_TTL = 60 * 60 * 24
+
+# To crosspost several account pairs from a single process, list them here.
+# Each pair has a name (used in logs) and a directory where its credentials
+# and its state are stored (same file names as in FILES above). A pair can
+# also override POST_ON_TWITTER and POST_ON_MASTODON. Connection pools,
+# worker pools and the medias cache are shared by all pairs.
+# If empty, a single pair is crossposted, using FILES.
+# Example:
+# ACCOUNTS = [
+#     {'name': 'alice', 'path': ROOT_PATH / 'accounts' / 'alice'},
+#     {'name': 'bob', 'path': ROOT_PATH / 'accounts' / 'bob', 'post_on_mastodon': False},
+# ]
+ACCOUNTS = []
+
+# How the tweets/toots associations are stored.
+# - 'sqlite': in a SQLite database;
+# - 'log': in memory, persisted in an append-only log file, compacted from
+#   times to times.
+# The store is located at FILES['status_associations_store'].
+# An old mtt_status_associations.json file is migrated automatically.
+STATUS_ASSOCIATIONS_BACKEND = 'sqlite'
+
+# Associations older than this (in days) are forgotten, so the store does
+# not grow forever. Replies to older statuses will not be synced anymore.
+# Set to None to keep all associations.
+STATUS_ASSOCIATIONS_RETENTION_DAYS = None
+
+# To avoid bouncing tweets/toots, statuses we sent are not crossposted
+# back. As the echo of a status can arrive before its post request
+# returns, a status received while we are posting on its platform waits
+# for these posts to be done, for up to this many seconds. Other statuses
+# are processed right away.
+ECHO_WAIT_TIMEOUT = 30
+
+# At startup, statuses posted while the crossposter was not running are
+# crossposted (oldest first), before the new ones. At most
+# CATCH_UP_MAX_STATUSES statuses are caught up per direction (the most
+# recent ones). Set CATCH_UP to False to only crosspost statuses posted
+# after the start.
+CATCH_UP = True
+CATCH_UP_MAX_STATUSES = 200
+
+# Statuses received are queued, and crossposted by this many workers per
+# direction (statuses of the same thread are always crossposted in order).
+# When PUBLISH_QUEUE_SIZE statuses are waiting, the stream reading is paused.
+PUBLISH_WORKERS = 4
+PUBLISH_QUEUE_SIZE = 100
+
+# To avoid bouncing statuses, the IDs of the statuses we sent are remembered
+# for this long (seconds), and at most this many IDs are remembered per
+# network. Echoes come back within seconds, so this can stay small.
+SENT_STATUS_TTL = 60 * 10
+SENT_STATUS_MAX_SIZE = 10000
+
+# Medias are transferred by chunks of this size (bytes). Medias smaller
+# than MEDIA_SPOOL_MAX_MEMORY bytes are kept in memory during the transfer;
+# larger ones are spooled to a temporary file.
+MEDIA_CHUNK_SIZE = 64 * 1024
+MEDIA_SPOOL_MAX_MEMORY = 4 * 1024 * 1024
+
+# Timeout (seconds) for media downloads.
+MEDIA_TIMEOUT = 30
+
+# How many medias can be transferred at the same time. The attachments of
+# a status are transferred concurrently.
+MEDIA_TRANSFER_WORKERS = 4
+
+# Uploaded medias are cached, so identical medias (e.g. boosted or re-posted)
+# are not transferred again. This is how long (seconds) an uploaded media
+# can be reused, per platform. Twitter media IDs expire after 24 hours;
+# Mastodon medias can only be attached to a single status, so they are not
+# cached (0).
+MEDIA_CACHE_TTL = {
+    'twitter': 60 * 60 * 23,
+    'mastodon': 0
 }
 
-# The delay to wait before a tweet or a toot is processed (seconds).
-# This avoids race conditions.
-# We wait a little bit so tweets sent to Mastodon (or the other way
-# around) can be marked as such before this run, avoiding bouncing
-# tweets/toots
-STATUS_PROCESS_DELAY = 0.6
+# The maximal amount of entries in the medias cache (least recently used
+# entries are evicted first).
+MEDIA_CACHE_SIZE = 1000
+
+# HTTP connections are kept alive and shared by all threads.
+# HTTP_POOL_HOSTS is the number of hosts for which connections are kept,
+# HTTP_POOL_SIZE the maximal number of idle connections kept per host.
+HTTP_POOL_HOSTS = 10
+HTTP_POOL_SIZE = 10
+
+# Timeout (seconds) to establish a HTTP connection, for requests without
+# an explicit timeout.
+HTTP_CONNECT_TIMEOUT = 10
+
+# With the asyncio engine (--engine=async), the maximal number of statuses
+# crossposted at the same time (both directions together).
+ASYNC_MAX_CONCURRENCY = 8
+
+# Streams are reopened when they are closed or stalled, after a delay
+# growing from STREAM_RECONNECT_MIN_DELAY up to STREAM_RECONNECT_MAX_DELAY
+# (seconds) with each failed attempt. Statuses published while disconnected
+# are fetched before the stream is reopened.
+# A stream is stalled when nothing (not even a heartbeat) was received for
+# STREAM_STALL_TIMEOUT seconds. Mastodon sends heartbeats every 15 seconds
+# and Twitter keep-alives every 30 seconds.
+STREAM_STALL_TIMEOUT = 90
+STREAM_RECONNECT_MIN_DELAY = 1
+STREAM_RECONNECT_MAX_DELAY = 5 * 60
+
+# Metrics: latency histograms of each crossposting stage (receive: from
+# the stream to the processing; convert: HTML cleanup of toots or text
+# conversion of tweets; split_status; media_download; media_upload; post;
+# associate), counters (statuses, stream reconnections and events accepted
+# or dropped, echo checks, rate limited requests, medias cache lookups), and
+# gauges (queues, streams, sent statuses, associations, rate limits, medias
+# cache).
+# If METRICS_PORT is set, they are served in the Prometheus text format at
+# http://METRICS_HOST:METRICS_PORT/metrics. If METRICS_FILE is set, a JSON
+# summary is written to this file every METRICS_FILE_INTERVAL seconds.
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = None
+METRICS_FILE = None
+METRICS_FILE_INTERVAL = 60
+
+# Logs are written to the standard output by a background thread, so a
+# slow output never delays the crossposting.
+# LOG_FORMAT is 'text', or 'json' for one JSON object per line.
+# LOG_LEVEL is the minimal level of the messages written ('DEBUG', 'INFO',
+# 'WARNING', 'ERROR'). LOG_LEVELS overrides it per namespace, e.g.
+# {'Medias': 'WARNING', 'Mastodon -> Twitter': 'DEBUG'} (publishers are
+# namespaced by their name, prefixed with the account pair name if any).
+# The statuses texts are truncated to LOG_STATUS_MAX_LENGTH characters in
+# the logs; set it to 0 to hide them, or None to log them entirely.
+LOG_FORMAT = 'text'
+LOG_LEVEL = 'INFO'
+LOG_LEVELS = {}
+LOG_STATUS_MAX_LENGTH = 80
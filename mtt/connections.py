@@ -0,0 +1,130 @@
+import requests
+import threading
+
+from requests.adapters import HTTPAdapter
+
+from mtt import config
+from mtt.ratelimit import RateLimiter
+
+
+class PooledHTTPAdapter(HTTPAdapter):
+    """
+    A transport adapter keeping alive connections to each host, with a
+    default connection timeout for requests sent without explicit timeout.
+    Streams sent without explicit timeout also get a read timeout, so a
+    stalled stream fails instead of hanging forever.
+
+    Other requests are paced by a rate limiter, if any.
+
+    A single adapter is shared by all threads: its underlying connection
+    pools are thread-safe, unlike requests sessions.
+    """
+
+    def __init__(self, connect_timeout=None, stream_read_timeout=None, rate_limiter=None, **kwargs):
+        super(PooledHTTPAdapter, self).__init__(**kwargs)
+        self.connect_timeout = connect_timeout
+        self.stream_read_timeout = stream_read_timeout
+        self.rate_limiter = rate_limiter
+
+    def send(self, request, stream=False, timeout=None, **kwargs):
+        if timeout is None:
+            # Streams stay open for a long time, but receive keep-alives.
+            timeout = (self.connect_timeout, self.stream_read_timeout if stream else None)
+
+        if stream or self.rate_limiter is None:
+            return super(PooledHTTPAdapter, self).send(request, stream=stream, timeout=timeout, **kwargs)
+
+        endpoint = self.rate_limiter.get_endpoint(request)
+        self.rate_limiter.acquire(endpoint)
+
+        response = super(PooledHTTPAdapter, self).send(request, stream=stream, timeout=timeout, **kwargs)
+        self.rate_limiter.update(endpoint, response)
+        return response
+
+
+_adapter = None
+_adapter_lock = threading.Lock()
+_local = threading.local()
+
+
+def get_adapter():
+    """
+    :return: The transport adapter (and connection pools) shared by the whole process.
+    """
+    global _adapter
+    with _adapter_lock:
+        if _adapter is None:
+            _adapter = PooledHTTPAdapter(
+                connect_timeout=config.HTTP_CONNECT_TIMEOUT,
+                stream_read_timeout=config.STREAM_STALL_TIMEOUT,
+                # A single rate limiter, as all API requests share the adapter
+                rate_limiter=RateLimiter(max_wait=config.RATE_LIMIT_MAX_WAIT),
+                pool_connections=config.HTTP_POOL_HOSTS,
+                pool_maxsize=config.HTTP_POOL_SIZE,
+                pool_block=False
+            )
+        return _adapter
+
+
+def get_session():
+    """
+    Returns a requests session for the current thread. All sessions share the
+    same keep-alive connection pools, so connections to a host are reused
+    across threads.
+
+    :return: A requests.Session.
+    """
+    session = getattr(_local, 'session', None)
+    if session is None:
+        session = requests.Session()
+        session.mount('https://', get_adapter())
+        session.mount('http://', get_adapter())
+        _local.session = session
+    return session
+
+
+class APIClients:
+    """
+    Hands out Mastodon and Twitter API clients.
+
+    API clients are not safe for concurrent use, so each thread gets its own
+    clients. They all use the shared connection pools.
+
+    The API libraries are imported when the first client is created, as
+    they are slow to import.
+    """
+
+    def __init__(self, mastodon_settings, twitter_settings):
+        """
+        :param mastodon_settings: The keyword arguments used to create Mastodon clients.
+        :param twitter_settings: The keyword arguments used to create Twitter clients.
+        """
+        self.mastodon_settings = mastodon_settings
+        self.twitter_settings = twitter_settings
+        self.local = threading.local()
+
+    @property
+    def mastodon(self):
+        """
+        :return: The Mastodon client of the current thread.
+        """
+        client = getattr(self.local, 'mastodon', None)
+        if client is None:
+            from mastodon import Mastodon
+            client = Mastodon(session=get_session(), **self.mastodon_settings)
+            self.local.mastodon = client
+        return client
+
+    @property
+    def twitter(self):
+        """
+        :return: The Twitter client of the current thread.
+        """
+        client = getattr(self.local, 'twitter', None)
+        if client is None:
+            import twitter
+            client = twitter.Api(**self.twitter_settings)
+            # python-twitter does not accept a session, but uses this attribute for all its requests
+            client._session = get_session()
+            self.local.twitter = client
+        return client
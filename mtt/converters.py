@@ -0,0 +1,172 @@
+import html
+import re
+
+
+# Tags handled when converting toots HTML to text. Mastodon only sends
+# sanitized HTML, so it can be tokenized with a regexp.
+_TOOT_HTML_REGEXP = re.compile(
+    r'<(?:'
+    r'a [^>]*href="([^"]+)">[^<]*</a>'  # 1. Simple links are replaced by their URL
+    r'|((?i:br ?/?>))'                  # 2. Line breaks
+    r'|((?i:/p><p>))'                   # 3. New paragraphs
+    r'|[^>\n]*>'                        # Other tags are removed, keeping their text (mentions, hashtags...)
+    r')'
+)
+
+# Replacements for the groups above (the group 1 is replaced by its content)
+_TOOT_HTML_REPLACEMENTS = (None, None, '\n', '\n\n')
+
+
+def _replace_toot_html_tag(match):
+    group = match.lastindex
+    if group is None:
+        return ''
+    elif group == 1:
+        return match.group(1)
+    else:
+        return _TOOT_HTML_REPLACEMENTS[group]
+
+
+class TootConverter:
+    """
+    Converts the HTML content of toots to plain text, ready to be tweeted.
+
+    The tags are handled in a single tokenizing pass: links are replaced by
+    their URL, line breaks and paragraphs by new lines, and other tags are
+    removed (keeping their text, so mentions and hashtags are kept as is).
+    Two more passes follow: the text is unescaped, then the links to the
+    instance medias (which are attached to the tweet instead) are trimmed,
+    with the whitespace after them.
+
+    Converters are reusable, and do not recompile anything between toots.
+    """
+
+    def __init__(self, api_base_url):
+        """
+        :param api_base_url: The base URL of the Mastodon instance.
+        """
+        self.media_regexp = re.compile(re.escape(api_base_url.rstrip('/')) + r'\/media\/(\w)+(\s|$)+')
+
+    def convert(self, content):
+        """
+        :param content: The toot HTML content.
+        :return: The toot text.
+        """
+        text = html.unescape(_TOOT_HTML_REGEXP.sub(_replace_toot_html_tag, content).strip())
+        return self.media_regexp.sub('', text)
+
+
+# Entities are not followed by word characters (@someone is not in @someone_else)
+_ENTITY_END_REGEXP = re.compile(r'(?!\w)')
+
+
+class TweetConverter:
+    """
+    Converts the text of tweets to toots text, and extracts their content
+    warnings.
+
+    The text is rewritten in a single left-to-right pass driven by the
+    tweet entities (and their indices): mentions are suffixed with
+    @twitter.com to clearly signal their origin, short URLs are expanded
+    and links to the attached medias are removed. Content warnings are
+    then extracted from the rewritten text.
+    """
+
+    def __init__(self, cw_regexp=None, cw_allow_multi=True, cw_separator=', '):
+        """
+        :param cw_regexp: The regexp matching content warnings, the warning
+                          being in the first group. None to disable content
+                          warnings extraction.
+        :param cw_allow_multi: If False, only the first content warning is extracted.
+        :param cw_separator: The separator between content warnings.
+        """
+        self.cw_regexp = cw_regexp
+        self.cw_allow_multi = cw_allow_multi
+        self.cw_separator = cw_separator
+
+    @staticmethod
+    def _locate(text, entity, expected):
+        """
+        Locates an entity in the text, using its indices if they match the
+        expected text, else searching it.
+
+        :return: A (start, end) tuple, or None if the entity is not in the text.
+        """
+        indices = entity.get('indices')
+        if indices:
+            start, end = indices
+            if text[start:end].lower() == expected.lower() and _ENTITY_END_REGEXP.match(text, end):
+                return start, end
+
+        # Indices not matching the text (e.g. entities from another version of the tweet).
+        # Not inside a longer mention or URL (@someone in @someone_else).
+        match = re.search(r'(?<![\w@])' + re.escape(expected) + r'(?!\w)', text, re.IGNORECASE)
+        return match.span() if match else None
+
+    def convert(self, text, mentions=(), urls=(), medias=()):
+        """
+        :param text: The tweet text (HTML-escaped, as sent by Twitter).
+        :param mentions: The tweet user_mentions entities.
+        :param urls: The tweet urls entities.
+        :param medias: The tweet media entities.
+        :return: A (text, content warning) tuple; the content warning is None
+                 if there is none.
+        """
+        text = html.unescape(text)
+
+        edits = []
+
+        for mention in mentions:
+            location = self._locate(text, mention, '@' + mention['screen_name'])
+            if location:
+                edits.append((location[0], location[1], text[location[0]:location[1]] + '@twitter.com'))
+
+        for url in urls:
+            location = self._locate(text, url, url['url'])
+            if location:
+                edits.append((location[0], location[1], url['expanded_url']))
+
+        for media in medias:
+            location = self._locate(text, media, media['url'])
+            if location:
+                edits.append((location[0], location[1], ''))
+
+        if edits:
+            edits.sort(key=lambda edit: edit[0])
+
+            parts = []
+            position = 0
+            for start, end, replacement in edits:
+                if start < position:
+                    # Overlapping entities
+                    continue
+                parts.append(text[position:start])
+                parts.append(replacement)
+                position = end
+            parts.append(text[position:])
+
+            text = ''.join(parts)
+
+        return self._extract_content_warning(text)
+
+    def _extract_content_warning(self, text):
+        if not self.cw_regexp:
+            return text, None
+
+        warnings = []
+        parts = []
+        position = 0
+
+        for match in self.cw_regexp.finditer(text):
+            warnings.append(match.group(1).strip())
+            parts.append(text[position:match.start()])
+            position = match.end()
+
+            if not self.cw_allow_multi:
+                break
+
+        if not warnings:
+            return text, None
+
+        parts.append(text[position:])
+        return ''.join(parts).strip(), self.cw_separator.join(warnings)
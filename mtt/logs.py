@@ -0,0 +1,168 @@
+import atexit
+import json
+import logging
+import queue
+import re
+import sys
+
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+from threading import Lock
+
+from mtt import config
+
+
+_logger = None
+_listener = None
+_setup_lock = Lock()
+
+# Namespace -> minimal level, resolved from the configuration
+_levels = {}
+
+# Worker threads are named after their publisher, with a number
+_WORKER_SUFFIX_REGEXP = re.compile(r' #\d+$')
+
+
+class _LazyQueueHandler(QueueHandler):
+    """
+    Queues the records as they are: they are formatted by the listener
+    thread, not by the thread logging them.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class TextFormatter(logging.Formatter):
+    """
+    Formats records as `[date] [namespace] message`; the level is shown for
+    warnings and errors.
+    """
+
+    def format(self, record):
+        message = record.getMessage()
+        if record.levelno != logging.INFO:
+            message = f'{record.levelname}: {message}'
+        if record.exc_info:
+            message += '\n' + self.formatException(record.exc_info)
+
+        return f'[{datetime.fromtimestamp(record.created):%d/%m/%Y %H:%M:%S}] [{record.namespace}] {message}'
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    Formats records as JSON objects, one per line.
+    """
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created).isoformat(),
+            'level': record.levelname,
+            'namespace': record.namespace,
+            'message': record.getMessage()
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class StatusText:
+    """
+    The text of a status, to log. It is truncated to LOG_STATUS_MAX_LENGTH
+    characters (or hidden if 0) when the record is formatted, by the logging
+    thread.
+    """
+
+    __slots__ = ('text',)
+
+    def __init__(self, text):
+        self.text = text
+
+    def __str__(self):
+        text = str(self.text).strip()
+        max_length = config.LOG_STATUS_MAX_LENGTH
+
+        if max_length is None:
+            return text
+        if max_length == 0:
+            return f'<{len(text)} characters>'
+        if len(text) > max_length:
+            return text[:max_length - 1].replace('\n', ' ') + '…'
+        return text.replace('\n', ' ')
+
+
+class LazyText:
+    """
+    A text to log, computed by the logging thread when the record is
+    formatted, and only if it is written (e.g. from stats taking a lock).
+    """
+
+    __slots__ = ('function',)
+
+    def __init__(self, function):
+        """
+        :param function: A function returning the text (or a value to convert to text).
+        """
+        self.function = function
+
+    def __str__(self):
+        return str(self.function())
+
+
+def _setup():
+    global _logger, _listener
+
+    with _setup_lock:
+        if _logger is not None:
+            return _logger
+
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(JSONFormatter() if config.LOG_FORMAT == 'json' else TextFormatter())
+
+        # Unbounded: logging must never block the callers
+        records = queue.SimpleQueue()
+        _listener = QueueListener(records, handler)
+        _listener.start()
+        atexit.register(_listener.stop)
+
+        logger = logging.getLogger('mtt')
+        logger.setLevel(logging.DEBUG)
+        logger.propagate = False
+        logger.addHandler(_LazyQueueHandler(records))
+
+        _logger = logger
+        return _logger
+
+
+def get_level(namespace):
+    """
+    :param namespace: A log namespace.
+    :return: The minimal level of the messages logged for this namespace
+             (see LOG_LEVELS).
+    """
+    level = _levels.get(namespace)
+
+    if level is None:
+        levels = config.LOG_LEVELS
+        name = levels.get(namespace, levels.get(_WORKER_SUFFIX_REGEXP.sub('', namespace), config.LOG_LEVEL))
+        level = _levels[namespace] = logging.getLevelName(name) if isinstance(name, str) else name
+
+    return level
+
+
+def log(namespace, level, message, *args, exc_info=None):
+    """
+    Logs a message. It is written by a background thread, so this never blocks
+    on the output.
+
+    :param namespace: The namespace.
+    :param level: The level (logging.INFO...).
+    :param message: The message, with %-style placeholders for the args.
+    :param args: The arguments of the message, formatted only if it is written.
+    :param exc_info: An exception to log with its traceback.
+    """
+    if level < get_level(namespace):
+        return
+
+    (_logger or _setup()).log(level, message, *args, exc_info=exc_info, extra={'namespace': namespace})
@@ -1,54 +1,102 @@
-import html
-import re
-import time
+import logging
+import requests
 
 from mastodon import StreamListener
-from twitter import TwitterError
 from urllib.parse import urlparse
 
-from mtt import config, lock
+from mtt import config
+from mtt.converters import TootConverter
+from mtt.logs import StatusText
+from mtt.metrics import metrics
+from mtt.ratelimit import RetryLater, get_retry_after
+from mtt.streams import StreamFilter
 from mtt.utils import MTTThread, lgt, split_status
 
 
 class TwitterPublisher(MTTThread):
-    def __init__(self, mastodon_api, twitter_api, ma_account_id, tw_account_id,
-                 status_associations, sent_status, group=None, target=None, name=None):
+    destination = 'twitter'
+    statuses_name = 'toots'
+
+    # The maximal page size of the Mastodon API
+    CATCH_UP_PAGE_SIZE = 40
+
+    def __init__(self, clients, metadata, ma_account_id, tw_account_id,
+                 status_associations, sent_status, outbox, group=None, target=None, name=None):
         super(TwitterPublisher, self).__init__(
             group=group,
             target=target,
             name=name,
-            mastodon_api=mastodon_api,
-            twitter_api=twitter_api,
+            clients=clients,
+            metadata=metadata,
             ma_account_id=ma_account_id,
             tw_account_id=tw_account_id,
             status_associations=status_associations,
-            sent_status=sent_status
+            sent_status=sent_status,
+            outbox=outbox
         )
 
-        self.account = mastodon_api.account(ma_account_id)
+        self.account = metadata.mastodon_account
+        self.stream_filter = StreamFilter(ma_account_id)
 
         self.since_toot_id = 0
         self.url_length = 24
-        self.last_url_len_update = 0
 
-        self.MEDIA_REGEXP = re.compile(re.escape(self.mastodon_api.api_base_url.rstrip("/")) + "\/media\/(\w)+(\s|$)+")
+        self.toot_converter = TootConverter(self.mastodon_api.api_base_url)
+
+        self.max_retries = config.TWITTER_RETRIES
+        self.retry_delay = config.TWITTER_RETRY_DELAY
 
     def init_process(self):
-        try:
-            self.since_toot_id = self.mastodon_api.account_statuses(self.ma_account_id)[0]["id"]
-            lgt(f'Tweeting any toot after toot {self.since_toot_id}')
-        except IndexError:
-            lgt('Tweeting any toot (user timeline is empty right now)')
+        checkpoint = self.get_checkpoint()
+
+        if checkpoint is not None and config.CATCH_UP:
+            self.since_toot_id = checkpoint
+            self.missed_statuses = self.fetch_statuses_since(checkpoint)
+            lgt('Tweeting any toot after toot %s (%d toots posted since the last run)',
+                self.since_toot_id, len(self.missed_statuses))
+        else:
+            try:
+                self.since_toot_id = self.mastodon_api.account_statuses(self.ma_account_id, limit=1)[0]["id"]
+                self.set_checkpoint(self.since_toot_id)
+                lgt('Tweeting any toot after toot %s', self.since_toot_id)
+            except IndexError:
+                lgt('Tweeting any toot (user timeline is empty right now)')
 
         self.update_twitter_link_length()
 
+    def fetch_statuses_since(self, since_id):
+        """
+        Fetches our toots posted after a toot, by pages as large as possible.
+        :param since_id: The toot ID.
+        :return: The toots, oldest first (at most CATCH_UP_MAX_STATUSES, the most recent ones).
+        """
+        toots = []
+        max_id = None
+
+        while len(toots) < config.CATCH_UP_MAX_STATUSES:
+            page = self.mastodon_api.account_statuses(self.ma_account_id, since_id=since_id, max_id=max_id,
+                                                      limit=self.CATCH_UP_PAGE_SIZE)
+            if not page:
+                break
+
+            toots.extend(page)
+            max_id = page[-1]['id']
+
+            if len(page) < self.CATCH_UP_PAGE_SIZE:
+                break
+
+        if len(toots) > config.CATCH_UP_MAX_STATUSES:
+            toots = toots[:config.CATCH_UP_MAX_STATUSES]
+            lgt('Too many toots posted since the last run, only the last %d will be tweeted', len(toots))
+
+        return toots[::-1]
+
     def update_twitter_link_length(self):
-        if time.time() - self.last_url_len_update > 60 * 60 * 24:
-            self.twitter_api._config = None
-            self.url_length = max(self.twitter_api.GetShortUrlLength(False),
-                                  self.twitter_api.GetShortUrlLength(True)) + 1
-            self.last_url_len_update = time.time()
-            lgt(f'Updated expected short URL length - it is now {self.url_length} characters.')
+        # Cached, and refreshed in the background (see PlatformMetadata)
+        url_length = self.metadata.short_url_length
+        if url_length != self.url_length:
+            self.url_length = url_length
+            lgt('Updated expected short URL length - it is now %d characters.', self.url_length)
 
     @staticmethod
     def _are_same_accounts(first, other):
@@ -74,161 +122,201 @@ class TwitterPublisher(MTTThread):
     def is_from_us(self, account):
         return self._are_same_accounts(self.account, account)
 
-    def run(self):
-        self.init_process()
+    def process_status(self, toot):
+        """
+        Crossposts a toot to Twitter.
+        :param toot: The toot, as received from the stream.
+        """
+        # python-twitter is slow to import, and only needed once the process is started
+        from twitter import TwitterError
+
+        toot_id = toot["id"]
+
+        # The statuses we sent are only remembered in memory: after a restart,
+        # a toot caught up or resumed may be a crosspost of a tweet, or be
+        # already tweeted. Both are in the associations store.
+        if self.status_associations.get_tweet_id(toot_id) is not None:
+            lgt('Skipping toot %s - already associated with a tweet', toot_id)
+            return
+
+        # Avoids bouncing tweets/toots. If we are sending toots, this waits
+        # for them to be marked as sent, as this may be the echo of one.
+        if self.is_toot_sent_by_us(toot_id):
+            return
+
+        if toot['visibility'] not in config.TOOT_VISIBILITY_REQUIRED_TO_TRANSFER:
+            lgt('Skipping toot %s - invalid visibility (%s)', toot['id'], toot['visibility'])
+            return
+
+        content = toot["content"]
+        media_attachments = toot["media_attachments"]
+
+        if toot['reblogged'] and 'reblog' in toot:
+            reblog = toot['reblog']
+            reblog_name = f'@{reblog["account"]["username"]}@{urlparse(reblog["account"]["url"]).netloc}'
+            content = f'\U0001f501 RT {reblog_name}\n' \
+                      f'{reblog["content"]}\n\n' \
+                      f'{reblog["url"]}'
+            media_attachments = reblog["media_attachments"]
+
+            toot = reblog
+
+        # We trust mastodon to return valid HTML
+        with metrics.timed('convert', self.destination):
+            content_clean = self.toot_converter.convert(content)
+
+        # Don't cross-post replies
+        if len(content_clean) != 0 and content_clean[0] == '@':
+            lgt('Skipping toot "%s" - is a reply.', StatusText(content_clean))
+            return
+
+        if config.TWEET_CW_PREFIX and toot['spoiler_text']:
+            content_clean = config.TWEET_CW_PREFIX.format(toot['spoiler_text']) + content_clean
+
+        with metrics.timed('split_status', self.destination):
+            content_parts = split_status(
+                status=content_clean,
+                max_length=280,
+                split=config.SPLIT_ON_TWITTER,
+                url=toot['uri']
+            )
+
+        # Tweet all the parts. On error, the toot is retried later.
+        try:
+            reply_to = None
+
+            # We check if this toot is a reply to a previously sent toot.
+            # If so, the first corresponding tweet will be a reply to
+            # the stored tweet.
+            # Unlike in the Mastodon API calls, we don't have to handle the
+            # case where the tweet was deleted, as twitter will ignore
+            # the in_reply_to_status_id option if the given tweet
+            # does not exists.
+            reply_to = self.status_associations.get_tweet_id(toot['in_reply_to_id'])
+
+            # Parts already tweeted before a restart are not tweeted again
+            posted_parts = self.get_posted_parts(toot_id)
+            tweet_ids = []
+
+            for i in range(len(content_parts)):
+                if i in posted_parts:
+                    reply_to = posted_parts[i]
+                    tweet_ids.append(reply_to)
+                    continue
+
+                media_ids = []
+                content_tweet = content_parts[i]
+
+                # Last content part: Upload media, no -- at the end
+                if i == len(content_parts) - 1:
+                    media_ids = self.transfer_medias(
+                        media_urls=[attachment["url"] for attachment in media_attachments],
+                        to='twitter'
+                    )
+
+                    content_tweet = content_parts[i]
+
+                # Some final cleaning
+                content_tweet = content_tweet.strip()
+
+                lgt('Sending tweet "%s"…', StatusText(content_tweet))
+
+                # Until the tweet ID is marked as sent, its echo waits
+                with self.sending_tweet():
+                    # On error, the toot is retried later from this part
+                    try:
+                        with metrics.timed('post', self.destination):
+                            if len(media_ids) == 0:
+                                reply_to = self.twitter_api.PostUpdate(
+                                    content_tweet,
+                                    in_reply_to_status_id=reply_to
+                                ).id
+                            else:
+                                reply_to = self.twitter_api.PostUpdate(
+                                    content_tweet,
+                                    media=media_ids,
+                                    in_reply_to_status_id=reply_to
+                                ).id
+                    except (TwitterError, requests.RequestException) as e:
+                        raise RetryLater(f'Unable to send the tweet: {e}.', retry_after=get_retry_after(e))
+
+                    self.mark_tweet_sent(reply_to)
+                tweet_ids.append(reply_to)
+
+                self.mark_part_posted(toot_id, i, reply_to)
+
+                lgt('Tweet sent successfully.')
+
+            # Every tweet is linked to the toot (so their echoes are recognized
+            # after a restart), the last one last, as replies are attached to it.
+            # Only done once all are sent: associated toots are not crossposted again.
+            for tweet_id in tweet_ids:
+                self.associate_status(toot_id, tweet_id)
+
+        except RetryLater:
+            raise
+
+        except Exception as e:
+            lgt('Unhandled exception happened - giving up on this toot: %s', e, level=logging.ERROR, exc_info=e)
+
+        # From times to times we update the Twitter URL length.
+        self.update_twitter_link_length()
 
-        lgt('Listening for toots…')
+    def listen(self, callback, heartbeat=None):
+        """
+        Listens for our toots and hands them to the callback. Blocks while the
+        stream is open.
+        :param callback: A function called with each toot.
+        :param heartbeat: A function called for each event of the stream (heartbeats included).
+        """
+        stream_filter = self.stream_filter
 
         class TootsListener(StreamListener):
             def __init__(self, publisher):
                 self.publisher = publisher
 
+            def _dispatch(self, event):
+                # Mastodon.py decodes the events here; toots which can't be ours are
+                # dropped before. This is a private method of Mastodon.py, so its
+                # version is pinned in requirements.txt.
+                if heartbeat:
+                    heartbeat()
+
+                if isinstance(event, dict) and event.get('event') == 'update' \
+                        and not stream_filter.may_be_ours(event.get('data', '')):
+                    return
+
+                super(TootsListener, self)._dispatch(event)
+
             def on_update(self, toot):
                 # We only transfer our own toots, but the streaming endpoint receives the whole
                 # timeline.
                 if not self.publisher.is_from_us(toot['account']):
+                    stream_filter.reject()
                     return
 
-                # Avoids a race condition.
-                # We wait a little bit so tweets sent to Mastodon
-                # can be marked as such before this run, avoiding
-                # bouncing tweets/toots.
-                time.sleep(config.STATUS_PROCESS_DELAY)
-
-                toot_id = toot["id"]
-
-                if self.publisher.is_toot_sent_by_us(toot_id):
-                    return
-
-                if toot['visibility'] not in config.TOOT_VISIBILITY_REQUIRED_TO_TRANSFER:
-                    lgt(f'Skipping toot {toot["id"]} - invalid visibility ({toot["visibility"]})')
-                    return
-
-                content = toot["content"]
-                media_attachments = toot["media_attachments"]
-
-                if toot['reblogged'] and 'reblog' in toot:
-                    reblog = toot['reblog']
-                    reblog_name = f'@{reblog["account"]["username"]}@{urlparse(reblog["account"]["url"]).netloc}'
-                    content = f'\U0001f501 RT {reblog_name}\n' \
-                              f'{reblog["content"]}\n\n' \
-                              f'{reblog["url"]}'
-                    media_attachments = reblog["media_attachments"]
-
-                    toot = reblog
-
-                # We trust mastodon to return valid HTML
-                content_clean = re.sub(r'<a [^>]*href="([^"]+)">[^<]*</a>', '\g<1>', content)
-
-                # We replace html br with new lines
-                content_clean = "\n".join(re.compile(r'<br ?/?>', re.IGNORECASE).split(content_clean))
-                # We must also replace new paragraphs with double line skips
-                content_clean = "\n\n".join(re.compile(r'</p><p>', re.IGNORECASE).split(content_clean))
-                # Then we can delete the other html contents and unescape the string
-                content_clean = html.unescape(str(re.compile(r'<.*?>').sub("", content_clean).strip()))
-                # Trim out media URLs
-                content_clean = re.sub(self.publisher.MEDIA_REGEXP, "", content_clean)
-
-                # Don't cross-post replies
-                if len(content_clean) != 0 and content_clean[0] == '@':
-                    lgt('Skipping toot "' + content_clean + '" - is a reply.')
-                    return
+                stream_filter.accept()
+                callback(toot)
 
-                if config.TWEET_CW_PREFIX and toot['spoiler_text']:
-                    content_clean = config.TWEET_CW_PREFIX.format(toot['spoiler_text']) + content_clean
-
-                content_parts = split_status(
-                    status=content_clean,
-                    max_length=280,
-                    split=config.SPLIT_ON_TWITTER,
-                    url=toot['uri']
-                )
-
-                # Tweet all the parts. On error, give up and go on with the next toot.
-                try:
-                    reply_to = None
-
-                    # We check if this toot is a reply to a previously sent toot.
-                    # If so, the first corresponding tweet will be a reply to
-                    # the stored tweet.
-                    # Unlike in the Mastodon API calls, we don't have to handle the
-                    # case where the tweet was deleted, as twitter will ignore
-                    # the in_reply_to_status_id option if the given tweet
-                    # does not exists.
-                    if toot['in_reply_to_id'] in self.publisher.status_associations['m2t']:
-                        reply_to = self.publisher.status_associations['m2t'][toot['in_reply_to_id']]
-
-                    for i in range(len(content_parts)):
-                        media_ids = []
-                        content_tweet = content_parts[i]
-
-                        # Last content part: Upload media, no -- at the end
-                        if i == len(content_parts) - 1:
-                            for attachment in media_attachments:
-                                media_ids.append(self.publisher.transfer_media(
-                                    media_url=attachment["url"],
-                                    to='twitter'
-                                ))
-
-                            content_tweet = content_parts[i]
-
-                        # Some final cleaning
-                        content_tweet = content_tweet.strip()
-
-                        # Retry three times before giving up
-                        retry_counter = 0
-                        post_success = False
-
-                        lgt(f'Sending tweet "{content_tweet}"…')
-
-                        while not post_success:
-                            try:
-                                if len(media_ids) == 0:
-                                    reply_to = self.publisher.twitter_api.PostUpdate(
-                                        content_tweet,
-                                        in_reply_to_status_id=reply_to
-                                    ).id
-
-                                    self.publisher.mark_tweet_sent(reply_to)
-                                    since_tweet_id = reply_to
-                                    post_success = True
-
-                                else:
-                                    reply_to = self.publisher.twitter_api.PostUpdate(
-                                        content_tweet,
-                                        media=media_ids,
-                                        in_reply_to_status_id=reply_to
-                                    ).id
-
-                                    self.publisher.mark_tweet_sent(reply_to)
-                                    since_tweet_id = reply_to
-                                    post_success = True
-
-                            except TwitterError:
-                                if retry_counter < config.MASTODON_RETRIES:
-                                    retry_counter += 1
-                                    time.sleep(config.MASTODON_RETRY_DELAY)
-                                else:
-                                    raise
-
-                        lgt('Tweet sent successfully.')
-
-                        # Only the last tweet is linked to the toot, see comment
-                        # above the status_associations declaration
-                        if i == len(content_parts) - 1:
-                            with lock:
-                                self.publisher.associate_status(toot_id, since_tweet_id)
-                                self.publisher.save_status_associations()
-
-                except Exception as e:
-                    lgt("Encountered error after " + str(config.MASTODON_RETRIES) + " retries. Not retrying.")
-                    print(e)
-
-                # From times to times we update the Twitter URL length.
-                self.publisher.update_twitter_link_length()
+            def handle_heartbeat(self):
+                if heartbeat:
+                    heartbeat()
 
         # Compatibility with multiple versions of Mastodon.py
         try:
-            self.mastodon_api.stream_user(TootsListener(self), async=False)
+            # Without heartbeat for this long, the stream is stalled: the read times out.
+            self.mastodon_api.stream_user(TootsListener(self), timeout=config.STREAM_STALL_TIMEOUT)
         except AttributeError:
-            self.mastodon_api.user_stream(TootsListener(self), async=False)
+            self.mastodon_api.user_stream(TootsListener(self))
+
+    @staticmethod
+    def get_reply_ids(toot):
+        """
+        :param toot: A toot.
+        :return: A (toot ID, ID of the toot it replies to or None) tuple.
+        """
+        return toot['id'], toot['in_reply_to_id']
+
+    def run(self):
+        self.init_process()
+        self.process_stream()
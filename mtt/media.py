@@ -0,0 +1,303 @@
+import hashlib
+import json
+import mimetypes
+import os
+import time
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import SpooledTemporaryFile
+from threading import Lock
+
+from mtt import config
+from mtt.connections import get_session
+
+
+class MediaFile(SpooledTemporaryFile):
+    """
+    A media being transferred.
+
+    The media is kept in memory while it is small, and spilled to a
+    temporary file on disk once it grows over `max_size` bytes, so memory
+    usage is bounded regardless of the media size.
+
+    Unlike a plain SpooledTemporaryFile, it always has a name (with an
+    extension matching its content type) and a binary mode, as the
+    python-twitter upload API relies on them to detect the media type.
+    """
+
+    def __init__(self, content_type, max_size):
+        super(MediaFile, self).__init__(max_size=max_size, mode='w+b')
+
+        self.content_type = content_type
+        self.file_name = 'media' + (mimetypes.guess_extension(content_type) or '')
+        self.hash = hashlib.sha256()
+
+    def write(self, data):
+        self.hash.update(data)
+        return super(MediaFile, self).write(data)
+
+    @property
+    def digest(self):
+        """
+        :return: The SHA-256 of the content written so far.
+        """
+        return self.hash.hexdigest()
+
+    @property
+    def name(self):
+        return self.file_name
+
+
+class MediaCache:
+    """
+    Remembers the media IDs of the medias we uploaded, so identical medias
+    (boosted, retweeted or re-posted) are not downloaded and uploaded again.
+
+    Uploaded medias are indexed both by source URL and by content hash; a hit
+    on the URL skips the download and the upload, a hit on the content skips
+    the upload. Entries expire after a platform-specific delay (uploaded
+    medias are only usable for a limited time) and the least recently used
+    entries are evicted when the cache is full.
+
+    The index is persisted on disk so it survives restarts, as a log of
+    entries (one JSON line per entry) appended to on each upload. The log is
+    compacted (rewritten with only the live entries) when it grows to more
+    than twice the size of the cache.
+    """
+
+    # The log is never compacted under this many lines.
+    MIN_COMPACTION_SIZE = 1000
+
+    def __init__(self, path, ttl, max_size=1000):
+        """
+        :param path: The path of the on-disk index. None to keep it in memory only.
+        :param ttl: A dict mapping each platform to how long (seconds) its media
+                    IDs can be reused. A platform with no or a zero TTL is not cached.
+        :param max_size: The maximal amount of entries.
+        """
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+        self.url_hits = 0
+        self.content_hits = 0
+        self.misses = 0
+
+        self.log = None
+        self.log_lines = 0
+
+        if path:
+            self._load()
+            self._compact()
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Truncated last line after a crash
+                        continue
+
+                    if record and isinstance(record[0], list):
+                        # Old format: the whole index as a single JSON list
+                        self.entries.update((key, tuple(entry)) for key, entry in record)
+                    elif len(record) == 3:
+                        key, media_id, expires_at = record
+                        self.entries[key] = (media_id, expires_at)
+                        self.entries.move_to_end(key)
+        except OSError:
+            pass
+
+        now = time.time()
+        for key in [key for key, (_, expires_at) in self.entries.items() if expires_at <= now]:
+            del self.entries[key]
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    @staticmethod
+    def _key(to, owner, kind, value):
+        return f'{to}:{owner}:{kind}:{value}'
+
+    def get(self, to, owner, url=None, digest=None):
+        """
+        Looks up an uploaded media.
+
+        :param to: The destination platform.
+        :param owner: The account owning the uploaded medias on this platform.
+        :param url: The source URL of the media, if looking up by URL.
+        :param digest: The content hash of the media, if looking up by content.
+        :return: The media ID on the destination platform, or None.
+        """
+        if not self.ttl.get(to):
+            return None
+
+        key = self._key(to, owner, 'url', url) if url is not None else self._key(to, owner, 'sha256', digest)
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] > time.time():
+                self.entries.move_to_end(key)
+                if url is not None:
+                    self.url_hits += 1
+                else:
+                    self.content_hits += 1
+                return entry[0]
+
+            if entry is not None:
+                del self.entries[key]
+
+            # A URL miss is followed by a content lookup, only the latter counts.
+            if url is None:
+                self.misses += 1
+
+            return None
+
+    def put(self, to, owner, media_id, url, digest):
+        """
+        Remembers an uploaded media.
+
+        :param to: The destination platform.
+        :param owner: The account owning the uploaded medias on this platform.
+        :param media_id: The media ID on the destination platform.
+        :param url: The source URL of the media.
+        :param digest: The content hash of the media.
+        """
+        if not self.ttl.get(to):
+            return
+
+        expires_at = time.time() + self.ttl[to]
+
+        with self.lock:
+            for key in (self._key(to, owner, 'url', url), self._key(to, owner, 'sha256', digest)):
+                self.entries[key] = (media_id, expires_at)
+                self.entries.move_to_end(key)
+                self._append(key, media_id, expires_at)
+
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+            if self.log_lines > max(self.MIN_COMPACTION_SIZE, 2 * self.max_size):
+                self._compact()
+
+    def _append(self, key, media_id, expires_at):
+        if self.log is None:
+            return
+
+        try:
+            self.log.write(json.dumps([key, media_id, expires_at]) + '\n')
+            self.log.flush()
+            self.log_lines += 1
+        except OSError:
+            pass
+
+    def _compact(self):
+        """
+        Rewrites the log with the live entries only.
+        """
+        try:
+            temp_path = f'{self.path}.tmp'
+            with open(temp_path, 'w') as f:
+                for key, (media_id, expires_at) in self.entries.items():
+                    f.write(json.dumps([key, media_id, expires_at]) + '\n')
+            os.replace(temp_path, self.path)
+
+            if self.log is not None:
+                self.log.close()
+            self.log = open(self.path, 'a')
+            self.log_lines = len(self.entries)
+        except OSError:
+            pass
+
+    @property
+    def stats(self):
+        """
+        :return: A dict with the cache size, hits, misses and hit rate.
+        """
+        with self.lock:
+            hits = self.url_hits + self.content_hits
+            return {
+                'size': len(self.entries),
+                'url_hits': self.url_hits,
+                'content_hits': self.content_hits,
+                'misses': self.misses,
+                'hit_rate': hits / (hits + self.misses) if hits + self.misses else 0.0
+            }
+
+
+_cache = None
+_cache_lock = Lock()
+
+_executor = None
+_executor_lock = Lock()
+
+
+def get_media_cache():
+    """
+    :return: The uploaded medias cache shared by all media transfers, loaded on first use.
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = MediaCache(config.FILES['media_cache'], ttl=config.MEDIA_CACHE_TTL,
+                                max_size=config.MEDIA_CACHE_SIZE)
+        return _cache
+
+
+def get_media_executor():
+    """
+    :return: The worker pool shared by all media transfers, created on first use.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=config.MEDIA_TRANSFER_WORKERS, thread_name_prefix='Medias')
+        return _executor
+
+
+def download_media(media_url):
+    """
+    Downloads a media, streaming it in fixed-size chunks.
+
+    :param media_url: The media URL.
+    :return: A MediaFile, rewound. The caller has to close it.
+    """
+    with get_session().get(media_url, stream=True, timeout=config.MEDIA_TIMEOUT) as response:
+        response.raise_for_status()
+
+        content_type = response.headers.get('Content-Type', 'application/octet-stream').split(';')[0].strip()
+        media_file = MediaFile(content_type, max_size=config.MEDIA_SPOOL_MAX_MEMORY)
+
+        try:
+            # iter_content decodes any transfer content-encoding (gzip...) on the fly
+            for chunk in response.iter_content(chunk_size=config.MEDIA_CHUNK_SIZE):
+                media_file.write(chunk)
+        except Exception:
+            media_file.close()
+            raise
+
+    media_file.seek(0)
+    return media_file
+
+
+def upload_media(media_file, to, twitter_api, mastodon_api):
+    """
+    Uploads a downloaded media.
+
+    :param media_file: The MediaFile to upload.
+    :param to: The destination ('twitter' or 'mastodon', else ValueError is raised)
+    :param twitter_api: The Twitter API client.
+    :param mastodon_api: The Mastodon API client.
+    :return: The media ID on the destination platform.
+    """
+    if to == 'twitter':
+        # Read and sent by chunks by python-twitter.
+        return twitter_api.UploadMediaChunked(media=media_file)
+    elif to == 'mastodon':
+        return mastodon_api.media_post(media_file, mime_type=media_file.content_type)['id']
+    else:
+        raise ValueError(f'Unknown platform "{to}"')
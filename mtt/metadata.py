@@ -0,0 +1,175 @@
+import json
+import logging
+import os
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, Thread
+
+from mtt.logs import log
+
+
+class PlatformMetadata:
+    """
+    Caches what the crossposter needs to know about the platforms and the
+    accounts of a pair: both accounts, the Mastodon instance (statuses and
+    medias limits) and the Twitter configuration (short URLs length, medias
+    constraints).
+
+    Entries are persisted on disk, so a restart does not wait for them.
+    Missing entries are fetched concurrently, when the pair is loaded;
+    entries older than `ttl` are still used, and refreshed in the background.
+    """
+
+    def __init__(self, clients, path, ttl=60 * 60 * 24):
+        """
+        :param clients: The API clients of the pair.
+        :param path: The path of the on-disk cache. None to keep it in memory only.
+        :param ttl: How long (seconds) an entry is used before it is refreshed.
+        """
+        self.clients = clients
+        self.path = path
+        self.ttl = ttl
+
+        # Key -> (value, when it was fetched)
+        self.entries = {}
+        self.lock = Lock()
+        self.refreshing = set()
+
+        self.fetches = 0
+        self.refresh_errors = 0
+
+        self.fetchers = {
+            'mastodon_account': lambda: self.clients.mastodon.account_verify_credentials(),
+            'twitter_account': lambda: self.clients.twitter.VerifyCredentials().AsDict(),
+            'mastodon_instance': lambda: self.clients.mastodon.instance(),
+            'twitter_configuration': self._fetch_twitter_configuration
+        }
+
+        if path and os.path.isfile(path):
+            try:
+                with open(path, 'r') as f:
+                    self.entries.update((key, tuple(entry)) for key, entry in json.load(f).items()
+                                        if key in self.fetchers)
+            except (OSError, ValueError):
+                pass
+
+    def _fetch_twitter_configuration(self):
+        # python-twitter caches the configuration forever
+        self.clients.twitter._config = None
+        return self.clients.twitter.GetHelpConfiguration()
+
+    def load(self):
+        """
+        Fetches the missing entries, all at once. Stale entries are
+        refreshed in the background.
+        """
+        with self.lock:
+            missing = [key for key in self.fetchers if key not in self.entries]
+
+        if missing:
+            with ThreadPoolExecutor(max_workers=len(missing), thread_name_prefix='Metadata') as executor:
+                values = list(executor.map(lambda key: self.fetchers[key](), missing))
+
+            with self.lock:
+                fetched_at = time.time()
+                for key, value in zip(missing, values):
+                    self.entries[key] = (value, fetched_at)
+                self.fetches += len(missing)
+                self._save()
+
+        for key in self.fetchers:
+            self.get(key)
+
+    def get(self, key):
+        """
+        :param key: The entry key (mastodon_account, twitter_account,
+                    mastodon_instance or twitter_configuration).
+        :return: The entry value. Fetched if missing; refreshed in the
+                 background if stale.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                value, fetched_at = entry
+                if time.time() - fetched_at > self.ttl and key not in self.refreshing:
+                    self.refreshing.add(key)
+                    Thread(target=self._refresh, args=(key,), name='Metadata', daemon=True).start()
+                return value
+
+        value = self.fetchers[key]()
+
+        with self.lock:
+            self.entries[key] = (value, time.time())
+            self.fetches += 1
+            self._save()
+
+        return value
+
+    def _refresh(self, key):
+        try:
+            value = self.fetchers[key]()
+        except Exception as e:
+            # The stale value is still used, and refreshed again on next use
+            log('Metadata', logging.WARNING, 'Unable to refresh %s, keeping the cached one: %s', key, e)
+            with self.lock:
+                self.refresh_errors += 1
+                self.entries[key] = (self.entries[key][0], time.time() - self.ttl + 60)
+            return
+        finally:
+            with self.lock:
+                self.refreshing.discard(key)
+
+        with self.lock:
+            self.entries[key] = (value, time.time())
+            self.fetches += 1
+            self._save()
+
+    def _save(self):
+        if not self.path:
+            return
+
+        try:
+            temp_path = f'{self.path}.tmp'
+            with open(temp_path, 'w') as f:
+                json.dump(self.entries, f, default=str)
+            os.replace(temp_path, self.path)
+        except OSError:
+            pass
+
+    @property
+    def mastodon_account(self):
+        return self.get('mastodon_account')
+
+    @property
+    def twitter_account(self):
+        return self.get('twitter_account')
+
+    @property
+    def mastodon_instance(self):
+        return self.get('mastodon_instance')
+
+    @property
+    def twitter_configuration(self):
+        return self.get('twitter_configuration')
+
+    @property
+    def short_url_length(self):
+        """
+        :return: The length of the URLs once shortened by Twitter (http or
+                 https, the longest), plus one for safety.
+        """
+        configuration = self.twitter_configuration
+        return max(configuration['short_url_length'], configuration['short_url_length_https']) + 1
+
+    @property
+    def stats(self):
+        """
+        :return: A dict with the cache size, the fetches and the refresh errors.
+        """
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'fetches': self.fetches,
+                'refresh_errors': self.refresh_errors
+            }
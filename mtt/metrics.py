@@ -0,0 +1,390 @@
+import json
+import os
+import time
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+
+
+# Upper bounds of the latency histograms buckets (seconds)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+class Histogram:
+    """
+    Counts observations in fixed buckets, like Prometheus histograms.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        """
+        :param buckets: The upper bounds of the buckets, sorted.
+        """
+        self.buckets = buckets
+        # The last count is for the observations above the last bound
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self):
+        """
+        :return: A list of (upper bound, observations up to it) tuples; the last bound is '+Inf'.
+        """
+        counts = []
+        total = 0
+        for bound, count in zip(list(self.buckets) + ['+Inf'], self.counts):
+            total += count
+            counts.append((bound, total))
+        return counts
+
+
+class Metrics:
+    """
+    Collects the metrics of the crossposter: a latency histogram per
+    pipeline stage, counters, and gauges read when the metrics are exported.
+
+    Recording a value is a dict lookup and a few additions under a lock, so
+    metrics are always recorded; they are only exported if enabled.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        # (stage, destination) -> Histogram
+        self.stages = {}
+        # (stage, destination) -> number of errors
+        self.stage_errors = {}
+        # (name, labels) -> value
+        self.counters = {}
+        # Name -> (description, function returning a list of (labels, value))
+        self.gauges = {}
+        # Same, for counters kept by the components themselves (read like gauges)
+        self.collected_counters = {}
+
+    def observe(self, stage, duration, destination=None):
+        """
+        Records the duration of a pipeline stage.
+        :param stage: The stage name.
+        :param duration: The duration (seconds).
+        :param destination: The platform statuses are crossposted to.
+        """
+        with self.lock:
+            histogram = self.stages.get((stage, destination))
+            if histogram is None:
+                histogram = self.stages[(stage, destination)] = Histogram()
+            histogram.observe(duration)
+
+    @contextmanager
+    def timed(self, stage, destination=None):
+        """
+        Records the duration of the enclosed block as a pipeline stage; if it
+        raises, an error of this stage is counted too.
+        :param stage: The stage name.
+        :param destination: The platform statuses are crossposted to.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            with self.lock:
+                self.stage_errors[(stage, destination)] = self.stage_errors.get((stage, destination), 0) + 1
+            raise
+        finally:
+            self.observe(stage, time.perf_counter() - start, destination)
+
+    def increment(self, name, value=1, **labels):
+        """
+        Increments a counter.
+        :param name: The counter name.
+        :param value: The increment.
+        :param labels: The labels of the counter.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def register_gauge(self, name, description, collect):
+        """
+        Registers a gauge, read when the metrics are exported.
+        :param name: The gauge name.
+        :param description: The gauge description.
+        :param collect: A function returning a list of (labels dict, value) tuples.
+        """
+        with self.lock:
+            self.gauges[name] = (description, collect)
+
+    def register_counter(self, name, description, collect):
+        """
+        Registers a counter kept by a component (e.g. in its stats), read when
+        the metrics are exported. Its values only increase.
+        :param name: The counter name, without the _total suffix.
+        :param description: The counter description.
+        :param collect: A function returning a list of (labels dict, value) tuples.
+        """
+        with self.lock:
+            self.collected_counters[f'{name}_total'] = (description, collect)
+
+    @staticmethod
+    def _collect(registry):
+        values = {}
+        for name, (description, collect) in list(registry.items()):
+            try:
+                values[name] = (description, [(labels, value) for labels, value in collect() if value is not None])
+            except Exception:
+                # A broken metric must not break the others
+                continue
+        return values
+
+    def render(self):
+        """
+        :return: The metrics, in the Prometheus text exposition format.
+        """
+        with self.lock:
+            stages = {key: (histogram.cumulative_counts(), histogram.sum, histogram.count)
+                      for key, histogram in self.stages.items()}
+            stage_errors = dict(self.stage_errors)
+            counters = dict(self.counters)
+
+        lines = [
+            '# HELP mtt_stage_duration_seconds Duration of the crossposting pipeline stages.',
+            '# TYPE mtt_stage_duration_seconds histogram'
+        ]
+        for (stage, destination), (counts, total, count) in sorted(stages.items(), key=_sort_key):
+            labels = _labels(stage=stage, destination=destination)
+            for bound, cumulative in counts:
+                bucket_labels = _labels(stage=stage, destination=destination, le=bound)
+                lines.append(f'mtt_stage_duration_seconds_bucket{bucket_labels} {cumulative}')
+            lines.append(f'mtt_stage_duration_seconds_sum{labels} {total}')
+            lines.append(f'mtt_stage_duration_seconds_count{labels} {count}')
+
+        lines.append('# HELP mtt_stage_errors_total Pipeline stages failures.')
+        lines.append('# TYPE mtt_stage_errors_total counter')
+        for (stage, destination), errors in sorted(stage_errors.items(), key=_sort_key):
+            lines.append(f'mtt_stage_errors_total{_labels(stage=stage, destination=destination)} {errors}')
+
+        for name in sorted({name for name, _ in counters}):
+            lines.append(f'# TYPE {name} counter')
+            for (counter_name, labels), value in sorted(counters.items(), key=_sort_key):
+                if counter_name == name:
+                    lines.append(f'{name}{_labels(**dict(labels))} {value}')
+
+        for kind, registry in (('counter', self.collected_counters), ('gauge', self.gauges)):
+            for name, (description, values) in sorted(self._collect(registry).items()):
+                lines.append(f'# HELP {name} {description}')
+                lines.append(f'# TYPE {name} {kind}')
+                for labels, value in values:
+                    lines.append(f'{name}{_labels(**labels)} {float(value)}')
+
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        """
+        :return: The metrics, as a JSON-serializable dict. Histograms are
+                 summarized by their count, mean, and approximate percentiles.
+        """
+        with self.lock:
+            stages = {key: (histogram.cumulative_counts(), histogram.sum, histogram.count)
+                      for key, histogram in self.stages.items()}
+            stage_errors = dict(self.stage_errors)
+            counters = dict(self.counters)
+
+        snapshot = {'stages': {}, 'counters': {}, 'gauges': {}}
+
+        for (stage, destination), (counts, total, count) in sorted(stages.items(), key=_sort_key):
+            snapshot['stages'][f'{stage} ({destination})' if destination else stage] = {
+                'count': count,
+                'errors': stage_errors.get((stage, destination), 0),
+                'mean': total / count if count else 0.0,
+                'p50': _percentile(counts, count, 0.5),
+                'p99': _percentile(counts, count, 0.99)
+            }
+
+        for (name, labels), value in sorted(counters.items(), key=_sort_key):
+            snapshot['counters'][name + _labels(**dict(labels))] = value
+
+        for name, (_, values) in sorted(self._collect(self.collected_counters).items()):
+            for labels, value in values:
+                snapshot['counters'][name + _labels(**labels)] = value
+
+        for name, (_, values) in sorted(self._collect(self.gauges).items()):
+            for labels, value in values:
+                snapshot['gauges'][name + _labels(**labels)] = value
+
+        return snapshot
+
+
+def _sort_key(item):
+    return str(item[0])
+
+
+def _labels(**labels):
+    labels = {name: value for name, value in labels.items() if value is not None}
+    if not labels:
+        return ''
+
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in labels.items()) + '}'
+
+
+def _percentile(counts, count, quantile):
+    """
+    :return: The upper bound of the bucket containing the given quantile (None if above the last one).
+    """
+    if not count:
+        return None
+    for bound, cumulative in counts:
+        if cumulative >= quantile * count:
+            return bound if bound != '+Inf' else None
+    return None
+
+
+metrics = Metrics()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        body = metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are not worth logging
+        pass
+
+
+def serve_metrics(host, port):
+    """
+    Serves the metrics in the Prometheus text format at http://host:port/metrics, in a background thread.
+    :param host: The address to listen on.
+    :param port: The port to listen on.
+    :return: The server.
+    """
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, name='Metrics', daemon=True).start()
+    return server
+
+
+def write_metrics_periodically(path, interval):
+    """
+    Writes a JSON snapshot of the metrics to a file every `interval` seconds, in a background thread.
+    :param path: The file path. It is replaced atomically.
+    :param interval: The delay between writes (seconds).
+    """
+    def write():
+        while True:
+            time.sleep(interval)
+            try:
+                temp_path = f'{path}.tmp'
+                with open(temp_path, 'w') as f:
+                    json.dump(metrics.snapshot(), f, indent=2)
+                os.replace(temp_path, path)
+            except OSError:
+                pass
+
+    Thread(target=write, name='Metrics', daemon=True).start()
+
+
+def watch(account_pairs, publishers):
+    """
+    Registers the gauges and counters of the account pairs and publishers
+    state: queues, streams (and their events), sent statuses trackers,
+    associations, rate limits and medias cache.
+    :param account_pairs: The account pairs (loaded).
+    :param publishers: Their publishers.
+    """
+    from mtt.connections import get_adapter
+    from mtt.media import get_media_cache
+
+    def from_stats(objects, attribute, key):
+        def collect():
+            values = []
+            for name, obj in objects():
+                component = getattr(obj, attribute, None)
+                if component is not None:
+                    values.append(({'publisher': name}, component.stats[key]))
+            return values
+        return collect
+
+    def each_publisher():
+        return [(publisher.name, publisher) for publisher in publishers]
+
+    for key, description in (('depth', 'Statuses queued to be crossposted.'),
+                             ('in_progress', 'Statuses being crossposted.'),
+                             ('retrying', 'Statuses waiting to be retried.')):
+        metrics.register_gauge(f'mtt_queue_{key}', description, from_stats(each_publisher, 'work_queue', key))
+
+    metrics.register_gauge('mtt_stream_connected', 'Whether the stream is connected.',
+                           from_stats(each_publisher, 'stream_supervisor', 'connected'))
+    metrics.register_gauge('mtt_stream_heartbeat_age_seconds', 'Time since the stream last sent something.',
+                           from_stats(each_publisher, 'stream_supervisor', 'heartbeat_age'))
+    metrics.register_counter('mtt_stream_reconnects', 'Stream reconnections.',
+                             from_stats(each_publisher, 'stream_supervisor', 'reconnects'))
+
+    metrics.register_counter(
+        'mtt_stream_events', 'Stream events accepted, rejected once decoded, and dropped before being decoded.',
+        lambda: [({'publisher': publisher.name, 'outcome': outcome}, count)
+                 for publisher in publishers if publisher.stream_filter is not None
+                 for outcome, count in publisher.stream_filter.stats.items()]
+    )
+
+    metrics.register_gauge(
+        'mtt_sent_status_size', 'IDs of the statuses sent remembered to avoid bounces.',
+        lambda: [({'pair': pair.name or 'default', 'network': network}, len(tracker))
+                 for pair in account_pairs for network, tracker in pair.sent_status.items()]
+    )
+    metrics.register_counter(
+        'mtt_echo_checks', 'Statuses received while posting on their platform (waits), and waits timed out.',
+        lambda: [({'pair': pair.name or 'default', 'network': network, 'state': state}, tracker.stats[key])
+                 for pair in account_pairs for network, tracker in pair.sent_status.items()
+                 for state, key in (('waited', 'echo_waits'), ('timed_out', 'echo_timeouts'))]
+    )
+    metrics.register_gauge(
+        'mtt_status_associations', 'Toots/tweets associations stored.',
+        lambda: [({'pair': pair.name or 'default'}, len(pair.status_associations)) for pair in account_pairs]
+    )
+
+    def from_global_stats(get_stats, label, keys):
+        def collect():
+            stats = get_stats()
+            return [({label: value}, stats[key]) for value, key in keys]
+        return collect
+
+    def rate_limiter_stats():
+        return get_adapter().rate_limiter.stats
+
+    def media_cache_stats():
+        return get_media_cache().stats
+
+    metrics.register_gauge(
+        'mtt_rate_limit', 'Rate limiter state (endpoints tracked and exhausted).',
+        from_global_stats(rate_limiter_stats, 'state', (('endpoints', 'endpoints'), ('exhausted', 'exhausted')))
+    )
+    metrics.register_counter(
+        'mtt_rate_limit_requests', 'Requests delayed or rejected by the rate limiter, and 429 responses.',
+        from_global_stats(rate_limiter_stats, 'outcome', (('waited', 'waits'), ('rejected', 'rejections'),
+                                                           ('throttled', 'throttled_responses')))
+    )
+    metrics.register_gauge(
+        'mtt_media_cache', 'Uploaded medias cache state (size and hit rate).',
+        from_global_stats(media_cache_stats, 'state', (('size', 'size'), ('hit_rate', 'hit_rate')))
+    )
+    metrics.register_counter(
+        'mtt_media_cache_lookups', 'Uploaded medias cache lookups.',
+        from_global_stats(media_cache_stats, 'result', (('url_hit', 'url_hits'), ('content_hit', 'content_hits'),
+                                                        ('miss', 'misses')))
+    )
@@ -0,0 +1,241 @@
+import json
+import os
+
+from threading import Condition, Thread
+
+from mtt.utils import lg
+
+
+class Outbox:
+    """
+    A write-ahead journal of the statuses being crossposted, so they are not
+    lost if the process dies before they are fully crossposted.
+
+    Each status accepted from a stream is recorded, then each part posted
+    (a long toot is posted as several tweets), and finally its completion.
+    At startup, the statuses accepted but not finished are resumed from the
+    first part not posted yet, without posting the other parts again.
+
+    The outbox also keeps a checkpoint per destination: the ID of the last
+    status accepted, so statuses posted while the process was not running
+    can be caught up.
+
+    Records are appended to the journal as JSON lines. Writes needing to be
+    durable wait for the next fsync, which is shared by all the writes done
+    in the meantime (group commit): a single background thread syncs the
+    journal while statuses are processed. The journal is compacted when it
+    is mostly made of finished statuses.
+    """
+
+    # The journal is compacted when it contains more than this many records,
+    # and more than four records per unfinished status.
+    COMPACT_THRESHOLD = 1000
+
+    def __init__(self, path):
+        """
+        :param path: The path of the journal.
+        """
+        self.path = path
+        self.condition = Condition()
+        self.closed = False
+
+        # (destination, status ID) -> {'status': the status, 'parts': {index: posted ID}}
+        self.unfinished = {}
+        # Destination -> ID of the last status accepted
+        self.checkpoints = {}
+
+        self.records = 0
+        self._load()
+        self._compact()
+
+        # Number of records written and synced, to know which writes a fsync covers
+        self.written = 0
+        self.synced = 0
+
+        self.flusher = Thread(target=self._flush, name='Outbox', daemon=True)
+        self.flusher.start()
+
+    def _load(self):
+        if not os.path.isfile(self.path):
+            return
+
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Record partially written when the process died
+                    continue
+
+                key = (record['to'], record['id'])
+
+                if record['op'] == 'accept':
+                    self.unfinished[key] = {'status': record['status'], 'parts': {}}
+                    self._advance_checkpoint(record['to'], record['id'])
+                elif record['op'] == 'checkpoint':
+                    self._advance_checkpoint(record['to'], record['id'])
+                elif record['op'] == 'part' and key in self.unfinished:
+                    self.unfinished[key]['parts'][record['index']] = record['posted_id']
+                elif record['op'] == 'finish':
+                    self.unfinished.pop(key, None)
+
+        if self.unfinished:
+            lg('Outbox', '%d statuses were not fully crossposted, they will be resumed', len(self.unfinished))
+
+    def _compact(self):
+        """
+        Rewrites the journal with the unfinished statuses only.
+        """
+        records = [{'op': 'checkpoint', 'to': to, 'id': status_id} for to, status_id in self.checkpoints.items()]
+        for (to, status_id), entry in self.unfinished.items():
+            records.append({'op': 'accept', 'to': to, 'id': status_id, 'status': entry['status']})
+            for index, posted_id in entry['parts'].items():
+                records.append({'op': 'part', 'to': to, 'id': status_id, 'index': index, 'posted_id': posted_id})
+
+        temp_path = f'{self.path}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            for record in records:
+                f.write(self._serialize(record))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+
+        self.file = open(self.path, 'a', encoding='utf-8')
+        self.records = len(records)
+
+    def _advance_checkpoint(self, to, status_id):
+        self.checkpoints[to] = max(self.checkpoints.get(to, 0), int(status_id))
+
+    @staticmethod
+    def _serialize(record):
+        # Statuses may contain dates
+        return json.dumps(record, default=str) + '\n'
+
+    def _write(self, record, sync):
+        with self.condition:
+            if self.closed:
+                # Statuses crossposted while stopping: resumed at the next start
+                return
+
+            self.file.write(self._serialize(record))
+            self.records += 1
+            self.written += 1
+            position = self.written
+            self.condition.notify_all()
+
+            if sync:
+                self.condition.wait_for(lambda: self.synced >= position or self.closed)
+
+    def _flush(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.written > self.synced or self.closed)
+                if self.closed and self.written == self.synced:
+                    return
+
+                position = self.written
+                self.file.flush()
+                file = self.file
+
+            # Other records can be written during the fsync; they will be synced by the next one.
+            os.fsync(file.fileno())
+
+            with self.condition:
+                self.synced = max(self.synced, position)
+                self.condition.notify_all()
+
+                if self.records > max(self.COMPACT_THRESHOLD, 4 * len(self.unfinished)):
+                    self.file.close()
+                    self._compact()
+                    # Everything written so far is in the compacted journal, synced.
+                    self.synced = self.written
+                    self.condition.notify_all()
+
+    def accept(self, to, status_id, status):
+        """
+        Records a status to crosspost. Returns once recorded durably.
+
+        :param to: The destination platform.
+        :param status_id: The status ID.
+        :param status: The status (a JSON-serializable dict).
+        """
+        with self.condition:
+            self.unfinished[(to, status_id)] = {'status': status, 'parts': {}}
+            self._advance_checkpoint(to, status_id)
+        self._write({'op': 'accept', 'to': to, 'id': status_id, 'status': status}, sync=True)
+
+    def set_checkpoint(self, to, status_id):
+        """
+        Moves the checkpoint of a destination forward, without accepting a
+        status. Returns once recorded durably.
+
+        :param to: The destination platform.
+        :param status_id: The ID of the last status not to crosspost.
+        """
+        with self.condition:
+            self._advance_checkpoint(to, status_id)
+        self._write({'op': 'checkpoint', 'to': to, 'id': status_id}, sync=True)
+
+    def get_checkpoint(self, to):
+        """
+        :param to: The destination platform.
+        :return: The ID of the last status accepted (or checkpointed) for this
+                 destination, or None if there is none yet.
+        """
+        with self.condition:
+            return self.checkpoints.get(to)
+
+    def part_posted(self, to, status_id, index, posted_id):
+        """
+        Records a part of a status as posted. Returns once recorded durably.
+
+        :param to: The destination platform.
+        :param status_id: The status ID.
+        :param index: The index of the part.
+        :param posted_id: The ID of the status posted for this part.
+        """
+        with self.condition:
+            if (to, status_id) in self.unfinished:
+                self.unfinished[(to, status_id)]['parts'][index] = posted_id
+        self._write({'op': 'part', 'to': to, 'id': status_id, 'index': index, 'posted_id': posted_id}, sync=True)
+
+    def finish(self, to, status_id):
+        """
+        Records a status as fully processed (posted or given up).
+
+        :param to: The destination platform.
+        :param status_id: The status ID.
+        """
+        with self.condition:
+            if self.unfinished.pop((to, status_id), None) is None:
+                return
+        self._write({'op': 'finish', 'to': to, 'id': status_id}, sync=False)
+
+    def get_posted_parts(self, to, status_id):
+        """
+        :param to: The destination platform.
+        :param status_id: The status ID.
+        :return: A dict mapping the index of the parts already posted to their ID.
+        """
+        with self.condition:
+            entry = self.unfinished.get((to, status_id))
+            return dict(entry['parts']) if entry else {}
+
+    def get_unfinished(self, to):
+        """
+        :param to: The destination platform.
+        :return: The statuses accepted but not finished, in the order they were accepted.
+        """
+        with self.condition:
+            return [entry['status'] for (destination, _), entry in self.unfinished.items() if destination == to]
+
+    def close(self):
+        """
+        Syncs the pending records and closes the journal.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+        self.flusher.join()
+        self.file.close()
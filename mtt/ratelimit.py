@@ -0,0 +1,313 @@
+import hashlib
+import heapq
+import itertools
+import random
+import re
+import threading
+import time
+
+from contextlib import contextmanager
+from datetime import datetime
+from urllib.parse import urlparse
+
+import requests
+
+
+# Request priorities, lower first: when an endpoint is rate limited, the
+# pending requests are sent in this order once the limit is reset.
+PRIORITY_ORIGINAL = 0
+PRIORITY_MEDIA = 1
+PRIORITY_RETRY = 2
+
+_local = threading.local()
+
+
+@contextmanager
+def request_priority(priority):
+    """
+    Sets the priority of the requests sent by the current thread.
+    :param priority: One of the PRIORITY_* constants.
+    """
+    previous = getattr(_local, 'priority', PRIORITY_ORIGINAL)
+    _local.priority = max(previous, priority)
+    try:
+        yield
+    finally:
+        _local.priority = previous
+
+
+class RateLimitExceeded(requests.exceptions.RequestException):
+    """
+    Raised instead of sending a request when its endpoint is rate limited
+    for longer than the requests can wait.
+    """
+
+    def __init__(self, endpoint, retry_after):
+        super(RateLimitExceeded, self).__init__(f'Rate limit exceeded for {endpoint}, '
+                                                f'reset in {retry_after:.0f} seconds')
+        self.retry_after = retry_after
+
+
+class RetryLater(Exception):
+    """
+    Raised by publishers when a status could not be crossposted because of
+    a transient error, to retry it later.
+    """
+
+    def __init__(self, message, retry_after=0):
+        """
+        :param message: The error.
+        :param retry_after: The minimal delay before retrying (seconds).
+        """
+        super(RetryLater, self).__init__(message)
+        self.retry_after = retry_after
+
+
+def get_retry_after(exception):
+    """
+    API clients wrap the exceptions of their transport, so RateLimitExceeded
+    may be the cause of the exception they raise.
+
+    They also raise their own exceptions on 429 responses (see
+    is_throttling_error), without the reset time: it is then read from the
+    rate limit headers of the last response received by the current thread.
+
+    :param exception: An exception.
+    :return: If it was caused by a rate limit, the delay before retrying
+             (seconds, at least 1), else 0.
+    """
+    while exception is not None:
+        if isinstance(exception, (RateLimitExceeded, RetryLater)):
+            return exception.retry_after
+        if is_throttling_error(exception):
+            throttled_until = getattr(_local, 'throttled_until', None)
+            return max(1, throttled_until - time.time()) if throttled_until is not None else 1
+        exception = exception.__cause__ or exception.__context__
+    return 0
+
+
+def is_throttling_error(exception):
+    """
+    :param exception: An exception.
+    :return: True if it was raised by the Mastodon client on a 429 response
+             (MastodonRatelimitError), or by the Twitter one with the "rate
+             limit exceeded" error code (88).
+    """
+    # Only imported if needed, as the clients (see APIClients)
+    from mastodon import MastodonRatelimitError
+    from twitter import TwitterError
+
+    if isinstance(exception, MastodonRatelimitError):
+        return True
+
+    if isinstance(exception, TwitterError) and exception.args:
+        errors = exception.args[0]
+        if isinstance(errors, dict):
+            errors = [errors]
+        return isinstance(errors, list) and any(isinstance(error, dict) and error.get('code') == 88
+                                                for error in errors)
+
+    return False
+
+
+def retry_delay(attempt, base_delay, max_delay):
+    """
+    Computes an exponential backoff delay, with jitter.
+    :param attempt: The number of attempts already done (starting at 0).
+    :param base_delay: The delay of the first retry (seconds).
+    :param max_delay: The maximal delay (seconds).
+    :return: The delay before the next attempt (seconds).
+    """
+    delay = min(max_delay, base_delay * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class _Bucket:
+    def __init__(self):
+        self.limit = None
+        self.remaining = None
+        self.reset_at = None
+        # Heap of (priority, ticket) of the requests waiting for a token
+        self.waiters = []
+
+    def refill(self, now):
+        if self.reset_at is not None and now >= self.reset_at:
+            self.remaining = self.limit
+            self.reset_at = None
+
+
+class RateLimiter:
+    """
+    Paces the API requests so rate limits are never exceeded.
+
+    Each endpoint (per account) has a token bucket, fed by the rate limit
+    headers of its responses (x-rate-limit-* for Twitter, X-RateLimit-*
+    for Mastodon); the tokens taken by requests in flight are accounted
+    for locally, so concurrent requests do not overshoot the limit.
+
+    When a bucket is empty, requests wait for its reset, up to `max_wait`
+    seconds; requests that would have to wait longer fail immediately
+    with RateLimitExceeded, so the work can be deferred instead of
+    blocking a thread. Waiting requests are granted by priority.
+    """
+
+    # Path segments replaced to group requests by endpoint (IDs)
+    _ID_REGEXP = re.compile(r'/\d+(?=/|\.json|$)')
+    _OAUTH_TOKEN_REGEXP = re.compile(r'oauth_token="([^"]+)"')
+
+    def __init__(self, max_wait=10, margin=1):
+        """
+        :param max_wait: The maximal time a request waits for the rate limit reset (seconds).
+        :param margin: The delay added to the reset times, for clock differences (seconds).
+        """
+        self.max_wait = max_wait
+        self.margin = margin
+        self.buckets = {}
+        self.condition = threading.Condition()
+        self.tickets = itertools.count()
+
+        self.waits = 0
+        self.rejections = 0
+        self.throttled_responses = 0
+
+    def get_endpoint(self, request):
+        """
+        :param request: A prepared request.
+        :return: A key identifying the rate limit bucket of the request (account and endpoint).
+        """
+        authorization = request.headers.get('Authorization', '')
+        if isinstance(authorization, bytes):
+            # OAuth 1 headers (Twitter)
+            authorization = authorization.decode('utf-8')
+        oauth_token = self._OAUTH_TOKEN_REGEXP.search(authorization)
+        account = oauth_token.group(1) if oauth_token else authorization
+        account = hashlib.sha1(account.encode('utf-8')).hexdigest()[:12]
+
+        url = urlparse(request.url)
+        return f'{account} {request.method} {url.netloc}{self._ID_REGEXP.sub("/:id", url.path)}'
+
+    def acquire(self, endpoint):
+        """
+        Takes a token for a request, waiting for the rate limit reset if needed.
+        :param endpoint: The endpoint key.
+        :raise RateLimitExceeded: If the reset is more than max_wait seconds away.
+        """
+        priority = getattr(_local, 'priority', PRIORITY_ORIGINAL)
+
+        with self.condition:
+            bucket = self.buckets.get(endpoint)
+            if bucket is None:
+                # Unknown yet, until the first response
+                return
+
+            ticket = (priority, next(self.tickets))
+            heapq.heappush(bucket.waiters, ticket)
+            waited = False
+
+            try:
+                while True:
+                    now = time.time()
+                    bucket.refill(now)
+
+                    # Without reset time, an empty bucket cannot be trusted
+                    if bucket.remaining is None or bucket.remaining > 0 or bucket.reset_at is None:
+                        if bucket.waiters[0] == ticket:
+                            if bucket.remaining:
+                                bucket.remaining -= 1
+                            return
+                        wait = None
+                    else:
+                        wait = bucket.reset_at - now
+                        if wait > self.max_wait:
+                            self.rejections += 1
+                            raise RateLimitExceeded(endpoint.split(' ', 1)[1], wait)
+
+                    if not waited:
+                        self.waits += 1
+                        waited = True
+
+                    self.condition.wait(wait)
+            finally:
+                bucket.waiters.remove(ticket)
+                heapq.heapify(bucket.waiters)
+                self.condition.notify_all()
+
+    def update(self, endpoint, response):
+        """
+        Updates the bucket of an endpoint from the rate limit headers of a response.
+        :param endpoint: The endpoint key.
+        :param response: The response.
+        """
+        headers = response.headers
+        # The reset time of the last 429 response of this thread, for the
+        # exceptions the API clients raise from it (see get_retry_after)
+        _local.throttled_until = None
+
+        # Twitter headers, then Mastodon ones
+        limit = headers.get('x-rate-limit-limit', headers.get('x-ratelimit-limit'))
+        remaining = headers.get('x-rate-limit-remaining', headers.get('x-ratelimit-remaining'))
+        reset = headers.get('x-rate-limit-reset', headers.get('x-ratelimit-reset'))
+
+        if response.status_code == 429:
+            self.throttled_responses += 1
+            remaining = 0
+            if reset is None and 'Retry-After' in headers:
+                reset = time.time() + float(headers['Retry-After'])
+
+        if limit is None and remaining is None:
+            return
+
+        try:
+            limit = int(limit) if limit is not None else None
+            remaining = int(remaining)
+            reset_at = self._parse_reset(reset) + self.margin if reset is not None else None
+        except ValueError:
+            return
+
+        if response.status_code == 429:
+            _local.throttled_until = reset_at
+
+        with self.condition:
+            bucket = self.buckets.setdefault(endpoint, _Bucket())
+
+            if limit is not None:
+                bucket.limit = limit
+
+            if bucket.reset_at is not None and reset_at is not None and abs(bucket.reset_at - reset_at) < 1 \
+                    and bucket.remaining is not None:
+                # Same window: the requests in flight are already deduced locally
+                bucket.remaining = min(bucket.remaining, remaining)
+            else:
+                bucket.remaining = remaining
+
+            bucket.reset_at = reset_at
+            if bucket.limit is None:
+                bucket.limit = max(remaining, 1)
+
+            self.condition.notify_all()
+
+    @staticmethod
+    def _parse_reset(reset):
+        """
+        :param reset: A reset time, as a timestamp (Twitter) or an ISO 8601 date (Mastodon).
+        :return: The timestamp.
+        """
+        try:
+            return float(reset)
+        except (TypeError, ValueError):
+            return datetime.fromisoformat(str(reset).replace('Z', '+00:00')).timestamp()
+
+    @property
+    def stats(self):
+        """
+        :return: A dict with the number of endpoints tracked, exhausted, of
+                 requests that waited or were rejected, and of 429 responses.
+        """
+        with self.condition:
+            return {
+                'endpoints': len(self.buckets),
+                'exhausted': sum(1 for bucket in self.buckets.values() if bucket.remaining == 0),
+                'waits': self.waits,
+                'rejections': self.rejections,
+                'throttled_responses': self.throttled_responses
+            }
@@ -0,0 +1,235 @@
+import logging
+import random
+import time
+
+from threading import Lock
+
+from mtt.utils import lg
+
+
+class StreamSupervisor:
+    """
+    Keeps a publisher stream open.
+
+    Streams send heartbeats (Mastodon) or keep-alive newlines (Twitter)
+    when there is no other traffic. When nothing is received for
+    STREAM_STALL_TIMEOUT seconds, the stream read times out: the stream is
+    stalled.
+
+    When the stream is closed, fails or stalls, it is reopened after a
+    jittered exponential backoff. Once it is open again (at its first
+    event), the statuses published since the last one handed to the
+    callback are fetched and handed to it first; the stream ones are held
+    until then, and skipped if they were part of that gap. The gap is also
+    filled when the stream is first opened, for the statuses published
+    after the catch-up.
+    """
+
+    def __init__(self, publisher, callback, min_delay=1, max_delay=300):
+        """
+        :param publisher: The publisher whose stream to supervise.
+        :param callback: A function called with each status.
+        :param min_delay: The delay before the first reconnection attempt (seconds).
+        :param max_delay: The maximal delay between reconnection attempts (seconds).
+        """
+        self.publisher = publisher
+        self.callback = callback
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+
+        self.lock = Lock()
+        self.last_heartbeat = time.monotonic()
+        self.disconnected_at = None
+        self.attempts = 0
+
+        # Set when the stream is (re)opened, until the gap is filled
+        self.gap_pending = False
+        # IDs of the statuses of the last gap, which the stream may deliver too
+        self.gap_ids = set()
+
+        self.reconnects = 0
+        self.last_gap_size = 0
+        self.total_gap_size = 0
+        self.last_recovery_time = None
+        self.max_recovery_time = 0.0
+
+    def heartbeat(self):
+        """
+        Called for each event received from the stream, whether it is a
+        heartbeat, one of our statuses or anything else. The first one after
+        the stream is (re)opened fills the gap.
+        """
+        now = time.monotonic()
+
+        with self.lock:
+            self.last_heartbeat = now
+
+            # First sign of life after a reconnection
+            if self.disconnected_at is not None:
+                self.last_recovery_time = now - self.disconnected_at
+                self.max_recovery_time = max(self.max_recovery_time, self.last_recovery_time)
+                self.disconnected_at = None
+                self.attempts = 0
+
+                lg(self.publisher.name, 'Stream recovered in %.1f seconds', self.last_recovery_time)
+
+        if self.gap_pending:
+            self.fill_gap()
+
+    def _on_status(self, status):
+        # The status is held while the gap is filled, and dropped if it was part of it
+        self.heartbeat()
+
+        if self.publisher.get_reply_ids(status)[0] in self.gap_ids:
+            return
+
+        self.callback(status)
+
+    def run(self):
+        """
+        Listens to the stream, forever.
+        """
+        while True:
+            # The stream is opened before the gap is fetched, so the statuses
+            # published in between are delivered by one or the other.
+            self.gap_pending = True
+
+            try:
+                self.publisher.listen(self._on_status, heartbeat=self.heartbeat)
+                reason = 'stream closed'
+            except Exception as e:
+                reason = str(e) or e.__class__.__name__
+
+            with self.lock:
+                if self.disconnected_at is None:
+                    self.disconnected_at = time.monotonic()
+                self.reconnects += 1
+
+            self._back_off(f'Stream interrupted ({reason})')
+
+    def _back_off(self, reason):
+        with self.lock:
+            attempts = self.attempts
+            self.attempts += 1
+
+        # Full jitter, so reconnections of several streams are spread
+        delay = random.uniform(self.min_delay, min(self.max_delay, self.min_delay * 2 ** attempts))
+        lg(self.publisher.name, '%s, retrying in %.0f seconds…', reason, delay, level=logging.WARNING)
+        time.sleep(delay)
+
+    def fill_gap(self):
+        """
+        Hands the statuses published since the last status handed to the
+        callback to it. Called from the stream, so the stream statuses
+        received meanwhile are only handled after them.
+        :raise RuntimeError: If they could not be fetched; the stream is then
+                             reopened, and the gap filled again.
+        """
+        checkpoint = self.publisher.get_checkpoint()
+        if checkpoint is None:
+            self.gap_pending = False
+            return
+
+        try:
+            statuses = self.publisher.fetch_statuses_since(checkpoint)
+        except Exception as e:
+            raise RuntimeError(f'unable to fetch the statuses published while disconnected: {e}') from e
+
+        self.gap_pending = False
+        self.gap_ids = {self.publisher.get_reply_ids(status)[0] for status in statuses}
+
+        with self.lock:
+            self.last_gap_size = len(statuses)
+            self.total_gap_size += len(statuses)
+
+        if statuses:
+            lg(self.publisher.name, '%d statuses published while disconnected', len(statuses))
+
+        for status in statuses:
+            self.callback(status)
+
+    @property
+    def stats(self):
+        """
+        :return: A dict with the number of reconnections, the age of the last
+                 heartbeat, the statuses fetched after reconnections (last
+                 gap and total) and the time to recover (last and max, seconds).
+        """
+        with self.lock:
+            return {
+                'reconnects': self.reconnects,
+                'heartbeat_age': time.monotonic() - self.last_heartbeat,
+                'connected': self.disconnected_at is None,
+                'last_gap_size': self.last_gap_size,
+                'total_gap_size': self.total_gap_size,
+                'last_recovery_time': self.last_recovery_time,
+                'max_recovery_time': self.max_recovery_time
+            }
+
+
+class StreamFilter:
+    """
+    Drops the stream events which can't be statuses of our account before
+    they are decoded. The Mastodon user stream delivers the whole home
+    timeline, and decoding a status is by far the most expensive part of
+    reading it. The Twitter user stream only carries our own tweets (it is
+    opened with with=user), so its events are only counted.
+
+    An event is only decoded if our account ID appears in its raw payload
+    as a JSON string (as in the "id" of its author, or the "id_str" of a
+    tweet author): statuses from other accounts never contain it, unless
+    they mention us or reply to us. Decoded statuses are then checked as
+    before.
+    """
+
+    def __init__(self, account_id):
+        """
+        :param account_id: The ID of our account on the platform streamed.
+        """
+        self.probe = f'"{account_id}"'
+        self.raw_probe = self.probe.encode('utf-8')
+
+        self.lock = Lock()
+        self.accepted = 0
+        self.rejected = 0
+        self.dropped = 0
+
+    def may_be_ours(self, payload):
+        """
+        Checks if a raw event may be one of our statuses; if not, it is counted as dropped.
+        :param payload: The raw event payload (str or bytes).
+        :return: False if the event can't be one of our statuses.
+        """
+        if (self.raw_probe if isinstance(payload, bytes) else self.probe) in payload:
+            return True
+
+        with self.lock:
+            self.dropped += 1
+        return False
+
+    def accept(self):
+        """
+        Counts a decoded event which is one of our statuses.
+        """
+        with self.lock:
+            self.accepted += 1
+
+    def reject(self):
+        """
+        Counts a decoded event which is not one of our statuses.
+        """
+        with self.lock:
+            self.rejected += 1
+
+    @property
+    def stats(self):
+        """
+        :return: A dict with the number of events accepted, rejected once
+                 decoded, and dropped without being decoded.
+        """
+        with self.lock:
+            return {
+                'accepted': self.accepted,
+                'rejected': self.rejected,
+                'dropped': self.dropped
+            }
@@ -0,0 +1,147 @@
+import time
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from itertools import count
+from threading import Condition, Lock
+
+
+class SentStatusTracker:
+    """
+    Remembers the IDs of the statuses we sent, to avoid bouncing toots or
+    tweets back and forth between the two networks.
+
+    Echoes arrive within seconds, so IDs only need to be remembered for a
+    short time: they are evicted when older than `ttl` seconds, or when
+    more than `max_size` IDs are tracked (oldest first).
+    Membership checks and insertions are O(1).
+
+    Posts being sent are registered too (see `sending`): the echo of a post
+    can arrive before the post request returns the ID of the status. An
+    incoming status is then only checked once the posts in flight when it
+    is checked are done (see `was_sent`); when nothing is being posted,
+    statuses are checked without waiting.
+    """
+
+    def __init__(self, ttl=600, max_size=10000):
+        """
+        :param ttl: How long (in seconds) a sent status is remembered.
+                    None to only evict by size.
+        :param max_size: The maximal amount of IDs remembered.
+        """
+        self.ttl = ttl
+        self.max_size = max_size
+        self.sent = OrderedDict()
+        self.lock = Lock()
+
+        # Numbers of the posts being sent; notified when one is done
+        self.pending = set()
+        self.pending_numbers = count()
+        self.pending_done = Condition(self.lock)
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.echo_waits = 0
+        self.echo_timeouts = 0
+
+    def add(self, status_id):
+        """
+        Marks a status as sent by us.
+        :param status_id: The status ID.
+        """
+        status_id = int(status_id)
+        now = time.monotonic()
+
+        with self.lock:
+            self.sent[status_id] = now
+            self.sent.move_to_end(status_id)
+
+            self._evict(now)
+
+    @contextmanager
+    def sending(self):
+        """
+        Registers a post being sent, for the enclosed block. The ID of the
+        sent status must be added (see `add`) before the end of the block.
+        """
+        with self.lock:
+            number = next(self.pending_numbers)
+            self.pending.add(number)
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.pending.discard(number)
+                self.pending_done.notify_all()
+
+    def was_sent(self, status_id, timeout=None):
+        """
+        Checks if a status was sent by us. If it is not known, and if posts
+        are being sent, waits for them to be done first: the status may be
+        the echo of one of them.
+        :param status_id: The status ID.
+        :param timeout: How long (in seconds) to wait for the posts in flight, at most.
+        :return: True if the status was sent by us.
+        """
+        status_id = int(status_id)
+
+        with self.lock:
+            if status_id not in self.sent and self.pending:
+                # Posts started after this point can't be this status
+                in_flight = set(self.pending)
+                self.echo_waits += 1
+                if not self.pending_done.wait_for(lambda: not (in_flight & self.pending), timeout=timeout):
+                    self.echo_timeouts += 1
+
+            return self._check(status_id)
+
+    def __contains__(self, status_id):
+        status_id = int(status_id)
+
+        with self.lock:
+            return self._check(status_id)
+
+    def _check(self, status_id):
+        self._evict(time.monotonic())
+
+        if status_id in self.sent:
+            self.hits += 1
+            return True
+        else:
+            self.misses += 1
+            return False
+
+    def __len__(self):
+        with self.lock:
+            return len(self.sent)
+
+    def _evict(self, now):
+        while len(self.sent) > self.max_size:
+            self.sent.popitem(last=False)
+            self.evictions += 1
+
+        if self.ttl is not None:
+            while self.sent:
+                oldest_id, sent_at = next(iter(self.sent.items()))
+                if now - sent_at <= self.ttl:
+                    break
+                del self.sent[oldest_id]
+                self.evictions += 1
+
+    @property
+    def stats(self):
+        """
+        :return: A dict with the tracker size, the posts in flight and
+                 hit/miss/eviction/echo waits counters.
+        """
+        with self.lock:
+            return {
+                'size': len(self.sent),
+                'pending': len(self.pending),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'echo_waits': self.echo_waits,
+                'echo_timeouts': self.echo_timeouts
+            }
@@ -1,36 +1,95 @@
-import html
-import re
-import time
+import logging
 
 from mastodon.Mastodon import MastodonError, MastodonAPIError
 
-from mtt import config, lock
+from mtt import config
+from mtt.connections import get_session
+from mtt.converters import TweetConverter
+from mtt.logs import StatusText
+from mtt.metrics import metrics
+from mtt.ratelimit import RetryLater, get_retry_after
+from mtt.streams import StreamFilter
 from mtt.utils import MTTThread, lgt
 
 
 class MastodonPublisher(MTTThread):
-    def __init__(self, mastodon_api, twitter_api, ma_account_id, tw_account_id,
-                 status_associations, sent_status, group=None, target=None, name=None):
+    destination = 'mastodon'
+    statuses_name = 'tweets'
+
+    # The maximal page size of the Twitter user timeline API
+    CATCH_UP_PAGE_SIZE = 200
+
+    def __init__(self, clients, metadata, ma_account_id, tw_account_id,
+                 status_associations, sent_status, outbox, group=None, target=None, name=None):
         super(MastodonPublisher, self).__init__(
             group=group,
             target=target,
             name=name,
-            mastodon_api=mastodon_api,
-            twitter_api=twitter_api,
+            clients=clients,
+            metadata=metadata,
             ma_account_id=ma_account_id,
             tw_account_id=tw_account_id,
             status_associations=status_associations,
-            sent_status=sent_status
+            sent_status=sent_status,
+            outbox=outbox
         )
 
         self.since_tweet_id = 0
+        self.stream_filter = StreamFilter(tw_account_id)
+
+        self.tweet_converter = TweetConverter(
+            cw_regexp=config.TWEET_CW_REGEXP,
+            cw_allow_multi=config.TWEET_CW_ALLOW_MULTI,
+            cw_separator=config.TWEET_CW_SEPARATOR
+        )
+
+        self.max_retries = config.MASTODON_RETRIES
+        self.retry_delay = config.MASTODON_RETRY_DELAY
 
     def init_process(self):
-        try:
-            self.since_tweet_id = self.twitter_api.GetUserTimeline()[0].id
-            lgt('Tooting any tweet after tweet {}'.format(self.since_tweet_id))
-        except IndexError:
-            lgt('Tooting any tweet (user timeline is empty right now)')
+        checkpoint = self.get_checkpoint()
+
+        if checkpoint is not None and config.CATCH_UP:
+            self.since_tweet_id = checkpoint
+            self.missed_statuses = self.fetch_statuses_since(checkpoint)
+            lgt('Tooting any tweet after tweet %s (%d tweets posted since the last run)',
+                self.since_tweet_id, len(self.missed_statuses))
+        else:
+            try:
+                self.since_tweet_id = self.twitter_api.GetUserTimeline(count=1)[0].id
+                self.set_checkpoint(self.since_tweet_id)
+                lgt('Tooting any tweet after tweet %s', self.since_tweet_id)
+            except IndexError:
+                lgt('Tooting any tweet (user timeline is empty right now)')
+
+    def fetch_statuses_since(self, since_id):
+        """
+        Fetches our tweets posted after a tweet, by pages as large as possible.
+        :param since_id: The tweet ID.
+        :return: The tweets (as received from the stream), oldest first (at most
+                 CATCH_UP_MAX_STATUSES, the most recent ones).
+        """
+        tweets = []
+        max_id = None
+
+        while len(tweets) < config.CATCH_UP_MAX_STATUSES:
+            page = self.twitter_api.GetUserTimeline(user_id=self.tw_account_id, since_id=since_id, max_id=max_id,
+                                                   count=self.CATCH_UP_PAGE_SIZE, include_rts=True)
+            if not page:
+                break
+
+            # The raw tweets, as the stream sends them
+            tweets.extend(status._json for status in page)
+            max_id = page[-1].id - 1
+
+            if len(page) < self.CATCH_UP_PAGE_SIZE:
+                break
+
+        if len(tweets) > config.CATCH_UP_MAX_STATUSES:
+            tweets = tweets[:config.CATCH_UP_MAX_STATUSES]
+            lgt('Too many tweets posted since the last run, only the last %d will be tooted', len(tweets))
+
+        return tweets[::-1]
 
     @staticmethod
     def _get_tweet_full_text(tweet):
@@ -46,131 +105,118 @@ class MastodonPublisher(MTTThread):
         else:
             return ''
 
-    def run(self):
-        self.init_process()
-
-        lgt('Listening for tweets…')
-
-        for tweet in self.twitter_api.GetUserStream():
-            if 'text' not in tweet and 'full_text' not in tweet:
-                continue
-
-            # Avoids a race condition.
-            # We wait a little bit so toots sent to Twitter
-            # can be marked as such before this run, avoiding
-            # bouncing tweets/toots.
-            time.sleep(config.STATUS_PROCESS_DELAY)
-
-            tweet_id = tweet['id']
-
-            if self.is_tweet_sent_by_us(tweet_id):
-                continue
-
-            if tweet['user']['id_str'] != str(self.tw_account_id):
-                continue
-
-            is_retweet = False
-
-            content = MastodonPublisher._get_tweet_full_text(tweet)
-
-            if 'retweeted_status' in tweet:
-                rt = tweet['retweeted_status']
-                rt_content = MastodonPublisher._get_tweet_full_text(rt)
-
-                content = f'\U0001f501 RT @{rt["user"]["screen_name"]}\n\n' \
-                          f'{rt_content}\n\n' \
-                          f'https://twitter.com/{rt["user"]["screen_name"]}/status/{rt["id_str"]}'
-
-                tweet = rt
-                is_retweet = True
-
-            reply_to = None
-
-            with lock:
-                if 'in_reply_to_user_id' in tweet and 'in_reply_to_status_id' in tweet and tweet['in_reply_to_user_id']:
-                    # If it's a reply, we keep the tweet if:
-                    # 1. it's a reply from us (in a thread);
-                    # 2. it's a reply from a previously transmitted tweet, so we don't sync
-                    #    if someone replies to someone in two or more tweets (because in this
-                    #    case the 2nd tweet and the ones after are replying to us);
-                    # 3. it's a reply from another one but we retweeted it.
-
-                    # If it's not a tweet in reply to us
-                    if ((tweet['in_reply_to_user_id'] != self.tw_account_id
-                         # or if it's a reply to us but not in our threads association
-                         or tweet['in_reply_to_status_id'] not in self.status_associations['t2m'])
-                        # or if it's a tweet from us but not a retweet
-                       and not is_retweet):
-
-                        # ... in all these cases, we don't want to transfer the tweet.
-                        lgt(f'Skipping tweet {tweet_id} - it\'s a reply.')
-                        continue
-
-                    # A tweet can be a reply without previous tweet if we directly mentioned someone
-                    # (starting the tweet with the mention).
-                    if tweet['in_reply_to_status_id'] is not None:
-                        reply_to = self.status_associations['t2m'].get(tweet['in_reply_to_status_id'])
-
-            media_attachments = (tweet['media'] if 'media' in tweet
-                                 else tweet['entities']['media'] if 'entities' in tweet and 'media' in tweet['entities']
-                                 else tweet['extended_tweet']['entities']['media']
-                                     if 'extended_tweet' in tweet and 'entities' in tweet['extended_tweet']
-                                     and 'media' in tweet['extended_tweet']['entities']
-                                 else [])
-
-            urls = (tweet['urls'] if 'urls' in tweet
-                    else tweet['entities']['urls'] if 'entities' in tweet and 'urls' in tweet['entities']
-                    else tweet['extended_tweet']['entities']['urls']
-                        if 'extended_tweet' in tweet and 'entities' in tweet['extended_tweet']
-                        and 'urls' in tweet['extended_tweet']['entities']
-                    else [])
-
-            sensitive = tweet['possibly_sensitive'] if 'possibly_sensitive' in tweet else False
-
-            content_toot = html.unescape(content)
-            mentions = re.findall(r'@[a-zA-Z0-9_]*', content_toot)
-            cws = config.TWEET_CW_REGEXP.findall(content) if config.TWEET_CW_REGEXP else []
-            warning = None
-            media_ids = []
-
-            if mentions:
-                for mention in mentions:
-                    # Replace all mentions for an equivalent to clearly signal their origin on Twitter
-                    content_toot = re.sub(mention, mention + '@twitter.com', content_toot)
-
-            if urls:
-                for url in urls:
-                    # Un-shorten URLs
-                    content_toot = re.sub(url['url'], url['expanded_url'], content_toot)
-
-            if cws:
-                warning = (config.TWEET_CW_SEPARATOR.join([cw.strip() for cw in cws]) if config.TWEET_CW_ALLOW_MULTI
-                           else cws[0].strip())
-                content_toot = config.TWEET_CW_REGEXP.sub('', content_toot, count=(0 if config.TWEET_CW_ALLOW_MULTI
-                                                                                   else 1)).strip()
-
-            if media_attachments:
-                for attachment in media_attachments:
-                    # Remove the t.co link to the media
-                    content_toot = re.sub(attachment['url'], '', content_toot)
-
-                    attachment_url = (attachment['media_url_https'] if 'media_url_https' in attachment
-                                      else attachment['media_url'])
-
-                    media_ids.append(self.transfer_media(
-                        media_url=attachment_url,
-                        to='mastodon'
-                    ))
-
-            # Now that the toot is ready, we send it.
-            try:
-                retry_counter = 0
-                post_success = False
-
-                lgt(f'Sending toot "{content_toot.strip()}"…')
+    @staticmethod
+    def _get_tweet_entities(tweet, kind):
+        """
+        :param tweet: A tweet.
+        :param kind: The kind of entities ('user_mentions', 'urls', 'media'...).
+        :return: The entities of this kind in the tweet.
+        """
+        if kind in tweet:
+            return tweet[kind]
+        # Same precedence as _get_tweet_full_text, so the entities indices match the text
+        elif 'extended_tweet' in tweet and 'entities' in tweet['extended_tweet'] \
+                and kind in tweet['extended_tweet']['entities']:
+            return tweet['extended_tweet']['entities'][kind]
+        elif 'entities' in tweet and kind in tweet['entities']:
+            return tweet['entities'][kind]
+        else:
+            return []
+
+    def process_status(self, tweet):
+        """
+        Crossposts a tweet to Mastodon.
+        :param tweet: The tweet, as received from the stream.
+        """
+        tweet_id = tweet['id']
+
+        # The statuses we sent are only remembered in memory: after a restart,
+        # a tweet caught up or resumed may be a crosspost of a toot, or be
+        # already tooted. Both are in the associations store.
+        if self.status_associations.get_toot_id(tweet_id) is not None:
+            lgt('Skipping tweet %s - already associated with a toot', tweet_id)
+            return
+
+        # Avoids bouncing tweets/toots. If we are sending tweets, this waits
+        # for them to be marked as sent, as this may be the echo of one.
+        if self.is_tweet_sent_by_us(tweet_id):
+            return
+
+        is_retweet = False
+        content_prefix = ''
+        content_suffix = ''
+
+        if 'retweeted_status' in tweet:
+            rt = tweet['retweeted_status']
+
+            content_prefix = f'\U0001f501 RT @{rt["user"]["screen_name"]}@twitter.com\n\n'
+            content_suffix = f'\n\nhttps://twitter.com/{rt["user"]["screen_name"]}/status/{rt["id_str"]}'
+
+            tweet = rt
+            is_retweet = True
+
+        content = MastodonPublisher._get_tweet_full_text(tweet)
+
+        reply_to = None
+
+        if 'in_reply_to_user_id' in tweet and 'in_reply_to_status_id' in tweet and tweet['in_reply_to_user_id']:
+            # If it's a reply, we keep the tweet if:
+            # 1. it's a reply from us (in a thread);
+            # 2. it's a reply from a previously transmitted tweet, so we don't sync
+            #    if someone replies to someone in two or more tweets (because in this
+            #    case the 2nd tweet and the ones after are replying to us);
+            # 3. it's a reply from another one but we retweeted it.
+
+            # If it's not a tweet in reply to us
+            if ((tweet['in_reply_to_user_id'] != self.tw_account_id
+                 # or if it's a reply to us but not in our threads association
+                 or self.status_associations.get_toot_id(tweet['in_reply_to_status_id']) is None)
+                # or if it's a tweet from us but not a retweet
+               and not is_retweet):
+
+                # ... in all these cases, we don't want to transfer the tweet.
+                lgt('Skipping tweet %s - it\'s a reply.', tweet_id)
+                return
+
+            # A tweet can be a reply without previous tweet if we directly mentioned someone
+            # (starting the tweet with the mention).
+            if tweet['in_reply_to_status_id'] is not None:
+                reply_to = self.status_associations.get_toot_id(tweet['in_reply_to_status_id'])
+
+        # Already tooted before a restart
+        posted_parts = self.get_posted_parts(tweet_id)
+        if posted_parts:
+            self.associate_status(posted_parts[0], tweet_id)
+            return
+
+        media_attachments = MastodonPublisher._get_tweet_entities(tweet, 'media')
+        sensitive = tweet['possibly_sensitive'] if 'possibly_sensitive' in tweet else False
+        media_ids = []
+
+        with metrics.timed('convert', self.destination):
+            content_toot, warning = self.tweet_converter.convert(
+                content,
+                mentions=MastodonPublisher._get_tweet_entities(tweet, 'user_mentions'),
+                urls=MastodonPublisher._get_tweet_entities(tweet, 'urls'),
+                medias=media_attachments
+            )
+        content_toot = content_prefix + content_toot + content_suffix
+
+        if media_attachments:
+            media_ids = self.transfer_medias(
+                media_urls=[attachment['media_url_https'] if 'media_url_https' in attachment
+                            else attachment['media_url'] for attachment in media_attachments],
+                to='mastodon'
+            )
+
+        # Now that the toot is ready, we send it. On error, it is retried later.
+        try:
+            lgt('Sending toot "%s"…', StatusText(content_toot))
 
-                while not post_success:
-                    try:
+            # Until the toot ID is marked as sent, its echo waits
+            with self.sending_toot():
+                try:
+                    with metrics.timed('post', self.destination):
                         if len(media_ids) == 0:
                             try:
                                 post = self.mastodon_api.status_post(
@@ -179,7 +225,6 @@ class MastodonPublisher(MTTThread):
                                     spoiler_text=warning,
                                     in_reply_to_id=reply_to
                                 )
-                                self.mark_toot_sent(post['id'])
 
                             except MastodonAPIError:
                                 # If the toot we are replying to has been deleted while we were processing it
@@ -188,10 +233,6 @@ class MastodonPublisher(MTTThread):
                                     visibility=config.TOOT_VISIBILITY,
                                     spoiler_text=warning
                                 )
-                                self.mark_toot_sent(post['id'])
-
-                            since_toot_id = post['id']
-                            post_success = True
 
                         else:
                             try:
@@ -203,7 +244,6 @@ class MastodonPublisher(MTTThread):
                                     spoiler_text=warning,
                                     in_reply_to_id=reply_to
                                 )
-                                self.mark_toot_sent(post['id'])
 
                             except MastodonAPIError:
                                 # If the toot we are replying to has been deleted (same as before)
@@ -214,30 +254,60 @@ class MastodonPublisher(MTTThread):
                                     sensitive=sensitive,
                                     spoiler_text=warning
                                 )
-                                self.mark_toot_sent(post['id'])
 
-                            since_toot_id = post['id']
-                            post_success = True
+                except MastodonError as e:
+                    raise RetryLater(f'Unable to send the toot: {e}.', retry_after=get_retry_after(e))
 
-                    except MastodonError:
-                        if retry_counter < config.TWITTER_RETRIES:
-                            lgt('We were unable to send the toot. '
-                                f'Retrying… ({retry_counter+1}/{config.TWITTER_RETRIES})')
-                            retry_counter += 1
-                            time.sleep(config.TWITTER_RETRY_DELAY)
-                        else:
-                            raise
+                self.mark_toot_sent(post['id'])
+            since_toot_id = post['id']
+
+            self.mark_part_posted(tweet_id, 0, since_toot_id)
+
+            lgt('Toot sent successfully.')
 
-                lgt('Toot sent successfully.')
+            self.associate_status(since_toot_id, tweet_id)
 
-                with lock:
-                    self.associate_status(since_toot_id, tweet_id)
-                    self.save_status_associations()
+        except RetryLater:
+            raise
 
-            except MastodonError:
-                lgt(f'Encountered error after {config.TWITTER_RETRIES} retries. Not retrying.')
+        # Broad exception to avoid thread interruption in case of network problems or anything else.
+        except Exception as e:
+            lgt('Unhandled exception happened - giving up on this toot: %s', e, level=logging.ERROR, exc_info=e)
 
-            # Broad exception to avoid thread interruption in case of network problems or anything else.
-            except Exception as e:
-                lgt('Unhandled exception happened - giving up on this toot.')
-                lgt(e)
+    def listen(self, callback, heartbeat=None):
+        """
+        Listens for our tweets and hands them to the callback. Blocks while the
+        stream is open.
+        :param callback: A function called with each tweet.
+        :param heartbeat: A function called for each event of the stream (keep-alives included).
+        """
+        # Keep-alives are sent every 30 seconds without other traffic. Without
+        # them for STREAM_STALL_TIMEOUT, the stream is stalled: the read times out
+        # (python-twitter uses a new session for streams, without our timeouts).
+        # The stream is opened with with=user, so it only carries our own tweets
+        # and events: unlike the Mastodon one, it is not filtered before decoding.
+        for tweet in self.twitter_api.GetUserStream(include_keepalive=True, session=get_session()):
+            if heartbeat:
+                heartbeat()
+
+            if tweet is None:
+                continue
+
+            if ('text' not in tweet and 'full_text' not in tweet) or tweet['user']['id_str'] != str(self.tw_account_id):
+                self.stream_filter.reject()
+                continue
+
+            self.stream_filter.accept()
+            callback(tweet)
+
+    @staticmethod
+    def get_reply_ids(tweet):
+        """
+        :param tweet: A tweet.
+        :return: A (tweet ID, ID of the tweet it replies to or None) tuple.
+        """
+        return tweet['id'], tweet.get('in_reply_to_status_id')
+
+    def run(self):
+        self.init_process()
+        self.process_stream()
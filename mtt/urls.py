@@ -0,0 +1,195 @@
+"""
+URL detection, as done by Twitter to compute the length of a tweet.
+
+The patterns below match the same URLs as the ones of python-twitter, but
+texts are only scanned with them where an URL can be, and instead of a
+thousand-branches alternation of all the top-level domains, they only
+contain the ones found after a dot in the scanned word. The patterns are
+compiled for each set of top-level domains, and cached.
+"""
+import re
+
+from functools import lru_cache
+from threading import Lock
+
+
+# {tlds} is the TLDs pattern
+_URL_PATTERN = (
+    r'('
+    r'(?!(https?://|www\.)?\.|ftps?://|([0-9]+\.){{1,3}}\d+)'  # exclude urls that start with "."
+    r'(?:https?://|www\.)*(?!.*@)(?:[\w+-_]+[.])'              # beginning of url
+    r'(?:{tlds}\b|'                                            # all tlds
+    r'(?:[:0-9]))'                                             # port numbers & close off TLDs
+    r'(?:[\w+\/]?[a-z0-9!\*\'\(\);:&=\+\$/%#\[\]\-_\.,~?])*'   # path/query params
+    r')'
+)
+
+# The pattern used by python-twitter to check if a word is an URL (anchored
+# at the beginning, and the last TLD of the list requires a port).
+_IS_URL_PATTERN = (
+    r'('
+    r'^(?!(https?://|www\.)?\.|ftps?://|([0-9]+\.){{1,3}}\d+)'
+    r'(?:https?://|www\.)*^(?!.*@)(?:[\w+-_]+[.])'
+    r'(?:{tlds}\b|{last_tld}\b'
+    r'(?:[:0-9]))'
+    r'(?:[\w+\/]?[a-z0-9!\*\'\(\);:&=\+\$/%#\[\]\-_\.,~?])*'
+    r')'
+)
+
+
+_IS_WORD_CHAR = re.compile(r'\w').match
+_WORD_CHARS_REGEXP = re.compile(r'\w*')
+
+# TLD -> index in python-twitter's list
+_tlds = None
+# First character -> TLDs with non-word characters (some scripts use combining marks)
+_other_tlds = None
+_tlds_lock = Lock()
+
+
+def _get_tlds():
+    global _tlds, _other_tlds
+    with _tlds_lock:
+        if _tlds is None:
+            # Imported when first needed: python-twitter is slow to import
+            from twitter.twitter_utils import TLDS
+
+            _other_tlds = {}
+            for tld in TLDS:
+                if not re.fullmatch(r'\w+', tld):
+                    _other_tlds.setdefault(tld[0], []).append(tld)
+            _tlds = {tld: index for index, tld in enumerate(TLDS)}
+        return _tlds, _other_tlds
+
+
+def _find_tlds(word):
+    """
+    Finds the top-level domains the URL patterns could match in a word: the
+    ones right after a dot, and followed by a word boundary.
+
+    :param word: A word.
+    :return: The top-level domains, in the order of python-twitter's list (as
+             the first one matching wins in an alternation).
+    """
+    tlds, other_tlds = _get_tlds()
+    lowered = word.lower()
+    if len(lowered) != len(word):
+        # A few characters are longer once lowercased: positions would not match
+        return tuple(tlds)
+
+    found = set()
+
+    position = lowered.find('.')
+    while position != -1:
+        start = position + 1
+
+        # A TLD made of word characters is followed by a boundary only at the end of the word characters
+        tld = _WORD_CHARS_REGEXP.match(lowered, start).group()
+        if tld in tlds:
+            found.add(tld)
+
+        for tld in other_tlds.get(lowered[start:start + 1], ()):
+            end = start + len(tld)
+            if lowered.startswith(tld, start) \
+                    and bool(_IS_WORD_CHAR(word[end - 1])) != bool(end < len(word) and _IS_WORD_CHAR(word[end])):
+                found.add(tld)
+
+        position = lowered.find('.', start)
+
+    return tuple(sorted(found, key=tlds.get))
+
+
+def _alternation(tlds):
+    # Never matches without TLDs
+    return f'(?:{"|".join(map(re.escape, tlds))})' if tlds else '(?!)'
+
+
+@lru_cache(maxsize=1024)
+def _get_regexp(name, tlds):
+    """
+    :param name: 'url' or 'is_url'.
+    :param tlds: The top-level domains to match, as returned by _find_tlds.
+    :return: The compiled regular expression.
+    """
+    if name == 'url':
+        pattern = _URL_PATTERN.format(tlds=_alternation(tlds))
+    else:
+        from twitter.twitter_utils import TLDS
+
+        # The last TLD of the list is matched separately (it requires a port)
+        pattern = _IS_URL_PATTERN.format(tlds=_alternation([tld for tld in tlds if tld != TLDS[-1]]),
+                                         last_tld=re.escape(TLDS[-1]))
+    return re.compile(pattern, re.U | re.I | re.X)
+
+
+def get_url_regexp(text):
+    """
+    :param text: The text to scan (a single word, see find_urls).
+    :return: The compiled URL regular expression to scan it with (its first
+             group is the URL).
+    """
+    return _get_regexp('url', _find_tlds(text))
+
+
+_WORD_REGEXP = re.compile(r'\S+')
+
+
+def find_urls(text):
+    """
+    Finds the URLs in a text, as Twitter would.
+
+    The text is scanned in two phases: candidates are first located cheaply
+    (words containing a dot), then the URL regexp is only run on them.
+    URLs never contain spaces, so running the regexp on a single word gives
+    the same URLs as running it on the whole text, except that no URL is
+    matched if an "@" appears later on the same line; words followed by an
+    "@" on their line are skipped.
+
+    :param text: A text.
+    :return: The list of the URLs found, in order.
+    """
+    # No URL without a dot
+    if '.' not in text:
+        return []
+
+    found = []
+
+    for line in text.split('\n'):
+        if '.' not in line:
+            continue
+
+        last_at = line.rfind('@')
+
+        for word in _WORD_REGEXP.finditer(line):
+            if word.end() <= last_at or '.' not in word.group():
+                continue
+
+            found.extend(match.group(1) for match in get_url_regexp(word.group()).finditer(word.group()))
+
+    return found
+
+
+def expected_length(text, short_url_length=23):
+    """
+    Computes the length of a text once posted on Twitter, each URL being
+    replaced by a short URL.
+
+    :param text: A text.
+    :param short_url_length: The length of Twitter short URLs.
+    :return: The expected length.
+    """
+    urls = find_urls(text)
+    return len(text) - sum(len(url) for url in urls) + short_url_length * len(urls)
+
+
+def is_url(text):
+    """
+    Checks if a word should be treated as an URL (same as python-twitter's is_url).
+
+    :param text: A word.
+    :return: True if it's an URL.
+    """
+    if '.' not in text:
+        return False
+
+    return _get_regexp('is_url', _find_tlds(text)).search(text) is not None
@@ -1,132 +1,440 @@
-import json
-import mimetypes
-import os
+import logging
 import re
-import requests
-import tempfile
 import threading
-import twitter
+import time
 
-from datetime import datetime
 from threading import Thread
 
-from mtt import config, lock
+from mtt import config
+from mtt.logs import LazyText, log
+from mtt.media import download_media, get_media_cache, get_media_executor, upload_media
+from mtt.metrics import metrics
+from mtt.ratelimit import PRIORITY_MEDIA, PRIORITY_ORIGINAL, PRIORITY_RETRY, RetryLater, get_retry_after, \
+    request_priority, retry_delay
+from mtt.urls import expected_length, is_url
 
 
 class MTTThread(Thread):
-    def __init__(self, mastodon_api, twitter_api, ma_account_id, tw_account_id,
-                 status_associations, sent_status, group=None, target=None, name=None):
+    # The platform statuses are crossposted to ('twitter' or 'mastodon')
+    destination = None
+    # The statuses crossposted ('toots' or 'tweets'), for the logs
+    statuses_name = None
+
+    # How many times, and after how long (seconds, doubled each time), a
+    # status failing because of a transient error is retried
+    max_retries = 0
+    retry_delay = 0
+
+    def __init__(self, clients, metadata, ma_account_id, tw_account_id,
+                 status_associations, sent_status, outbox, group=None, target=None, name=None):
         super(MTTThread, self).__init__(
             group=group,
             target=target,
-            name=name
+            name=name,
+            # Streams are read forever: the process stops with the main thread
+            daemon=True
         )
 
-        self.mastodon_api = mastodon_api
-        self.twitter_api = twitter_api
+        self.clients = clients
+        self.metadata = metadata
         self.ma_account_id = ma_account_id
         self.tw_account_id = tw_account_id
         self.status_associations = status_associations
         self.sent_status = sent_status
+        self.outbox = outbox
+        self.work_queue = None
+        self.stream_supervisor = None
+        self.stream_filter = None
+
+        # Statuses posted while we were not running, to crosspost before the stream ones
+        self.missed_statuses = []
+        # Status ID -> when it was accepted, until it is processed
+        self.accepted_at = {}
+
+    @property
+    def mastodon_api(self):
+        """
+        :return: The Mastodon API client of the current thread.
+        """
+        return self.clients.mastodon
+
+    @property
+    def twitter_api(self):
+        """
+        :return: The Twitter API client of the current thread.
+        """
+        return self.clients.twitter
+
+    def accept_status(self, status):
+        """
+        Records a status received from the stream in the outbox, so it is
+        crossposted even if the process dies before.
+        :param status: The status.
+        """
+        status_id = self.get_reply_ids(status)[0]
+        self.accepted_at[status_id] = time.monotonic()
+        self.outbox.accept(self.destination, status_id, status)
+
+    def crosspost(self, status, attempt=0):
+        """
+        Crossposts an accepted status, and records it as finished in the outbox.
+
+        If it fails because of a transient error (network, rate limit...), it
+        is not finished: the delay before retrying it is returned instead, so
+        the caller can crosspost other statuses in the meantime.
+
+        :param status: The status.
+        :param attempt: The number of attempts already done.
+        :return: The delay before retrying (seconds), or None if the status is done.
+        """
+        status_id = self.get_reply_ids(status)[0]
+        retry_in = None
+
+        accepted_at = self.accepted_at.pop(status_id, None)
+        if accepted_at is not None:
+            metrics.observe('receive', time.monotonic() - accepted_at, self.destination)
+
+        try:
+            with request_priority(PRIORITY_RETRY if attempt else PRIORITY_ORIGINAL):
+                self.process_status(status)
+
+        except RetryLater as e:
+            if attempt < self.max_retries:
+                retry_in = max(e.retry_after, retry_delay(attempt, self.retry_delay, config.RETRY_MAX_DELAY))
+                lgt('%s Retrying in %.0f seconds… (%d/%d)', e, retry_in, attempt + 1, self.max_retries,
+                    level=logging.WARNING)
+                metrics.increment('mtt_statuses_total', destination=self.destination, outcome='retried')
+            else:
+                lgt('%s Giving up after %d retries.', e, attempt, level=logging.ERROR)
+                metrics.increment('mtt_statuses_total', destination=self.destination, outcome='given_up')
+
+        else:
+            metrics.increment('mtt_statuses_total', destination=self.destination, outcome='processed')
+
+        finally:
+            if retry_in is None:
+                self.outbox.finish(self.destination, status_id)
+
+        return retry_in
+
+    def get_posted_parts(self, status_id):
+        """
+        :param status_id: The ID of the status being crossposted.
+        :return: A dict mapping the index of the parts already posted (before
+                 a restart) to their ID.
+        """
+        return self.outbox.get_posted_parts(self.destination, status_id)
+
+    def mark_part_posted(self, status_id, index, posted_id):
+        """
+        Records a part of a status as posted, so it is not posted again if the
+        process dies before the status is fully crossposted.
+        :param status_id: The ID of the status being crossposted.
+        :param index: The index of the part.
+        :param posted_id: The ID of the status posted.
+        """
+        self.outbox.part_posted(self.destination, status_id, index, posted_id)
+
+    def get_checkpoint(self):
+        """
+        :return: The ID of the last status accepted, before a restart too, or None.
+        """
+        return self.outbox.get_checkpoint(self.destination)
+
+    def set_checkpoint(self, status_id):
+        """
+        Records that statuses up to this one do not have to be crossposted.
+        :param status_id: A status ID.
+        """
+        self.outbox.set_checkpoint(self.destination, status_id)
+
+    def get_unfinished_statuses(self):
+        """
+        :return: The statuses accepted but not fully crossposted before a restart.
+        """
+        return self.outbox.get_unfinished(self.destination)
+
+    def listen_supervised(self, callback):
+        """
+        Listens to the stream forever: it is reopened if closed or stalled,
+        and the statuses published in the meantime are fetched.
+        :param callback: A function called with each status.
+        """
+        from mtt.streams import StreamSupervisor
+
+        self.stream_supervisor = StreamSupervisor(self, callback, min_delay=config.STREAM_RECONNECT_MIN_DELAY,
+                                                  max_delay=config.STREAM_RECONNECT_MAX_DELAY)
+        self.stream_supervisor.run()
+
+    def read_stream(self):
+        """
+        Listens to the stream and queues the statuses received in the work
+        queue. The stream is reopened when it is closed or fails, so this
+        only returns on unexpected errors. Statuses not fully crossposted
+        before a restart, then the ones posted while we were not running,
+        are queued first.
+        """
+        lg(self.name, 'Listening for %s…', self.statuses_name)
+
+        def on_status(status):
+            self.accept_status(status)
+            self.work_queue.put(*self.get_reply_ids(status), status)
+
+        # Statuses not fully crossposted before a restart first
+        for status in self.get_unfinished_statuses():
+            self.work_queue.put(*self.get_reply_ids(status), status)
+
+        # Then the statuses posted while we were not running
+        for status in self.missed_statuses:
+            on_status(status)
+        self.missed_statuses = []
+
+        self.listen_supervised(on_status)
+
+    def process_stream(self):
+        """
+        Listens to the stream and crossposts the statuses received.
+
+        The stream is only read here: statuses are queued and crossposted by
+        a pool of workers, so slow posts do not delay the stream reading.
+        Statuses of the same thread are crossposted in order. The stream is
+        reopened when it is closed or fails (see StreamSupervisor), so this
+        only returns on unexpected errors, once queued statuses are
+        crossposted.
+        """
+        from mtt.work_queue import WorkQueue
+
+        self.work_queue = WorkQueue(self.crosspost, name=self.name,
+                                    workers=config.PUBLISH_WORKERS, max_size=config.PUBLISH_QUEUE_SIZE)
+        self.work_queue.start()
+
+        try:
+            self.read_stream()
+        finally:
+            self.work_queue.close()
 
     def mark_toot_sent(self, toot_id):
-        with lock:
-            self.sent_status['toots'].append(str(toot_id))
+        self.sent_status['toots'].add(toot_id)
 
     def mark_tweet_sent(self, tweet_id):
-        with lock:
-            self.sent_status['tweets'].append(str(tweet_id))
+        self.sent_status['tweets'].add(tweet_id)
+
+    def sending_toot(self):
+        """
+        :return: A context manager registering a toot being sent, so its echo
+                 waits for its ID to be marked as sent (see mark_toot_sent).
+        """
+        return self.sent_status['toots'].sending()
+
+    def sending_tweet(self):
+        """
+        :return: A context manager registering a tweet being sent (see sending_toot).
+        """
+        return self.sent_status['tweets'].sending()
 
     def is_toot_sent_by_us(self, toot_id):
-        with lock:
-            return str(toot_id) in self.sent_status['toots']
+        return self.sent_status['toots'].was_sent(toot_id, timeout=config.ECHO_WAIT_TIMEOUT)
 
     def is_tweet_sent_by_us(self, tweet_id):
-        with lock:
-            return str(tweet_id) in self.sent_status['tweets']
+        return self.sent_status['tweets'].was_sent(tweet_id, timeout=config.ECHO_WAIT_TIMEOUT)
 
     def associate_status(self, toot_id, tweet_id):
         """
-        Associates a tweet and a toot in the associations file.
+        Associates a tweet and a toot in the associations store.
         :param toot_id: The toot ID
         :param tweet_id: The tweet ID
         """
-        self.status_associations['t2m'][tweet_id] = toot_id
-        self.status_associations['m2t'][toot_id] = tweet_id
-
-    def save_status_associations(self):
         try:
-            with open('mtt_status_associations.json', 'w') as f:
-                json.dump(self.status_associations['m2t'], f)
-        except Exception:
-            print('Encountered error while saving status associations file. Threads might be broken after MTT service '
-                  'restarts. Check files permissions.')
+            with metrics.timed('associate', self.destination):
+                self.status_associations.associate(toot_id, tweet_id)
+        except Exception as e:
+            lgt('Encountered error while saving status association: %s. Threads might be broken after MTT '
+                'service restarts. Check files permissions.', e, level=logging.ERROR)
 
     def transfer_media(self, media_url, to='twitter'):
         """
         Transfers a media from a network to another.
+        Medias already uploaded (same URL or same content) are reused.
 
         :param media_url: The media URL.
         :param to: The destination ('twitter' or 'mastodon', else ValueError is raised)
         :return: The media ID on the destination platform.
         """
-        lg('Medias', f'Downloading {media_url} from {"Mastodon" if to == "twitter" else "Twitter"}')
+        with request_priority(PRIORITY_MEDIA):
+            try:
+                return self._transfer_media(media_url, to)
+            except Exception as e:
+                # The rate limit reset is only known by the thread which received it
+                retry_after = get_retry_after(e)
+                if retry_after:
+                    raise RetryLater(f'Unable to transfer media {media_url}: {e}.', retry_after=retry_after) from e
+                raise
+
+    def _transfer_media(self, media_url, to):
+        to_name = "Twitter" if to == "twitter" else "Mastodon"
+        owner = self.tw_account_id if to == 'twitter' else self.ma_account_id
+        cache = get_media_cache()
+
+        # Only computed if the messages below are written
+        hit_rate = LazyText(lambda: f'{cache.stats["hit_rate"]:.0%}')
+
+        media_id = cache.get(to, owner, url=media_url)
+        if media_id is not None:
+            lg('Medias', 'Reusing already uploaded %s on %s (%s cache hit rate)', media_url, to_name, hit_rate)
+            return media_id
+
+        lg('Medias', 'Downloading %s from %s', media_url, 'Mastodon' if to == 'twitter' else 'Twitter')
+
+        with metrics.timed('media_download', to):
+            media_file = download_media(media_url)
+
+        with media_file:
+            media_id = cache.get(to, owner, digest=media_file.digest)
+
+            if media_id is not None:
+                lg('Medias', 'Reusing already uploaded identical media on %s (%s cache hit rate)', to_name, hit_rate)
+            else:
+                lg('Medias', 'Uploading %s (%s) to %s', media_url, media_file.content_type, to_name)
+                with metrics.timed('media_upload', to):
+                    media_id = upload_media(media_file, to=to, twitter_api=self.twitter_api,
+                                            mastodon_api=self.mastodon_api)
 
-        media_file = requests.get(media_url, stream=True)
-        media_file.raw.decode_content = True
+            cache.put(to, owner, media_id, url=media_url, digest=media_file.digest)
 
-        temp_file = tempfile.NamedTemporaryFile(delete=False)
-        temp_file.write(media_file.raw.read())
-        temp_file.close()
+        return media_id
 
-        file_extension = mimetypes.guess_extension(media_file.headers['Content-type'])
-        upload_file_name = temp_file.name + file_extension
-        os.rename(temp_file.name, upload_file_name)
+    def transfer_medias(self, media_urls, to='twitter'):
+        """
+        Transfers several medias from a network to another, concurrently.
 
-        temp_file_read = open(upload_file_name, 'rb')
-        lg('Medias', f'Uploading {upload_file_name} to {"Twitter" if to == "twitter" else "Mastodon"}')
+        If a media cannot be transferred, it is skipped and the others are
+        still returned, unless the destination is rate limited: the status
+        is then retried later, with all its medias.
 
-        if to == 'twitter':
-            media_id = self.twitter_api.UploadMediaChunked(media=temp_file_read)
-        elif to == 'mastodon':
-            media_id = self.mastodon_api.media_post(upload_file_name)
-        else:
-            raise ValueError(f'Unknown platform "{to}"')
+        :param media_urls: The media URLs.
+        :param to: The destination ('twitter' or 'mastodon', else ValueError is raised)
+        :return: The media IDs on the destination platform, in the same order as the URLs.
+        :raise RetryLater: If the destination is rate limited.
+        """
+        executor = get_media_executor()
+        futures = [executor.submit(self.transfer_media, media_url=media_url, to=to) for media_url in media_urls]
 
-        temp_file_read.close()
-        os.unlink(upload_file_name)
+        media_ids = []
+        for media_url, future in zip(media_urls, futures):
+            try:
+                media_ids.append(future.result())
+            except (ValueError, RetryLater):
+                raise
+            except Exception as e:
+                lgt('Unable to transfer media %s, skipping it: %s', media_url, e, level=logging.WARNING)
 
-        return media_id
+        return media_ids
 
 
-def lg(namespace, message):
+def lg(namespace, message, *args, level=logging.INFO, exc_info=None):
     """
-    Prints a log message.
+    Logs a message. It is written by a background thread, so logging never
+    blocks on a slow output.
     :param namespace: A namespace. If None, uses the current thread name.
-    :param message: A message to be logged.
+    :param message: A message to be logged, with %-style placeholders for the args.
+    :param args: The arguments of the message, only formatted if the message is written.
+    :param level: The level of the message (logging.INFO…).
+    :param exc_info: An exception to log with its traceback.
     """
     if namespace is None:
         namespace = threading.current_thread().name
-    print(f'[{datetime.now():%d/%m/%Y %H:%M:%S}] [{namespace}] {message}')
+    log(namespace, level, message, *args, exc_info=exc_info)
 
 
-def lgt(message):
+def lgt(message, *args, level=logging.INFO, exc_info=None):
     """
-    Prints a log message namespaced with the current thread.
-    :param message: A message to be logged.
+    Logs a message namespaced with the current thread.
+    :param message: A message to be logged, with %-style placeholders for the args.
+    :param args: The arguments of the message, only formatted if the message is written.
+    :param level: The level of the message (logging.INFO…).
+    :param exc_info: An exception to log with its traceback.
     """
-    lg(None, message)
+    lg(None, message, *args, level=level, exc_info=exc_info)
 
 
 def calc_expected_status_length(status, short_url_length=23):
-    status_length = len(status)
-    match = re.findall(config.URL_REGEXP, status)
+    return expected_length(status, short_url_length=short_url_length)
+
+
+class _StatusLength:
+    """
+    Keeps the expected length of a status (see calc_expected_status_length)
+    while words are appended to it, so each word is measured only once
+    instead of re-scanning the whole status.
+
+    URLs never contain spaces, so each word can be measured on its own;
+    the only exception is that no URL is recognized on a line if an "@"
+    appears later on this line. Words of the current line containing
+    URLs are kept aside (as the length they would gain), in case a word
+    with an "@" is appended later on the same line.
+    """
+
+    def __init__(self, short_url_length):
+        self.short_url_length = short_url_length
+        self.value = 0
+        self.pending = 0
+
+    def measure(self, word):
+        """
+        :param word: A word, without spaces.
+        :return: The measure of the word, to be given to with_word or add.
+        """
+        length = calc_expected_status_length(word, short_url_length=self.short_url_length)
+
+        last_newline = word.rfind('\n')
+        if last_newline == -1:
+            length_if_at_follows = len(word)
+        else:
+            length_if_at_follows = (calc_expected_status_length(word[:last_newline + 1],
+                                                                short_url_length=self.short_url_length)
+                                    + len(word) - last_newline - 1)
+
+        first_newline = word.find('\n')
+        has_at = '@' in (word if first_newline == -1 else word[:first_newline])
 
-    if match:
-        replaced_chars = len(''.join(map(lambda x: x[0], match)))
-        status_length = status_length - replaced_chars + (short_url_length * len(match))
+        return length, length_if_at_follows - length, has_at, last_newline != -1
 
-    return status_length
+    def with_word(self, measure, separator=1):
+        """
+        :param measure: A word measure.
+        :param separator: The length of the separator before the word.
+        :return: The expected length if this word was added.
+        """
+        length, _, has_at, _ = measure
+        return self.value + separator + length + (self.pending if has_at else 0)
+
+    def add(self, measure, separator=1):
+        """
+        Adds a word.
+        :param measure: A word measure.
+        :param separator: The length of the separator before the word.
+        """
+        length, gain_if_at_follows, has_at, has_newline = measure
+
+        self.value = self.with_word(measure, separator)
+        if has_at:
+            self.pending = 0
+
+        if has_newline:
+            self.pending = gain_if_at_follows
+        else:
+            self.pending += gain_if_at_follows
+
+    def reset(self, status):
+        """
+        Restarts the count with the given status.
+        :param status: The status.
+        """
+        self.value = 0
+        self.pending = 0
+
+        for i, word in enumerate(status.split(' ')):
+            self.add(self.measure(word), separator=1 if i else 0)
 
 
 re_hashtag_begin = re.compile(r'^((?:#[a-zA-Z0-9]+(?:\s+)?)+)')
@@ -160,9 +468,6 @@ def split_status(status, max_length, split=True, url=None, url_length=None):
             hashtags_begin = match.group(1)
             status = re_hashtag_begin.sub('', status).lstrip()
         match = re_hashtag_end.search(status)
-        print(match)
-        print(match.group(1))
-        print(re_hashtag_end.sub('', status))
         if match:
             hashtags_end = match.group(1)
             status = re_hashtag_end.sub('', status).rstrip()
@@ -181,15 +486,21 @@ def split_status(status, max_length, split=True, url=None, url_length=None):
     hashtags_len = len(hashtags_begin) + len(hashtags_end)
 
     if calc_expected_status_length(status, short_url_length=url_length) > max_length:
-        current_part = ''
+        # The current part is ' '.join(current_words), built only when needed
+        current_words = ['']
+        current_length = _StatusLength(url_length)
+
         for next_word in status.split(' '):
+            next_word_length = current_length.measure(next_word)
+
             # Need to split here?
-            if calc_expected_status_length(current_part + ' ' + next_word, short_url_length=url_length) + len(hashtags_end) > max_length:
-                space_left = max_length - 5 - (calc_expected_status_length(current_part, short_url_length=url_length) + len(hashtags_end)) - 1
+            if current_length.with_word(next_word_length) + len(hashtags_end) > max_length:
+                space_left = max_length - 5 - (current_length.value + len(hashtags_end)) - 1
+                current_part = ' '.join(current_words)
 
                 if split:
                     # Want to split word?
-                    if len(next_word) > 30 and space_left > 5 and not twitter.twitter_utils.is_url(next_word):
+                    if len(next_word) > 30 and space_left > 5 and not is_url(next_word):
                         current_part = current_part + ' ' + next_word[:space_left] + hashtags_end
                         content_parts.append(current_part)
                         current_part = hashtags_begin + next_word[space_left:]
@@ -201,16 +512,21 @@ def split_status(status, max_length, split=True, url=None, url_length=None):
                     while len(current_part) + hashtags_len > max_length - 5:
                         content_parts.append(hashtags_begin + current_part[:max_length - 5 - hashtags_len] + hashtags_end)
                         current_part = current_part[max_length - 5:]
+
+                    current_words = [current_part]
+                    current_length.reset(current_part)
                 else:
                     space_for_suffix = len('… ') + url_length
                     content_parts.append(current_part[:-space_for_suffix] + '… ' + url)
-                    current_part = ''
+                    current_words = ['']
                     break
             else:
                 # Just plop next word on
-                current_part = current_part + ' ' + next_word
+                current_words.append(next_word)
+                current_length.add(next_word_length)
 
         # Insert last part
+        current_part = ' '.join(current_words)
         if len(current_part.strip()) != 0 or len(content_parts) == 0:
             content_parts.append(current_part.strip() + hashtags_end)
 
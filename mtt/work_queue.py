@@ -0,0 +1,245 @@
+import heapq
+import logging
+import itertools
+import time
+
+from collections import deque
+from threading import Condition, Thread
+
+from mtt.utils import lg
+
+
+class WorkQueue:
+    """
+    A bounded queue of statuses to crosspost, consumed by a pool of workers.
+
+    Statuses of the same conversation are processed one after the other, in
+    the order they were queued: a status replying to a status still queued
+    or being processed joins its conversation, and waits for it. Other
+    statuses are processed concurrently.
+
+    When the queue is full, `put` blocks until a status is processed. A
+    status already queued or being processed is not queued again (streams
+    may send a status again after a reconnection, and a status caught up
+    may also come from the stream).
+
+    The handler can return a delay to retry a status later (e.g. when rate
+    limited): the worker is released, and the status is queued again after
+    the delay, at the head of its conversation, which waits for it.
+    Statuses still waiting to be retried when the queue is closed are
+    dropped; they are resumed from the outbox at the next start.
+
+    Without workers, the queue is consumed by calling `take` and `process`
+    (this is how the asyncio engine schedules statuses).
+    """
+
+    def __init__(self, handler, name, workers=4, max_size=100):
+        """
+        :param handler: The function processing a status, called with the
+                        status and the number of attempts already done. Returns
+                        None, or a delay to retry the status after (seconds).
+        :param name: The name of the queue, used to name the workers.
+        :param workers: The number of workers (0 if the queue is consumed
+                        with `take` and `process`).
+        :param max_size: The maximal number of queued statuses (not counting
+                         the ones being processed).
+        """
+        self.handler = handler
+        self.name = name
+        self.workers = [Thread(target=self._work, name=f'{name} #{i + 1}', daemon=True) for i in range(workers)]
+        self.max_size = max_size
+
+        self.condition = Condition()
+        self.closed = False
+
+        # Conversation keys with queued statuses, ready to be processed
+        self.ready = deque()
+        # Conversation key -> queue of (status ID, status, attempt, queued at)
+        self.pending = {}
+        # Conversation keys being processed by a worker
+        self.busy = set()
+        # Heap of (due at, sequence, conversation key, status ID, status, attempt) to retry
+        self.delayed = []
+        self.sequence = itertools.count()
+        # Status ID -> conversation key, for the statuses queued or being processed
+        self.conversations = {}
+        self.size = 0
+        # Statuses taken and not processed yet
+        self.running = 0
+        # True while the queue is saturated (logged once)
+        self.saturated = False
+
+        self.processed = 0
+        self.dequeued = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def start(self):
+        """
+        Starts the workers.
+        """
+        for worker in self.workers:
+            worker.start()
+
+    def put(self, status_id, in_reply_to_id, status):
+        """
+        Queues a status, unless it is already queued or being processed.
+        Blocks while the queue is full.
+
+        :param status_id: The status ID.
+        :param in_reply_to_id: The ID of the status it replies to, or None.
+        :param status: The status.
+        """
+        with self.condition:
+            if status_id in self.conversations:
+                lg(self.name, 'Status %s already queued, ignoring it', status_id, level=logging.DEBUG)
+                return
+
+            if self.size >= self.max_size:
+                if not self.saturated:
+                    lg(self.name, 'Work queue full (%d statuses), pausing the stream reading', self.size,
+                       level=logging.WARNING)
+                    self.saturated = True
+                self.condition.wait_for(lambda: self.size < self.max_size)
+
+                # Queued by another thread in the meantime
+                if status_id in self.conversations:
+                    return
+            elif self.saturated and self.size <= self.max_size // 2:
+                self.saturated = False
+
+            conversation = self.conversations.get(in_reply_to_id, status_id)
+            self.conversations[status_id] = conversation
+
+            statuses = self.pending.setdefault(conversation, deque())
+            statuses.append((status_id, status, 0, time.monotonic()))
+            if len(statuses) == 1 and conversation not in self.busy:
+                self.ready.append(conversation)
+
+            self.size += 1
+            self.condition.notify_all()
+
+    def close(self):
+        """
+        Waits for the queued statuses to be processed, and stops the workers.
+        Once closed, `take` returns None when everything taken is processed.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+        for worker in self.workers:
+            worker.join()
+
+    def _promote_due(self):
+        """
+        Queues again the statuses to retry whose delay is over.
+        :return: The time before the next one is due (seconds), or None if there is none.
+        """
+        now = time.monotonic()
+
+        while self.delayed and self.delayed[0][0] <= now:
+            _, _, conversation, status_id, status, attempt = heapq.heappop(self.delayed)
+            self.pending.setdefault(conversation, deque()).appendleft((status_id, status, attempt, now))
+            self.busy.discard(conversation)
+            self.ready.append(conversation)
+            self.size += 1
+
+        return self.delayed[0][0] - now if self.delayed else None
+
+    def take(self):
+        """
+        Waits for a status to process: the next one of a conversation is only
+        handed out once the previous one is processed.
+        :return: A status to give to `process`, or None once the queue is
+                 closed and the statuses taken are processed.
+        """
+        with self.condition:
+            while True:
+                next_due_in = self._promote_due()
+                if self.ready or (self.closed and not self.running):
+                    break
+                self.condition.wait(next_due_in)
+
+            if not self.ready:
+                # Closed, and nothing left to process
+                return None
+
+            conversation = self.ready.popleft()
+            self.busy.add(conversation)
+            status_id, status, attempt, queued_at = self.pending[conversation].popleft()
+            self.size -= 1
+            self.running += 1
+
+            wait = time.monotonic() - queued_at
+            self.dequeued += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+
+            self.condition.notify_all()
+
+            return conversation, status_id, status, attempt
+
+    def process(self, item):
+        """
+        Processes a status returned by `take` with the handler. If the
+        handler returns a delay, the status is queued again after it.
+        :param item: The status, as returned by `take`.
+        """
+        conversation, status_id, status, attempt = item
+
+        retry_in = None
+        try:
+            retry_in = self.handler(status, attempt)
+        except Exception as e:
+            lg(None, 'Unhandled exception happened - giving up on this status: %s', e,
+               level=logging.ERROR, exc_info=e)
+
+        with self.condition:
+            self.running -= 1
+
+            if retry_in is not None:
+                # The conversation stays busy until the status is retried
+                heapq.heappush(self.delayed, (time.monotonic() + retry_in, next(self.sequence),
+                                              conversation, status_id, status, attempt + 1))
+                self.condition.notify_all()
+                return
+
+            self.processed += 1
+            self.busy.discard(conversation)
+            self.conversations.pop(status_id, None)
+
+            if self.pending[conversation]:
+                self.ready.append(conversation)
+            else:
+                del self.pending[conversation]
+
+            self.condition.notify_all()
+
+    def _work(self):
+        while True:
+            # Broad exception so a failure does not stop the worker
+            try:
+                item = self.take()
+                if item is None:
+                    return
+                self.process(item)
+            except Exception as e:
+                lg(self.name, 'Unexpected error in the work queue: %s', e, level=logging.ERROR, exc_info=e)
+
+    @property
+    def stats(self):
+        """
+        :return: A dict with the queue depth, the number of statuses being and
+                 already processed, waiting to be retried, and the mean and max
+                 time spent in queue (seconds).
+        """
+        with self.condition:
+            return {
+                'depth': self.size,
+                'in_progress': len(self.busy),
+                'processed': self.processed,
+                'retrying': len(self.delayed),
+                'mean_wait': self.total_wait / self.dequeued if self.dequeued else 0.0,
+                'max_wait': self.max_wait
+            }